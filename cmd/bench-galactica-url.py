@@ -0,0 +1,89 @@
+import argparse
+import timeit
+
+from mdlg.model.model import GalacticaURL, ZONE_FULL, SIZE_FULL
+
+# micro-benchmark of GalacticaURL, on the operations run for each image by ImagesManager and ViaLabelManager
+# the urls are read from the Gallica dump file of Mandragore (Zoologie-URLs-Gallica.txt : imageID <tab> url),
+# or generated if no file is given
+
+
+class ListGalacticaURL:
+    # previous implementation of GalacticaURL, kept here as the reference of the benchmark
+    def __init__(self, parts):
+        self.params = parts
+
+    @classmethod
+    def from_url(cls, url):
+        parts = url.split("/")
+        parts += ([''] * (12 - len(parts)))
+        return cls(parts)
+
+    def document_id(self) -> str:
+        return self.params[6][5:-1]
+
+    def page_number(self) -> int:
+        return int(self.params[7][1:])
+
+    def file_format(self) -> str:
+        end = self.params[11].split(".")
+        return end[1] if len(end) > 1 else ""
+
+    def as_filename(self) -> str:
+        return f"IMG-{self.document_id()}_P-{self.page_number()}.{self.file_format()}"
+
+    def as_url(self) -> str:
+        return "/".join(self.params)
+
+    def set_zone(self, zone=ZONE_FULL):
+        szone = "full" if zone is None or zone == "full" or zone == ZONE_FULL else ",".join(map(str, zone))
+        return ListGalacticaURL(self.params[0:8] + [szone] + self.params[9:])
+
+    def set_size(self, final_size=SIZE_FULL):
+        ssize = "pct:%d" % int(final_size) if isinstance(final_size, int) else \
+            "full" if final_size is None or final_size == SIZE_FULL else ",".join(map(str, final_size))
+        return ListGalacticaURL(self.params[0:9] + [ssize] + self.params[10:])
+
+
+def read_urls(filename):
+    with open(filename, 'r', encoding='utf-8') as f:
+        return [line.rstrip('\n').split('\t')[1] for line in f if '\t' in line]
+
+
+def generated_urls(count):
+    return ["https://gallica.bnf.fr/iiif/ark:/12148/btv1b%dd/f%d/full/pct:50/0/native.jpg" % (8470000 + i // 200, i % 200 + 1) for i in range(count)]
+
+
+def per_image(cls, urls):
+    # what is done for each image : page url of the scene, then name and url of the file to download
+    for url in urls:
+        gal = cls.from_url(url).set_zone(ZONE_FULL)
+        gal.as_url()
+        gal = gal.set_size(20)
+        gal.as_filename()
+        gal.as_url()
+        gal.as_filename()
+
+
+def run(name, statement, repeat):
+    best = min(timeit.repeat(statement, number=1, repeat=repeat))
+    print("%-40s %8.1f ms" % (name, best * 1000))
+    return best
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-f', '--urls-file', type=str, required=False, help="Zoologie-URLs-Gallica.txt from the Mandragore dumps")
+    parser.add_argument('-n', '--count', type=int, default=100000, help="number of urls generated, when no file is given")
+    parser.add_argument('-r', '--repeat', type=int, default=5)
+    args = vars(parser.parse_args())
+
+    urls = read_urls(args['urls_file']) if args['urls_file'] else generated_urls(args['count'])
+    print("%d urls (%d distinct)" % (len(urls), len(set(urls))))
+
+    reference = run("list based GalacticaURL", lambda: per_image(ListGalacticaURL, urls), args['repeat'])
+    current = run("GalacticaURL", lambda: per_image(GalacticaURL, urls), args['repeat'])
+    print("ratio to the list based implementation : x%.2f" % (reference / current))
+    # parsing only : one from_url per url, or parse_many for the callers parsing many urls at once (each distinct url parsed once)
+    run("GalacticaURL.from_url", lambda: [GalacticaURL.from_url(u) for u in urls], args['repeat'])
+    run("GalacticaURL.parse_many", lambda: GalacticaURL.parse_many(urls), args['repeat'])
@@ -10,7 +10,7 @@ setup(
     package_dir={'': 'src'},  # tell distutils packages are under src
     packages=find_namespace_packages('src'),  # include all packages under src
     project_urls={'Source Code': 'https://github.com/fturib/mandlagore'},
-    install_requires=['click', 'requests'],
+    install_requires=['click', 'requests', 'numpy', 'Pillow'],
     package_data={
         '': ['*.sql'],
     },
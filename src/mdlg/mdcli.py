@@ -1,10 +1,20 @@
 import click
 import os
+import csv
+import json
 from mdlg.persistence.db import PersistMandlagore
 from mdlg.persistence.remoteHttp import GalacticaSession
+from mdlg.persistence.iiifCache import IIIFInfoCache
 from mdlg.services.mandragore_dump_manager import MandragoreDumpManager
 from mdlg.services.via_label_manager import ViaLabelManager
 from mdlg.services.image_manager import ImagesManager
+from mdlg.services.crop_manager import CropsManager
+from mdlg.services.dataset_snapshot import DatasetSnapshot
+from mdlg.services.pyramid_store import PyramidStore
+from mdlg.services.dhsegment_generator import DhSegmentGenerator
+from mdlg.services.classify_exporter import ClassifyExporter
+from mdlg.services.ornaments_postprocess import OrnamentsPostProcessor, MIN_AREA
+from mdlg.services.ornaments_eval import OrnamentsEvaluator, CUTOFFS
 
 # TODO to initialize the DB
 # 1- we consider the schema is ready
@@ -63,7 +73,9 @@ class MdlgEnv(object):
         'classify_train': 'images/generated/classify/train',
         'classify_predict': 'images/generated/classify/predict',
         'import_dumps': 'import/mandragore-dumps',
-        'import_labels': 'import/via-labels'
+        'import_labels': 'import/via-labels',
+        'iiif_cache': 'cache/iiif-info',
+        'snapshot': 'cache/snapshot'
     }
     DB_FILENAME = 'mdlg.db'
 
@@ -76,6 +88,12 @@ class MdlgEnv(object):
     def db_filename(self) -> str:
         return os.path.join(self._rootdir, MdlgEnv.DB_FILENAME)
 
+    def open_db(self) -> PersistMandlagore:
+        # the DB of the root dir, with its schema created or migrated to the current version if needed
+        db = PersistMandlagore(self.db_filename())
+        db.ensure_schema(rebuilt=False)
+        return db
+
     def _ensure_and_check_dir(self, key_name) -> str:
         dname = os.path.join(self._rootdir, MdlgEnv.DIR_LOCATION[key_name])
         if not os.path.exists(dname):
@@ -96,6 +114,21 @@ class MdlgEnv(object):
     def source_images_galactica_dirname(self) -> str:
         return self._ensure_and_check_dir('galactica')
 
+    def iiif_cache_dirname(self) -> str:
+        return self._ensure_and_check_dir('iiif_cache')
+
+    def dhsegment_train_dirname(self) -> str:
+        return self._ensure_and_check_dir('dhsegment_train')
+
+    def dhsegment_predict_dirname(self) -> str:
+        return self._ensure_and_check_dir('dhsegment_predict')
+
+    def classify_train_dirname(self) -> str:
+        return self._ensure_and_check_dir('classify_train')
+
+    def snapshot_dirname(self) -> str:
+        return self._ensure_and_check_dir('snapshot')
+
     def __repr__(self):
         return '<MdlgEnv %r>' % self._rootdir
 
@@ -125,12 +158,26 @@ def reset(mdlgenv: MdlgEnv):
         if not os.path.isfile(pathdb):
             raise Exception("the root dir provided contains already a dir named {} - it should be a simple file".format(pathdb))
         os.remove(pathdb)
+    # journal files left by the WAL mode
+    for suffix in ('-wal', '-shm'):
+        if os.path.isfile(pathdb + suffix):
+            os.remove(pathdb + suffix)
 
     with PersistMandlagore(pathdb) as db:
         version = db.ensure_schema(rebuilt=True)
         click.echo("Mdlg DB rebuilt on file : {} - version {}".format(mdlgenv.db_filename(), version))
 
 
+@mdcli.command()
+@pass_env
+def migrate(mdlgenv: MdlgEnv):
+    # upgrade the schema of the DB to the current version, keeping its data
+    with PersistMandlagore(mdlgenv.db_filename()) as db:
+        before = db.schema_version()
+        version = db.ensure_schema(rebuilt=False)
+        click.echo("Mdlg DB on file : {} - version {} (was {})".format(mdlgenv.db_filename(), version, before))
+
+
 @mdcli.command()
 def backup():
     click.echo("Not yet implemented")
@@ -150,8 +197,7 @@ def download():
 @pass_env
 def mandragore(mdlgenv: MdlgEnv):
     # load last downloaded dumps in the DB
-    pathdb = mdlgenv.db_filename()
-    with PersistMandlagore(pathdb) as db:
+    with mdlgenv.open_db() as db:
         dname = mdlgenv.dump_data_dirname()
         mng = MandragoreDumpManager(dname, db)
         report = mng.load_bnf_data()
@@ -166,12 +212,12 @@ def mandragore(mdlgenv: MdlgEnv):
 
 @mdcli.command()
 @pass_env
-def labels(mdlgenv: MdlgEnv):
+@click.option('-w', '--workers', type=click.IntRange(min=1), default=4, help="number of image sizes collected concurrently")
+def labels(mdlgenv: MdlgEnv, workers):
     # load labels frol all the VIA annotation files available in the import folder
-    pathdb = mdlgenv.db_filename()
-    with PersistMandlagore(pathdb) as db, GalacticaSession() as gal:
+    with mdlgenv.open_db() as db, GalacticaSession(cache=IIIFInfoCache(mdlgenv.iiif_cache_dirname())) as gal:
         dname = mdlgenv.via_annotation_dirname()
-        vlm = ViaLabelManager(dname, db, gal)
+        vlm = ViaLabelManager(dname, db, gal, workers)
         report = vlm.import_labels()
 
         click.echo("Mdlg labels (VIA annotations) imported into the DB")
@@ -216,24 +262,131 @@ def build_filter_from_option(param: str, value: str) -> list:
 @click.option('-l', '--limit', type=int, help="limit quantity images to process")
 @click.option('--dryrun', is_flag=True, help="download operations are avoided, only actions are printed")
 @click.option('--faked', is_flag=True, help="download is simulated")
-def galactica(mdlgenv: MdlgEnv, images, scenes, descriptors, limit, dryrun, faked):
+@click.option('-w', '--workers', type=click.IntRange(min=1), default=1, help="number of images downloaded concurrently")
+@click.option('--max-connections', type=click.IntRange(min=1), default=4, help="max connections opened at the same time on one galactica host")
+@click.option('--missing-only', is_flag=True, help="only images with no downloaded file recorded in DB")
+@click.option('-z', '--zoom', type=click.IntRange(min=1, max=100), default=ImagesManager.DOWNLOAD_ZOOM, help="pct of the full pages downloaded")
+@click.option('--crops', is_flag=True, help="download only the regions of the located scenes, at full resolution, instead of the whole pages")
+@click.option('--tile-size', type=click.IntRange(min=64), default=CropsManager.TILE_SIZE, help="with --crops, larger regions are downloaded by tiles of this size")
+def galactica(mdlgenv: MdlgEnv, images, scenes, descriptors, limit, dryrun, faked, workers, max_connections, missing_only, zoom, crops, tile_size):
     # complete download informations from Galactica : images and size of images
     # we should have filters:
     # -all to download everything
     # -scenes to complete only images involved in scenes that are located (have a defined position in the image)
     # -size for size only
-    pathdb = mdlgenv.db_filename()
     filter = [build_filter_from_option('images', f) for f in images]
     filter += [build_filter_from_option('scenes', f) for f in scenes]
     filter += [build_filter_from_option('descriptors', f) for f in descriptors]
-    with PersistMandlagore(pathdb) as db, GalacticaSession() as gal:
-        imgr = ImagesManager(mdlgenv.source_images_galactica_dirname(), db, gal)
-        imgr.ensure_content_images(filter, limit, dryrun, faked)
+    with mdlgenv.open_db() as db, GalacticaSession(max_connections, IIIFInfoCache(mdlgenv.iiif_cache_dirname())) as gal:
+        if crops:
+            cmgr = CropsManager(mdlgenv.source_images_galactica_dirname(), db, gal, tile_size)
+            click.echo(cmgr.ensure_crop_images(filter, limit, dryrun, faked, workers))
+            return
+        imgr = ImagesManager(mdlgenv.source_images_galactica_dirname(), db, gal, zoom)
+        imgr.ensure_content_images(filter, limit, dryrun, faked, workers, missing_only)
 
 
 @mdcli.command()
-def dhsegment():
-    click.echo("Not yet implemented")
+@pass_env
+def snapshot(mdlgenv: MdlgEnv):
+    # save images, scenes and descriptors of the DB as a columnar snapshot, loaded by the training set generators
+    with mdlgenv.open_db() as db:
+        snap = DatasetSnapshot.from_db(db)
+    snap.save(mdlgenv.snapshot_dirname())
+    click.echo("Mdlg snapshot saved in : {} - {} images, {} scenes, {} descriptors".format(mdlgenv.snapshot_dirname(), len(snap.images), len(snap.scenes),
+                                                                                         len(snap.descriptors)))
+
+
+@mdcli.command()
+@pass_env
+@click.option('-i', '--images', multiple=True, help="filtering on images\nformat is [field==](value|patttern|(val,)*)")
+@click.option('-s', '--scenes', multiple=True, help="filtering on scenes, with same format as above")
+@click.option('-l', '--limit', type=int, help="limit quantity of pages in the training set")
+@click.option('-w', '--workers', type=click.IntRange(min=1), help="number of processes (default is the number of cores)")
+@click.option('--max-side', type=click.IntRange(min=16), default=DhSegmentGenerator.MAX_SIDE, help="size in pixels of the longest side of the pages")
+@click.option('--split', default=",".join(map(str, DhSegmentGenerator.SPLIT)), help="ratios of the train, test and validation sets")
+def dhsegment(mdlgenv: MdlgEnv, images, scenes, limit, workers, max_side, split):
+    # generate the training set for dh-segment, from the located scenes and the pages downloaded from galactica
+    ratios = [float(r) for r in split.split(',')]
+    if len(ratios) != 3 or min(ratios) < 0 or sum(ratios) <= 0:
+        raise click.BadParameter("expected 3 ratios, for train, test and validation", param_hint='--split')
+    filter = [build_filter_from_option('images', f) for f in images]
+    filter += [build_filter_from_option('scenes', f) for f in scenes]
+    with mdlgenv.open_db() as db:
+        store = PyramidStore(mdlgenv.source_images_galactica_dirname(), db)
+        generator = DhSegmentGenerator(mdlgenv.dhsegment_train_dirname(), db, store, max_side, ratios)
+        click.echo(generator.generate(filter, limit, workers))
+
+
+def read_post_process_params(filename: str) -> dict:
+    # params of the post-processing, in the section 'params' of a json file (as the params files of Ornaments)
+    if filename is None:
+        return None
+    with open(filename, 'r') as f:
+        return json.load(f)['params']
+
+
+@mdcli.command()
+@pass_env
+@click.option('-d', '--predictions', type=click.Path(exists=True, file_okay=False), help="folder of the predictions (.npy), default is the predict folder of dhsegment")
+@click.option('-p', '--params', type=click.Path(exists=True, dir_okay=False), help="json file of the params of the post-processing (section 'params')")
+@click.option('-o', '--output', type=click.Path(dir_okay=False), help="csv file of the boxes found, default is boxes.csv in the folder of the predictions")
+@click.option('--min-area', type=click.FloatRange(min=0, max=1), default=MIN_AREA, help="boxes smaller than this part of the page are ignored")
+@click.option('-w', '--workers', type=click.IntRange(min=1), help="number of processes (default is the number of cores)")
+@click.option('-r', '--run', help="id of the run : the boxes are also recorded in DB, as the predictions of this run")
+def postprocess(mdlgenv: MdlgEnv, predictions, params, output, min_area, workers, run):
+    # extract the boxes of the scenes from the predictions of dh-segment
+    with mdlgenv.open_db() as db:
+        processor = OrnamentsPostProcessor(db, read_post_process_params(params), min_area)
+        click.echo(processor.process_dir(predictions or mdlgenv.dhsegment_predict_dirname(), output, workers, run))
+
+
+@mdcli.command()
+@pass_env
+@click.argument('old_run')
+@click.argument('new_run')
+@click.option('--iou', type=click.FloatRange(min=0, max=1), default=0.5, help="IoU from which 2 boxes are the same scene")
+@click.option('-o', '--output', type=click.Path(dir_okay=False), help="csv file of the differences")
+def diff(mdlgenv: MdlgEnv, old_run, new_run, iou, output):
+    # compare the predictions of 2 runs recorded in DB (see postprocess --run)
+    with mdlgenv.open_db() as db:
+        runs = {r['runID'] for r in db.retrieve_prediction_runs()}
+        for r in (old_run, new_run):
+            if r not in runs:
+                raise click.BadParameter("no run %s in DB" % r)
+        differences = db.diff_predictions(old_run, new_run, iou)
+    if output is not None:
+        with open(output, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(('change', 'imageID', 'x', 'y', 'width', 'height', 'new x', 'new y', 'new width', 'new height', 'iou'))
+            writer.writerows(('added', r[0], '', '', '', '') + r[1:5] + ('', ) for r in differences['added'])
+            writer.writerows(('removed', ) + r[:5] + ('', '', '', '', '') for r in differences['removed'])
+            writer.writerows(('moved', ) + r[:9] + (round(r[9], 4), ) for r in differences['moved'])
+    click.echo("%s -> %s : %d boxes added, %d boxes removed, %d boxes moved (IoU >= %g)" % (old_run, new_run, len(differences['added']),
+                                                                                         len(differences['removed']), len(differences['moved']), iou))
+
+
+@mdcli.command()
+@pass_env
+@click.option('-d', '--predictions', type=click.Path(exists=True, file_okay=False), help="folder of the predictions (.npy), default is the predict folder of dhsegment")
+@click.option('-p', '--params', type=click.Path(exists=True, dir_okay=False),
+              help="json file of the grid of params (section 'params', each param having a list of values)")
+@click.option('-o', '--output', type=click.Path(dir_okay=False), help="csv file of the scores, default is eval.csv in the folder of the predictions")
+@click.option('--cutoffs', default=",".join(map(str, CUTOFFS)), help="IoU from which a box matches a scene")
+@click.option('--min-area', type=click.FloatRange(min=0, max=1), default=MIN_AREA, help="boxes smaller than this part of the page are ignored")
+@click.option('-w', '--workers', type=click.IntRange(min=1), help="number of processes (default is the number of cores)")
+def evaluate(mdlgenv: MdlgEnv, predictions, params, output, cutoffs, min_area, workers):
+    # score the post-processing of the predictions of dh-segment against the scenes located in DB, for each params of a grid
+    try:
+        cutoffs = [float(c) for c in cutoffs.split(',')]
+    except ValueError:
+        raise click.BadParameter("expected IoU separated by comma", param_hint='--cutoffs')
+    with mdlgenv.open_db() as db:
+        try:
+            evaluator = OrnamentsEvaluator(db, read_post_process_params(params), cutoffs, min_area)
+        except ValueError as e:
+            raise click.BadParameter(str(e), param_hint='--params')
+        click.echo(evaluator.evaluate_dir(predictions or mdlgenv.dhsegment_predict_dirname(), output, workers))
 
 
 @mdcli.command()
@@ -242,8 +395,21 @@ def predict():
 
 
 @mdcli.command()
-def classify():
-    click.echo("Not yet implemented")
+@pass_env
+@click.option('-l', '--limit', type=int, help="limit quantity of pages in the training set")
+@click.option('-w', '--workers', type=click.IntRange(min=1), help="number of processes (default is the number of cores)")
+@click.option('--max-side', type=click.IntRange(min=16), default=ClassifyExporter.MAX_SIDE, help="size in pixels of the longest side of the crops")
+@click.option('--shard-size', type=click.IntRange(min=1), default=ClassifyExporter.SHARD_SIZE, help="number of crops per shard")
+@click.option('--refresh', is_flag=True, help="rebuild the snapshot of the dataset from the DB before the export")
+def classify(mdlgenv: MdlgEnv, limit, workers, max_side, shard_size, refresh):
+    # generate the training set for class detection : crops of the descriptors, packed in shards
+    dirname = mdlgenv.snapshot_dirname()
+    with mdlgenv.open_db() as db:
+        if refresh or not os.path.exists(os.path.join(dirname, DatasetSnapshot.META_FILENAME)):
+            DatasetSnapshot.from_db(db).save(dirname)
+        store = PyramidStore(mdlgenv.source_images_galactica_dirname(), db)
+        exporter = ClassifyExporter(mdlgenv.classify_train_dirname(), DatasetSnapshot.load(dirname), store, max_side, shard_size)
+        click.echo(exporter.export(limit, workers))
 
 
 if __name__ == '__main__':
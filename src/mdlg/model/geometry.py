@@ -0,0 +1,135 @@
+# Batch operations on boxes, with NumPy
+#
+# a box array is an array of shape (n, 4), a row being : x, y, width, height (the order of ZONE_KEYS)
+# - in pixels, x, y is the upper left corner, lower right is x + width, y + height
+# - in pct, x, y is the middle of the box, width and height being in pct of the outer zone (values in [0, 1])
+# a size array is an array of shape (n, 2) : width, height - or (2, ) for the same size for all the boxes
+#
+# NULL_VALUE marks undefined values in the snapshots: boxes having one are flagged by undefined()
+
+import numpy as np
+
+BOX_KEYS = ('x', 'y', 'width', 'height')
+NULL_VALUE = -1
+
+
+def as_boxes(zones, dtype=np.float64) -> np.ndarray:
+    # box array from : a box array, a list of (x, y, width, height), a list of dict, or a structured array having the fields x, y, width, height
+    if isinstance(zones, np.ndarray) and zones.dtype.names is not None:
+        return np.stack([zones[k] for k in BOX_KEYS], axis=-1).astype(dtype, copy=False)
+    if len(zones) > 0 and isinstance(zones[0], dict):
+        return np.array([[z[k] for k in BOX_KEYS] for z in zones], dtype=dtype).reshape(-1, 4)
+    return np.asarray(zones, dtype=dtype).reshape(-1, 4)
+
+
+def as_sizes(sizes, dtype=np.float64) -> np.ndarray:
+    # size array from : a size array, a (width, height), a list of (width, height), or a box array (only width and height are kept)
+    sizes = np.asarray(sizes, dtype=dtype)
+    return sizes[..., 2:] if sizes.shape[-1] == 4 else sizes
+
+
+def undefined(boxes: np.ndarray) -> np.ndarray:
+    # mask of the boxes having one value undefined (NaN, or NULL_VALUE for width or height)
+    boxes = np.asarray(boxes)
+    return np.isnan(boxes).any(axis=-1) | (boxes[..., 2:] == NULL_VALUE).any(axis=-1)
+
+
+def areas(boxes: np.ndarray) -> np.ndarray:
+    return boxes[..., 2] * boxes[..., 3]
+
+
+def px_to_pct(boxes: np.ndarray, outer_sizes) -> np.ndarray:
+    # boxes in pixels, relative to their outer zone, to boxes in pct of the outer zone (see zone_in_zone_as_pct)
+    sizes = as_sizes(outer_sizes)
+    pct = np.empty(boxes.shape, dtype=np.float64)
+    pct[..., :2] = (boxes[..., :2] + boxes[..., 2:] / 2) / sizes
+    pct[..., 2:] = boxes[..., 2:] / sizes
+    return pct
+
+
+def pct_to_px(pct: np.ndarray, outer_sizes) -> np.ndarray:
+    # reverse of px_to_pct - the values are not rounded
+    sizes = as_sizes(outer_sizes)
+    boxes = np.empty(pct.shape, dtype=np.float64)
+    boxes[..., 2:] = pct[..., 2:] * sizes
+    boxes[..., :2] = pct[..., :2] * sizes - boxes[..., 2:] / 2
+    return boxes
+
+
+def clip(boxes: np.ndarray, sizes) -> np.ndarray:
+    # boxes in pixels reduced to their part inside the image (0, 0, width, height) - a box outside the image gets an empty size
+    sizes = as_sizes(sizes)
+    upper_left = np.clip(boxes[..., :2], 0, sizes)
+    lower_right = np.clip(boxes[..., :2] + boxes[..., 2:], 0, sizes)
+    return np.concatenate([upper_left, np.maximum(lower_right - upper_left, 0)], axis=-1)
+
+
+def rescale(boxes: np.ndarray, zoom) -> np.ndarray:
+    # boxes in pixels of the full image, to pixels of the image downloaded with the size 'pct:<zoom>'
+    # the values are rounded down as galactica does, (an integer zoom per box is allowed, as an array of shape (n, ))
+    zoom = np.asarray(zoom)
+    zoom = zoom[..., None] if zoom.ndim > 0 else zoom
+    return np.floor_divide(np.asarray(boxes) * zoom, 100)
+
+
+def intersections(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    # areas of the intersections of each box of a with each box of b : matrix of shape (len(a), len(b))
+    upper_left = np.maximum(a[:, None, :2], b[None, :, :2])
+    lower_right = np.minimum(a[:, None, :2] + a[:, None, 2:], b[None, :, :2] + b[None, :, 2:])
+    sides = np.maximum(lower_right - upper_left, 0)
+    return sides[..., 0] * sides[..., 1]
+
+
+def iou_matrix(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    # intersection over union of each box of a with each box of b : matrix of shape (len(a), len(b)) - 0 for empty boxes
+    inter = intersections(a, b)
+    union = areas(a)[:, None] + areas(b)[None, :] - inter
+    return np.divide(inter, union, out=np.zeros(inter.shape, dtype=np.float64), where=union > 0)
+
+
+def containment(inner: np.ndarray, outer: np.ndarray) -> np.ndarray:
+    # part of the area of each inner box that is inside each outer box : matrix of shape (len(inner), len(outer)) - 0 for empty boxes
+    inter = intersections(inner, outer)
+    inner_areas = areas(inner)[:, None]
+    return np.divide(inter, inner_areas, out=np.zeros(inter.shape, dtype=np.float64), where=inner_areas > 0)
+
+
+def contained(inner: np.ndarray, outer: np.ndarray, threshold: float = 1.0) -> np.ndarray:
+    # boolean matrix : inner box i is contained in outer box j (at least threshold of its area)
+    return containment(inner, outer) >= threshold
+
+
+def bounding_box(boxes: np.ndarray) -> np.ndarray:
+    # smallest box containing all the boxes
+    upper_left = boxes[:, :2].min(axis=0)
+    return np.concatenate([upper_left, (boxes[:, :2] + boxes[:, 2:]).max(axis=0) - upper_left])
+
+
+def merge_overlapping(boxes: np.ndarray) -> np.ndarray:
+    # boxes that overlap are replaced by their bounding box, until no box overlaps another one (touching boxes are not merged)
+    boxes = np.asarray(boxes)
+    merged = True
+    while merged and len(boxes) > 1:
+        overlap = intersections(boxes, boxes) > 0
+        merged = False
+        result, done = [], np.zeros(len(boxes), dtype=bool)
+        for i in range(len(boxes)):
+            if done[i]:
+                continue
+            group = overlap[i] & ~done
+            done |= group
+            merged |= group.sum() > 1
+            result.append(bounding_box(boxes[group]) if group.any() else boxes[i])
+        boxes = np.array(result, dtype=boxes.dtype)
+    return boxes
+
+
+def tiles(box, tile_size: int) -> np.ndarray:
+    # box array of the tiles of at most tile_size x tile_size pixels covering the box, row by row
+    x, y, width, height = box
+    xs = np.arange(x, x + width, tile_size)
+    ys = np.arange(y, y + height, tile_size)
+    tx, ty = np.meshgrid(xs, ys)
+    tw = np.minimum(tx + tile_size, x + width) - tx
+    th = np.minimum(ty + tile_size, y + height) - ty
+    return np.stack([tx.ravel(), ty.ravel(), tw.ravel(), th.ravel()], axis=-1)
@@ -1,3 +1,5 @@
+from mdlg.model import geometry
+
 ZONE_FULL = (0, 0, None, None)
 SIZE_FULL = (None, None)
 ZONE_KEYS = ('x', 'y', 'width', 'height')
@@ -6,86 +8,146 @@ SIZE_KEYS = ('width', 'height')
 
 class GalacticaURL:
     # https://gallica.bnf.fr/iiif/ark:/12148/btv1b8470209d/f11/398,195,2317,3945/full/0/native.jpg-1
-    def __init__(self, parts):
-        self.params = parts
+    # immutable : the set_xxx methods return a new GalacticaURL - so instances can be shared, and what is derived from the parts is
+    # computed once, on first use
+    __slots__ = ('_params', '_url', '_document_id', '_page_number', '_zone', '_size', '_filename')
+    # number of parts of a full URL (up to the quality and format)
+    PARTS = 12
+
+    def __init__(self, parts, url=None):
+        self._params = parts if type(parts) is tuple else tuple(parts)
+        self._url = url
+        self._document_id = self._page_number = self._zone = self._size = self._filename = None
+
+    @property
+    def params(self) -> tuple:
+        return self._params
 
     @classmethod
     def from_url(cls, url):
         parts = url.split("/")
-        parts += ([''] * (12 - len(parts)))
-        return cls(parts)
+        if len(parts) >= cls.PARTS:
+            return cls(parts, url)
+        return cls(parts + [''] * (cls.PARTS - len(parts)))
+
+    @classmethod
+    def parse_many(cls, urls) -> list:
+        # GalacticaURL of each url, for the callers parsing many urls at once : the same url is parsed once, and gives the same instance
+        parsed = {}
+        return [parsed[u] if u in parsed else parsed.setdefault(u, cls.from_url(u)) for u in urls]
+
+    def _derive(self, parts, keep_filename: bool):
+        # new url sharing what is already parsed from this one (the document and page are never changed by set_xxx)
+        gal = GalacticaURL(parts)
+        gal._document_id, gal._page_number = self._document_id, self._page_number
+        if keep_filename:
+            gal._filename = self._filename
+        return gal
+
+    def _replace(self, index, value, keep_filename: bool):
+        params = self._params
+        if len(params) > index and params[index] == value:
+            return self
+        return self._derive(params[:index] + (value, ) + params[index + 1:], keep_filename)
+
+    def __eq__(self, other):
+        return isinstance(other, GalacticaURL) and self._params == other._params
+
+    def __hash__(self):
+        return hash(self._params)
+
+    def __repr__(self):
+        return '<GalacticaURL %s>' % self.as_url()
 
     def is_valid(self) -> bool:
-        return len(self.params) > 5 and \
-            (self.params[2] == "gallica.bnf.fr" and self.params[3] == "iiif" and self.params[4] == "ark:")
+        return len(self._params) > 5 and \
+            (self._params[2] == "gallica.bnf.fr" and self._params[3] == "iiif" and self._params[4] == "ark:")
 
     def document_id(self) -> str:
-        return self.params[6][5:-1]
+        if self._document_id is None:
+            self._document_id = self._params[6][5:-1]
+        return self._document_id
 
     def page_number(self) -> int:
-        return int(self.params[7][1:])
+        if self._page_number is None:
+            self._page_number = int(self._params[7][1:])
+        return self._page_number
 
     def zone(self) -> ():
-        return ZONE_FULL if self.params[8] is None or self.params[8] == 'full' else dict(zip(ZONE_KEYS, map(int, self.params[8].split(","))))
+        if self._params[8] is None or self._params[8] == 'full':
+            return ZONE_FULL
+        if self._zone is None:
+            self._zone = tuple(map(int, self._params[8].split(",")))
+        return dict(zip(ZONE_KEYS, self._zone))
 
     def size(self) -> ():
-        return SIZE_FULL if self.params[9] is None or self.params[9] == 'full' else dict(zip(SIZE_KEYS, map(int, self.params[9].split(","))))
+        if self._params[9] is None or self._params[9] == 'full':
+            return SIZE_FULL
+        if self._size is None:
+            self._size = tuple(map(int, self._params[9].split(",")))
+        return dict(zip(SIZE_KEYS, self._size))
 
     def rotation(self) -> int:
-        return int(self.params[10]) | 0
+        return int(self._params[10]) | 0
 
     def quality(self) -> str:
-        return self.params[11].split(".")[0]
+        return self._params[11].split(".")[0]
 
     def file_format(self) -> str:
-        end = self.params[11].split(".")
+        end = self._params[11].split(".")
         return end[1] if len(end) > 1 else ""
 
     def as_filename(self) -> str:
         # TDO - review if we want to encode subset/rotation/zoom in the file
-        return f"IMG-{self.document_id()}_P-{self.page_number()}.{self.file_format()}"
+        if self._filename is None:
+            self._filename = f"IMG-{self.document_id()}_P-{self.page_number()}.{self.file_format()}"
+        return self._filename
 
     def as_url(self) -> str:
-        return "/".join(self.params)
+        if self._url is None:
+            self._url = "/".join(self._params)
+        return self._url
 
     def url_image_properties(self):
-        return GalacticaURL(self.params[0:8] + ['info.json'])
+        return self._derive(self._params[0:8] + ('info.json', ), False)
 
     def set_zone(self, zone=ZONE_FULL):
         szone = "full" if zone is None or zone == "full" or zone == ZONE_FULL else ",".join(map(str, zone))
-        parts = self.params[0:8] + [szone] + self.params[9:]
-        return GalacticaURL(parts)
+        return self._replace(8, szone, True)
 
     def set_size(self, final_size=SIZE_FULL):
         ssize = "pct:%d" % int(final_size) if isinstance(final_size, int) else \
             "full" if final_size is None or final_size == SIZE_FULL else ",".join(map(str, final_size))
-        parts = self.params[0:9] + [ssize] + self.params[10:]
-        return GalacticaURL(parts)
+        return self._replace(9, ssize, True)
 
     def set_rotation(self, rotation=0):
-        parts = self.params[0:10] + [str(rotation)] + self.params[11:]
-        return GalacticaURL(parts)
+        return self._replace(10, str(rotation), True)
 
     def set_quality(self, quality="native"):
-        parts = self.params[0:11] + ["%s.%s" % (quality, self.file_format())]
-        return GalacticaURL(parts)
+        return self._replace(11, "%s.%s" % (quality, self.file_format()), True)
 
     def set_file_format(self, file_format="jpg"):
-        parts = self.params[0:11] + ["%s.%s" % (self.quality(), file_format)]
-        return GalacticaURL(parts)
+        return self._replace(11, "%s.%s" % (self.quality(), file_format), False)
 
 
 def zone_in_zone_as_pct(outer_zone_px, inner_zone_px) -> dict:
     # each zone is describe as : x, y, width, height
     # absolute zone is in pixels (x, y is upper left corner, lower right is x+width, y+height
     # pct zone is a float where : x, y is middle of the inner zone (in pct) and widht, height in pct of outerzone
+    # (see geometry.px_to_pct to convert many zones at once)
+
+    pct = geometry.px_to_pct(geometry.as_boxes([inner_zone_px]), (outer_zone_px['width'], outer_zone_px['height']))
+    return dict(zip(ZONE_KEYS, pct[0].tolist()))
+
+
+def zone_iou(zone_a, zone_b) -> float:
+    # intersection over union of 2 zones in pixels (see geometry.iou_matrix)
+    return float(geometry.iou_matrix(geometry.as_boxes([zone_a]), geometry.as_boxes([zone_b]))[0, 0])
 
-    w_pct = inner_zone_px['width'] / outer_zone_px['width']
-    h_pct = inner_zone_px['height'] / outer_zone_px['height']
-    x_middle_pct = (inner_zone_px['x'] + inner_zone_px['width'] / 2) / outer_zone_px['width']
-    y_middle_pct = (inner_zone_px['y'] + inner_zone_px['height'] / 2) / outer_zone_px['height']
 
-    return {'x': x_middle_pct, 'y': y_middle_pct, 'width': w_pct, 'height': h_pct}
+def zone_in_zone(outer_zone_px, inner_zone_px, threshold=1.0) -> bool:
+    # True if at least threshold of the area of inner zone is inside outer zone (see geometry.contained)
+    return bool(geometry.contained(geometry.as_boxes([inner_zone_px]), geometry.as_boxes([outer_zone_px]), threshold)[0, 0])
 
 
 def get_one_field_values(array_of_dict: list, fieldname: str) -> set:
@@ -2,8 +2,15 @@ import sqlite3
 from sqlite3 import Error
 import os
 import csv
+import json
+import time
 import typing
-from collections import namedtuple
+import itertools
+import functools
+import queue
+import threading
+from contextlib import contextmanager
+from collections import namedtuple, deque
 
 
 class TableDescription(object):
@@ -48,14 +55,97 @@ TABLES_DESCRIPTIONS = [
     TableDescription('images', ['imageID'], ['documentURL', 'width', 'height'], []),
     TableDescription('scenes', ['mandragoreID', 'imageID'], ['x', 'y', 'width', 'height'], [['mandragores', 'mandragoreID'], ['images', 'imageID']]),
     TableDescription('descriptors', ['mandragoreID', 'classID'], ['x', 'y', 'width', 'height'], [['mandragores', 'mandragoreID'], ['classes', 'classID']]),
+    TableDescription('image_files', ['path'], ['imageID', 'zoom', 'bytes', 'width', 'height', 'sha256', 'region'], [['images', 'imageID']]),
+    TableDescription('prediction_runs', ['runID'], ['created', 'params'], []),
+    TableDescription('predictions', ['runID', 'imageID', 'x', 'y', 'width', 'height'], ['score'], [['prediction_runs', 'runID'], ['images', 'imageID']]),
 ]
 
 TABLES = {t.name: t for t in TABLES_DESCRIPTIONS}
 
+# version of the schema built by mandlagore.db.schema.sql
+SCHEMA_VERSION = 4
+
+# migrations/NNNN_<name>.sql upgrade a DB from version NNNN-1 to version NNNN
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'migrations')
+
+
+def list_migrations(dirname=MIGRATIONS_DIR) -> [(int, str)]:
+    # the migration scripts of dirname, as (version, filename) ordered by version
+    migrations = []
+    for name in os.listdir(dirname):
+        version, sep, _ = name.partition('_')
+        if sep and version.isdigit() and name.endswith('.sql'):
+            migrations.append((int(version), os.path.join(dirname, name)))
+    migrations.sort()
+    versions = [v for v, _ in migrations]
+    if len(set(versions)) != len(versions):
+        raise DBException("several migrations for the same version in %s : %s" % (dirname, versions))
+    return migrations
+
+
+def join_graph(tables: dict) -> dict:
+    # undirected graph of the links between tables : table -> [(neighbour table, link)], a link being (table, linked table, field)
+    graph = {name: [] for name in tables}
+    for td in tables.values():
+        for t, f in td.links:
+            graph[td.name].append((t, (td.name, t, f)))
+            graph[t].append((td.name, (td.name, t, f)))
+    for name in graph:
+        graph[name].sort()
+    return graph
+
+
+def shortest_join_paths(graph: dict, from_table: str, excluded: typing.Collection = ()) -> dict:
+    # breadth first search from from_table : return, for each reachable table, the list of links from from_table to that table
+    paths = {from_table: []}
+    queue = deque([from_table])
+    while len(queue) > 0:
+        t = queue.popleft()
+        for n, link in graph[t]:
+            if n not in paths and n not in excluded:
+                paths[n] = paths[t] + [link]
+                queue.append(n)
+    del paths[from_table]
+    return paths
+
+
+# the shortest join paths between all the tables, computed once: (from table, to table) -> list of links
+JOIN_GRAPH = join_graph(TABLES)
+JOIN_PATHS = {(f, t): path for f in TABLES for t, path in shortest_join_paths(JOIN_GRAPH, f).items()}
+
 GET_IMAGE = '''SELECT * FROM images where imageID = ?'''
 
 MASTER_QUERY = '''SELECT name FROM sqlite_master WHERE type='table' ORDER BY name;'''
 
+
+def sql_iou(a: str, b: str) -> str:
+    # SQL expression of the intersection over union of the boxes (x, y, width, height) of the tables aliased a and b
+    inter = "(MAX(0, MIN({a}.x + {a}.width, {b}.x + {b}.width) - MAX({a}.x, {b}.x)) * " \
+            "MAX(0, MIN({a}.y + {a}.height, {b}.y + {b}.height) - MAX({a}.y, {b}.y)))".format(a=a, b=b)
+    union = "({a}.width * {a}.height + {b}.width * {b}.height - {inter})".format(a=a, b=b, inter=inter)
+    return "CASE WHEN {union} > 0 THEN CAST({inter} AS REAL) / {union} ELSE 0 END".format(inter=inter, union=union)
+
+
+# diff of the predictions of 2 runs, page by page (see PersistMandlagore.diff_predictions)
+# the boxes of :run that no box of :other overlaps with an IoU of at least :iou
+PREDICTIONS_UNMATCHED = """SELECT p.imageID, p.x, p.y, p.width, p.height, p.score FROM predictions p
+ WHERE p.runID = :run AND NOT EXISTS (SELECT 1 FROM predictions o WHERE o.runID = :other AND o.imageID = p.imageID AND %s >= :iou)
+ ORDER BY p.imageID, p.x, p.y""" % sql_iou('p', 'o')
+# the pairs of boxes of :old and :new that overlap with an IoU of at least :iou, matched one to one : a pair is kept when each box is the
+# best match of the other (ties broken by position). The boxes that are in both runs are not matched. Window functions need SQLite 3.25
+PREDICTIONS_MOVED = """WITH pairs AS (
+ SELECT o.imageID, o.x AS ox, o.y AS oy, o.width AS owidth, o.height AS oheight, n.x AS nx, n.y AS ny, n.width AS nwidth, n.height AS nheight, %s AS iou
+ FROM predictions o JOIN predictions n ON n.runID = :new AND n.imageID = o.imageID
+ WHERE o.runID = :old
+  AND NOT EXISTS (SELECT 1 FROM predictions s WHERE s.runID = :new AND s.imageID = o.imageID AND s.x = o.x AND s.y = o.y AND s.width = o.width AND s.height = o.height)
+  AND NOT EXISTS (SELECT 1 FROM predictions s WHERE s.runID = :old AND s.imageID = n.imageID AND s.x = n.x AND s.y = n.y AND s.width = n.width AND s.height = n.height)),
+ranked AS (SELECT *,
+ ROW_NUMBER() OVER (PARTITION BY imageID, ox, oy, owidth, oheight ORDER BY iou DESC, nx, ny, nwidth, nheight) AS old_rank,
+ ROW_NUMBER() OVER (PARTITION BY imageID, nx, ny, nwidth, nheight ORDER BY iou DESC, ox, oy, owidth, oheight) AS new_rank
+ FROM pairs WHERE iou >= :iou)
+SELECT imageID, ox, oy, owidth, oheight, nx, ny, nwidth, nheight, iou FROM ranked WHERE old_rank = 1 AND new_rank = 1
+ ORDER BY imageID, ox, oy""" % sql_iou('o', 'n')
+
 IMAGES_OF_LOCALIZED_SCENES = "SELECT images.imageID from images JOIN scenes ON images.imageID = scenes.imageID WHERE scenes.width is not null LIMIT 10"
 
 
@@ -64,15 +154,46 @@ def keep_unique_items(s: typing.Sequence) -> list:
     return [x for x in s if x not in seen and not seen.add(x)]
 
 
+def iter_chunks(iterable: typing.Iterable, size: int) -> typing.Iterator[list]:
+    it = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(it, size))
+        if len(chunk) == 0:
+            return
+        yield chunk
+
+
 class DBException(Exception):
     pass
 
 
+def has_json1(conn: sqlite3.Connection) -> bool:
+    # True if SQLite is built with the JSON1 functions (json_each...)
+    try:
+        conn.execute("SELECT json('[]')")
+        return True
+    except sqlite3.OperationalError:
+        return False
+
+
 class SQLBuilder:
+    # lists of values longer than this are bound as one json array parameter, read with json_each:
+    # the statement does not depend on the length of the list
+    # without JSON1 (json_lists False, see has_json1), a long list is bound as IN (?, ...), its placeholders padded to a multiple of
+    # IN_LIST_MAX so that few statements are compiled - it must stay under SQLITE_MAX_VARIABLE_NUMBER
+    IN_LIST_MAX = 50
+    JSON_LIST = 'json'
+
     @staticmethod
     def is_quoted(v):
         return (v[0] == '"' and v[len(v) - 1] == '"') or (v[0] == "'" and v[len(v) - 1] == "'")
 
+    @staticmethod
+    def unquote(v):
+        if isinstance(v, str) and len(v) > 1 and SQLBuilder.is_quoted(v):
+            return v[1:-1]
+        return v
+
     @staticmethod
     def quote(v):
         if v is None:
@@ -102,10 +223,12 @@ class SQLBuilder:
         return ", ".join([f"{f} = {'?' if v is None else v}" for f, v in field_and_values.items()])
 
     @staticmethod
-    def build_select_query(fields: str, tablename: str, criterias: str = None, limit: int = None) -> str:
-        sql = f"SELECT {fields} FROM {tablename}"
+    def build_select_query(fields: str, tablename: str, criterias: str = None, limit: int = None, order_by: str = None, distinct: bool = False) -> str:
+        sql = f"SELECT {'DISTINCT ' if distinct else ''}{fields} FROM {tablename}"
         if criterias is not None and len(criterias) > 0:
             sql += f" WHERE {criterias}"
+        if order_by is not None:
+            sql += f" ORDER BY {order_by}"
         if limit is not None:
             sql += f" LIMIT {limit}"
         return sql
@@ -155,84 +278,32 @@ class SQLBuilder:
 
     @staticmethod
     def find_path(from_table: str, to_table: str, tables_viewed: [], maxl=1000) -> list:
-        # just explore the tree of possible until find a path
-        ft = TABLES[from_table]
-        tt = TABLES[to_table]
-
-        def find_direct_link(ltb, tb):
-            for t, f in ltb.links:
-                if t == tb.name:
-                    return [(ltb.name, t, f)], True
-            return [], False
-
-        def find_indirect_link(ltb, tb, unmwanted, append, maxl):
-            paths = []
-            for t, f in ltb.links:
-                if t not in unmwanted:
-                    path, found = SQLBuilder.find_path(t, tb.name, unmwanted + [ltb.name], maxl - 1)
-                    if found:
-                        if append:
-                            path += [(ltb.name, t, f)]
-                        else:
-                            path = [(ltb.name, t, f)] + path
-                        paths += [path]
-                        maxl = min(maxl, len(path))
-
-            for d in TABLES.values():
-                if d.name != ltb.name and d.name not in unmwanted:
-                    for t, f in d.links:
-                        if t == ltb.name:
-                            path, found = SQLBuilder.find_path(d.name, tb.name, unmwanted + [t], maxl - 1)
-                            if found:
-                                if append:
-                                    path += [(d.name, t, f)]
-                                else:
-                                    path = [(d.name, t, f)] + path
-                                paths += [path]
-                                maxl = min(maxl, len(path))
-
-            # return the smallest path
-            if len(paths) > 0:
-                return min(paths), True
-
+        # shortest list of links to join from_table and to_table, without going through the tables_viewed
+        # only a path longer than maxl links is rejected
+        if len(tables_viewed) == 0:
+            path = JOIN_PATHS.get((from_table, to_table))
+        else:
+            path = shortest_join_paths(JOIN_GRAPH, from_table, set(tables_viewed) - {from_table}).get(to_table)
+        if path is None or len(path) > maxl:
             return [], False
-
-        path, found = find_direct_link(ft, tt)
-        if found:
-            return path, True
-
-        path, found = find_direct_link(tt, ft)
-        if found:
-            return path, True
-
-        if maxl > 1:
-            paths = []
-            path, found = find_indirect_link(ft, tt, tables_viewed, False, maxl - 1)
-            if found:
-                paths += [path]
-                maxl = min(maxl, len(path))
-
-            path, found = find_indirect_link(tt, ft, tables_viewed, True, maxl - 1)
-            if found:
-                paths += [path]
-
-            # return the smallest path
-            if len(paths) > 0:
-                return min(paths), True
-
-        return [], False
+        return list(path), True
 
     @staticmethod
     def build_join(source_table: str, needed_tables: list):
         # return the "JOIN xx ON <fields> JOIN xx ON <fields> .. etc"
+        # the join only depends on the set of tables : it is computed once for each set
+        return SQLBuilder._build_join(source_table, tuple(sorted(set(needed_tables))))
+
+    @staticmethod
+    @functools.lru_cache(maxsize=256)
+    def _build_join(source_table: str, needed_tables: tuple):
         # compute the right fields, based on the primary keys (simplified)
         # we need to compute any missing link between the tables
         tb = TABLES[source_table]
 
         # find an order in the join and add the missing tables to ensure all links
         links = []
-        missing = set(needed_tables)
-        missing.discard(source_table)
+        missing = sorted(set(needed_tables) - {source_table})
         query = source_table
 
         if len(missing) == 0:
@@ -269,23 +340,19 @@ class SQLBuilder:
         return query
 
     @staticmethod
-    def build_field_criteria(table, field_filter, field_values) -> tuple:
+    def filter_fields(table, field_filter) -> (list, str):
+        # return the qualified fields and the operator of a filter
         td = TABLES[table]
         parts = field_filter.split(":")
         fieldname = parts[0]
         operator = '='
         if fieldname == "ID":
             fields = td.keys
-            values = SQLBuilder.quote(field_values)
-            if len(fields) == 1:
-                values = (values, )
         elif fieldname == "localized":
             fields = ['width', 'height']
-            values = ['not null'] * 2
             operator = 'is'
         else:
             fields = (fieldname, )
-            values = (SQLBuilder.quote(field_values), )
 
         if len(parts) > 1:
             if parts[1] == "like":
@@ -293,10 +360,58 @@ class SQLBuilder:
             elif parts[1] == "list":
                 operator = 'in'
 
-        return tuple(zip([td.qualify(f) for f in fields], [operator] * len(fields), values))
+        return [td.qualify(f) for f in fields], operator
 
     @staticmethod
-    def build_filtered_query(table, fields, filters, limit=None, qualify_fields=True):
+    def value_shape(v, json_lists: bool = True):
+        # None for a single value, the number of values of a short list, or JSON_LIST for a long list
+        # (without JSON1, the number of placeholders of a long list, a multiple of IN_LIST_MAX)
+        if isinstance(v, str) or not isinstance(v, typing.Sequence):
+            return None
+        if len(v) <= SQLBuilder.IN_LIST_MAX:
+            return len(v)
+        if json_lists:
+            return SQLBuilder.JSON_LIST
+        return -(-len(v) // SQLBuilder.IN_LIST_MAX) * SQLBuilder.IN_LIST_MAX
+
+    @staticmethod
+    def placeholder(shape) -> str:
+        if shape is None:
+            return '?'
+        if shape == SQLBuilder.JSON_LIST:
+            return "(SELECT value FROM json_each(?))"
+        return "( " + ", ".join("?" * shape) + " )"
+
+    @staticmethod
+    def parameters(v, shape) -> list:
+        if shape is None:
+            return [SQLBuilder.unquote(v)]
+        if shape == SQLBuilder.JSON_LIST:
+            return [json.dumps([SQLBuilder.unquote(x) for x in v])]
+        # the placeholders of a long list are padded with its last value
+        return [SQLBuilder.unquote(x) for x in v] + [SQLBuilder.unquote(v[-1])] * (shape - len(v))
+
+    @staticmethod
+    def build_field_parameters(table, field_filter, field_values, json_lists: bool = True) -> (tuple, list):
+        # return the shape of the value of each field (see value_shape) and the parameters to bind for a filter
+        if field_filter.split(":")[0] == "localized":
+            return (), []
+        fields, _ = SQLBuilder.filter_fields(table, field_filter)
+        values = (field_values, ) if len(fields) == 1 else field_values
+        shapes = tuple(SQLBuilder.value_shape(v, json_lists) for v in values)
+        return shapes, [p for v, shape in zip(values, shapes) for p in SQLBuilder.parameters(v, shape)]
+
+    @staticmethod
+    def build_field_criteria(table, field_filter, shapes) -> tuple:
+        # return the criterias of a filter, with a placeholder for each parameter
+        fields, operator = SQLBuilder.filter_fields(table, field_filter)
+        if field_filter.split(":")[0] == "localized":
+            return tuple((f, operator, 'not null') for f in fields)
+        return tuple(zip(fields, [operator] * len(fields), [SQLBuilder.placeholder(shape) for shape in shapes]))
+
+    @staticmethod
+    def build_filtered_query(table, fields, filters, limit=None, qualify_fields=True, extra_criterias=(), order_by=None, distinct=False,
+                             json_lists=True) -> (str, list):
         # Build a QUEY that retreive imagesIDs that match corresponding filters
         # filters : a triplet (table, field-like, value) where:
         #  - table is in one of the tables names
@@ -304,25 +419,41 @@ class SQLBuilder:
         #  - value is either a direct value (string), a like value (string), or tuple of values (for -list)
         # all filters are AND-ed
         # limit, if defined, provide the number of elements to return
+        # extra_criterias are SQL expressions AND-ed with the filters
+        # order_by and distinct are applied as is to the SELECT
+        # json_lists : long lists are bound as json arrays (SQLite has JSON1, see has_json1)
+        # return the query and its parameters (those of the filters, then the ones of the extra_criterias need to be appended)
+        # the query only depends on the shape of the filters, not on their values : it is computed once for each shape
 
         # "SELECT images.imageID from images JOIN scenes ON images.imageID = scenes.imageID WHERE scenes.width is not null LIMIT 10"
+        shape = []
+        params = []
+        for (t, f, v) in filters:
+            shapes, p = SQLBuilder.build_field_parameters(t, f, v, json_lists)
+            shape.append((t, f, shapes))
+            params.extend(p)
+
+        query = SQLBuilder._compile_filtered_query(table, tuple(fields), tuple(shape), limit, qualify_fields, tuple(extra_criterias), order_by, distinct)
+        return query, params
+
+    @staticmethod
+    @functools.lru_cache(maxsize=256)
+    def _compile_filtered_query(table, fields, shape, limit, qualify_fields, extra_criterias, order_by, distinct) -> str:
         tb = TABLES[table]
 
         criterias = []
-        for (t, f, v) in filters:
-            criterias.extend(SQLBuilder.build_field_criteria(t, f, v))
+        for (t, f, shapes) in shape:
+            criterias.extend(SQLBuilder.build_field_criteria(t, f, shapes))
 
-        tables = SQLBuilder.build_join(table, [f[0] for f in filters])
+        tables = SQLBuilder.build_join(table, [f[0] for f in shape])
         fieldclause = ""
         if qualify_fields:
             fieldclause = ", ".join(tb.qualify(f) for f in fields)
         else:
             fieldclause = ", ".join(f for f in fields)
-        whereclause = SQLBuilder.build_where_clause(criterias)
-
-        query = SQLBuilder.build_select_query(fieldclause, tables, whereclause, limit)
+        whereclause = " AND ".join([c for c in [SQLBuilder.build_where_clause(criterias)] + list(extra_criterias) if len(c) > 0])
 
-        return query
+        return SQLBuilder.build_select_query(fieldclause, tables, whereclause, limit, order_by, distinct)
 
 
 class DBOperationHelper:
@@ -330,6 +461,14 @@ class DBOperationHelper:
     MULTI_RECORD = 'multi-records'
     SINGLE_RECORD = 'single-record'
 
+    # one table fed from an imported file: fieldlist is the list of the columns given to insertQuery
+    ImportTarget = namedtuple('ImportTarget', ['tablename', 'insertQuery', 'fieldlist', 'distinct'])
+
+    # number of rows sent to one executemany during bulk imports
+    IMPORT_CHUNK_SIZE = 5000
+    # PRAGMAs set during bulk imports - a crash in the middle of an import requires to import again anyway
+    IMPORT_PRAGMAS = {'journal_mode': 'MEMORY', 'synchronous': 'OFF'}
+
     def __init__(self, conn):
         self.conn = conn
 
@@ -339,60 +478,245 @@ class DBOperationHelper:
         content = ""
         with open(schema_filename, 'r') as content_file:
             content = content_file.read()
-        self.conn.executescript(content)
+        try:
+            self.conn.executescript(content)
+        except Exception:
+            # the script is one transaction : nothing is changed if it fails
+            if self.conn.in_transaction:
+                self.conn.rollback()
+            raise
+
+    def run_migration(self, migration_filename, version):
+        # run the migration script and set the schema version in the same transaction : either both are done, or none
+        with open(migration_filename, 'r') as content_file:
+            content = content_file.read()
+        self.conn.commit()
+        try:
+            self.conn.executescript("BEGIN;\n%s\nUPDATE config SET version = %d;\nCOMMIT;" % (content, version))
+        except Exception:
+            if self.conn.in_transaction:
+                self.conn.rollback()
+            raise
+
+    @contextmanager
+    def bulk_load(self, tablenames: typing.Sequence = ()):
+        # run a whole load in one transaction, with the import PRAGMAs set and the secondary indexes of the loaded tables dropped
+        # indexes are rebuilt and previous PRAGMAs restored once the load is done
+        self.conn.commit()
+        previous = {p: self.conn.execute(f"PRAGMA {p}").fetchone()[0] for p in self.IMPORT_PRAGMAS}
+        if str(previous.get('journal_mode')).lower() == 'wal':
+            # leaving WAL would need all the other connections to be closed - synchronous OFF is enough in WAL mode
+            del previous['journal_mode']
+        for p in previous:
+            self.conn.execute(f"PRAGMA {p} = {self.IMPORT_PRAGMAS[p]}")
+        try:
+            self.conn.execute("BEGIN")
+            indexes = self._secondary_indexes(tablenames)
+            for name, _ in indexes:
+                self.conn.execute(f'DROP INDEX IF EXISTS "{name}"')
+            yield
+            for _, sql in indexes:
+                self.conn.execute(sql)
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+        finally:
+            for p, v in previous.items():
+                self.conn.execute(f"PRAGMA {p} = {v}")
+
+    def _secondary_indexes(self, tablenames: typing.Sequence) -> [(str, str)]:
+        # unique indexes are kept during the load: the REPLACE statements rely on them
+        if len(tablenames) == 0:
+            return []
+        query = "SELECT name, sql FROM sqlite_master WHERE type = 'index' AND sql IS NOT NULL AND tbl_name IN (%s)" % ",".join("?" * len(tablenames))
+        return [(name, sql) for name, sql in self.conn.execute(query, list(tablenames)) if not sql.upper().startswith("CREATE UNIQUE")]
+
+    def _execute_chunk(self, cur, filename, insertQuery, chunk: list, warnings: list) -> int:
+        # a chunk that fails is replayed row by row, so each invalid line is still reported
+        cur.execute("SAVEPOINT bulk_chunk")
+        imported = 0
+        try:
+            cur.executemany(insertQuery, chunk)
+            imported = len(chunk)
+        except Exception:
+            cur.execute("ROLLBACK TO bulk_chunk")
+            for data in chunk:
+                try:
+                    cur.execute(insertQuery, data)
+                    imported += 1
+                except Exception as e:
+                    warnings.append("%s : the line (%s) could not be imported : %s" % (filename, ",".join(data), str(e)))
+        cur.execute("RELEASE bulk_chunk")
+        return imported
+
+    def _bulk_execute(self, filename, insertQuery, rows: typing.Iterable) -> (int, []):
+        # rows are sent by chunks to executemany
+        imported = 0
+        warnings = []
+        cur = self.conn.cursor()
+        for chunk in iter_chunks(rows, self.IMPORT_CHUNK_SIZE):
+            imported += self._execute_chunk(cur, filename, insertQuery, chunk, warnings)
+        return imported, warnings
+
+    @staticmethod
+    def _report(lines: int, start: float) -> str:
+        elapsed = time.perf_counter() - start
+        return "%d lines imported (%d rows/s)" % (lines, lines / elapsed if elapsed > 0 else 0)
 
-    def import_csv_file(self, filename, insertQuery, fieldlist, rowTranslater=None) -> (str, []):
+    def import_csv_file(self, filename, insertQuery, fieldlist, rowTranslater=None, tablename=None) -> (str, []):
         # sql = INSERT INTO table(field, field, ...) VALUES(?,?, ...)
         # fieldlist is an ordered set of the numbers of fields to be taken from file to the query - 0 is first index
-        # TODO manage exceptions
+        # tablename, if provided, is the table loaded : its secondary indexes are rebuilt after the load
 
-        lines = 0
-        warnings = []
-        with open(filename, newline='', encoding='utf-8') as csvfile:
-            csvreader = csv.reader(csvfile, delimiter='\t', quotechar='"')
-            cur = self.conn.cursor()
+        def rows(csvreader):
             for row in csvreader:
                 frow, skip = rowTranslater(row) if rowTranslater is not None else (row, False)
                 if not skip:
-                    data = frow if fieldlist is None else [frow[x] for x in fieldlist]
-                    try:
-                        cur.execute(insertQuery, data)
-                        lines += 1
-                    except Exception as e:
-                        warnings.append("%s : the line (%s) could not be imported : %s" % (filename, ",".join(data), str(e)))
-        self.conn.commit()
-        return "%d lines imported" % lines, warnings
+                    yield frow if fieldlist is None else [frow[x] for x in fieldlist]
 
-    def import_csv_mode_file(self, filename, insertQuery, encoding, delim, mode, fieldlist, rowTranslater=None) -> (str, []):
+        start = time.perf_counter()
+        with open(filename, newline='', encoding='utf-8') as csvfile, self.bulk_load([tablename] if tablename is not None else []):
+            csvreader = csv.reader(csvfile, delimiter='\t', quotechar='"')
+            lines, warnings = self._bulk_execute(filename, insertQuery, rows(csvreader))
+        return self._report(lines, start), warnings
+
+    def import_csv_mode_file(self, filename, insertQuery, encoding, delim, mode, fieldlist, rowTranslater=None, tablename=None) -> (str, []):
         # sql = INSERT INTO table(field, field, ...) VALUES(?,?, ...)
         # fieldlist is an ordered set of the numbers of fields to be taken from file to the query - 0 is first index
-        # TODO manage exceptions
+        # tablename, if provided, is the table loaded : its secondary indexes are rebuilt after the load
+        target = DBOperationHelper.ImportTarget(tablename, insertQuery, fieldlist, False)
+        _, report, warnings = self.import_csv_mode_file_to_tables(filename, encoding, delim, mode, [target], rowTranslater)[0]
+        return report, warnings
+
+    def import_csv_mode_file_to_tables(self, filename, encoding, delim, mode, targets: typing.Sequence, rowTranslater=None) -> [(str, str, [])]:
+        # read the file once and fan out each row to all the targets (see ImportTarget)
+        # each target keeps its own chunk of rows. If distinct is set, a row already sent to that target is not sent again.
+        # return, for each target, the tablename, the report and the warnings
 
         lines = 0
-        warnings = []
-        with open(filename, newline='', encoding=encoding) as csvfile:
+        imported = [0] * len(targets)
+        warnings = [[] for _ in targets]
+        chunks = [[] for _ in targets]
+        seen = [set() if t.distinct else None for t in targets]
+        tablenames = keep_unique_items([t.tablename for t in targets if t.tablename is not None])
+
+        start = time.perf_counter()
+        with open(filename, newline='', encoding=encoding) as csvfile, self.bulk_load(tablenames):
             csvreader = csv.reader(csvfile, delimiter=delim)
             cur = self.conn.cursor()
             for line in csvreader:
-                rows = [[line[0], x] for x in line[1:]] if mode == DBOperationHelper.MULTI_RECORD else [line]
-                for row in rows:
+                records = [[line[0], x] for x in line[1:]] if mode == DBOperationHelper.MULTI_RECORD else [line]
+                for row in records:
                     frow, skip = rowTranslater(row) if rowTranslater is not None else (row, False)
-                    if not skip:
-                        data = frow if fieldlist is None else [frow[x] for x in fieldlist]
-                        try:
-                            cur.execute(insertQuery, data)
-                        except Exception as e:
-                            warnings.append("%s : the line (%s) could not be imported : %s" % (filename, ",".join(data), str(e)))
+                    if skip:
+                        continue
+                    for i, t in enumerate(targets):
+                        data = frow if t.fieldlist is None else [frow[x] for x in t.fieldlist]
+                        if seen[i] is not None:
+                            key = tuple(data)
+                            if key in seen[i]:
+                                continue
+                            seen[i].add(key)
+                        chunks[i].append(data)
+                        if len(chunks[i]) >= self.IMPORT_CHUNK_SIZE:
+                            imported[i] += self._execute_chunk(cur, filename, t.insertQuery, chunks[i], warnings[i])
+                            chunks[i] = []
                 lines += 1
 
-        self.conn.commit()
-        return "%d lines imported" % lines, warnings
+            for i, t in enumerate(targets):
+                if len(chunks[i]) > 0:
+                    imported[i] += self._execute_chunk(cur, filename, t.insertQuery, chunks[i], warnings[i])
+
+        report = self._report(lines, start)
+        return [(t.tablename, report if len(targets) == 1 else "%s - %d rows into %s" % (report, n, t.tablename), w)
+                for t, n, w in zip(targets, imported, warnings)]
+
+
+class ConnectionFactory(object):
+    # open connections on one SQLite DB file, all tuned with the same PRAGMAs
+    # WAL journal : readers do not block the writer, and the writer does not block readers. Its commits are also cheaper (synchronous NORMAL)
+    PRAGMAS = {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'mmap_size': 256 * 1024 * 1024,
+        'cache_size': -64 * 1024,  # negative : in KiB
+        'busy_timeout': 10000,  # ms
+    }
+    CACHED_STATEMENTS = 256
+
+    def __init__(self, filename: str, pragmas: dict = None):
+        super().__init__()
+        self.filename = filename
+        self.pragmas = dict(self.PRAGMAS) if pragmas is None else pragmas
+
+    def connect(self, read_only: bool = False) -> sqlite3.Connection:
+        # a read only connection can be used by any thread, one thread at a time (see ReadersPool)
+        conn = sqlite3.connect(self.filename,
+                               timeout=self.pragmas.get('busy_timeout', 5000) / 1000,
+                               cached_statements=self.CACHED_STATEMENTS,
+                               check_same_thread=not read_only)
+        for p, v in self.pragmas.items():
+            if not (read_only and p == 'journal_mode'):
+                conn.execute(f"PRAGMA {p} = {v}")
+        if read_only:
+            conn.execute("PRAGMA query_only = ON")
+        return conn
+
+
+class ReadersPool(object):
+    # small pool of read only connections : a thread borrows one connection for the time of a read (see PersistMandlagore.reader)
+    def __init__(self, factory: ConnectionFactory, size: int):
+        super().__init__()
+        self._factory = factory
+        self._slots = threading.BoundedSemaphore(size)
+        self._idle = queue.LifoQueue()
+        self._all = []
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def connection(self) -> sqlite3.Connection:
+        with self._slots:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                conn = self._factory.connect(read_only=True)
+                with self._lock:
+                    self._all.append(conn)
+            try:
+                yield conn
+            finally:
+                if conn.in_transaction:
+                    conn.rollback()
+                self._idle.put(conn)
+
+    def close(self):
+        with self._lock:
+            for conn in self._all:
+                conn.close()
+            self._all = []
+        self._idle = queue.LifoQueue()
 
 
 class PersistMandlagore(object):
+    # SQLite default limit on the number of parameters of one statement is 999
+    MAX_QUERY_PARAMETERS = 500
+    # number of rows read by each query when streaming images
+    ARRAYSIZE = 1000
+    # number of read only connections that can be used at the same time (by different threads)
+    READERS = 4
+    # number of predictions written by one executemany, in one transaction
+    PREDICTIONS_BATCH = 10000
+    COUNT_EXACT = 'exact'
+    COUNT_ESTIMATE = 'estimate'
+
     def __init__(self, filename=None):
         self.version = None
         self.conn = None
+        self._readers = None
+        self._batch = None
+        # SQLite has JSON1 : long lists of values are bound as json arrays (see SQLBuilder)
+        self.json_lists = True
         if filename is not None:
             self.connect(filename)
 
@@ -403,66 +727,257 @@ class PersistMandlagore(object):
         self._ensure_disconnect()
 
     def _ensure_disconnect(self):
+        if self._readers is not None:
+            self._readers.close()
+            self._readers = None
         if self.conn is not None:
             self.conn.close()
             self.conn = None
 
     def connect(self, filename):
-        """ create a database connection to a SQLite database """
+        """ create a database connection to a SQLite database - the connection used by all the methods, and to write """
         self._ensure_disconnect()
         try:
-            self.conn = sqlite3.connect(filename)
-            print(sqlite3.version)
+            factory = ConnectionFactory(filename)
+            self.conn = factory.connect()
+            self.json_lists = has_json1(self.conn)
+            self._readers = ReadersPool(factory, self.READERS)
         except Error as e:
             print(e)
             raise e
 
+    def reader(self):
+        # context manager giving a read only connection, that can be used from any thread while the main connection is writing
+        # (the DB must be a file: WAL does not apply to in-memory DBs)
+        return self._readers.connection()
+
+    def _read(self, query: str, params=()) -> list:
+        # rows of a query run on a read only connection : it only sees the data committed, and is not blocked by a batch running
+        with self.reader() as conn:
+            return conn.execute(query, params).fetchall()
+
+    @contextmanager
+    def batch(self, max_operations: int = None, max_seconds: float = None):
+        # unit of work : the writes of the mutators called within the batch are committed together, at the end of the batch
+        # - without threshold, the batch is atomic : it is rolled back if an exception is raised
+        # - with max_operations and/or max_seconds, a commit happens each time a threshold is reached, and what has been written
+        #   is committed at the end of the batch even if an exception is raised
+        # a batch started within another batch is part of the outer one
+        if self._batch is not None:
+            yield self
+            return
+
+        atomic = max_operations is None and max_seconds is None
+        self._batch = {'max_operations': max_operations, 'max_seconds': max_seconds, 'operations': 0, 'start': time.monotonic()}
+        try:
+            yield self
+            self.conn.commit()
+        except BaseException:
+            if atomic:
+                self.conn.rollback()
+            else:
+                self.conn.commit()
+            raise
+        finally:
+            self._batch = None
+
+    def _commit(self):
+        # commit the writes of a mutator, unless a batch is running : the batch commits when a threshold is reached
+        b = self._batch
+        if b is None:
+            self.conn.commit()
+            return
+        b['operations'] += 1
+        if (b['max_operations'] is not None and b['operations'] >= b['max_operations']) or \
+                (b['max_seconds'] is not None and time.monotonic() - b['start'] >= b['max_seconds']):
+            self.conn.commit()
+            b['operations'], b['start'] = 0, time.monotonic()
+
     def ensure_schema(self, rebuilt: bool) -> str:
         # check the version of current schema
-        # if not existent, then create tables using SQL schema file
+        # if not existent (or rebuilt), then create tables using SQL schema file
+        # if older than SCHEMA_VERSION, migrate it in place (the data are kept)
+        # an up to date DB costs only the read of its version
 
         if rebuilt or self.schema_version() is None:
-            persistence_dir = os.path.dirname(os.path.realpath(__file__))
-            schema_filename = os.path.join(persistence_dir, "mandlagore.db.schema.sql")
+            schema_filename = os.path.join(os.path.dirname(os.path.realpath(__file__)), "mandlagore.db.schema.sql")
             self.version = None
             DBOperationHelper(self.conn).create_schema(schema_filename)
+        elif self.schema_version() < SCHEMA_VERSION:
+            self.migrate()
 
         return self.schema_version()
 
+    def migrate(self, target=SCHEMA_VERSION, dirname=MIGRATIONS_DIR) -> [int]:
+        # apply in order the migrations above the current version, up to target - each one in its own transaction
+        # a migration that fails is rolled back and stops the upgrade : the DB stays at the version of the last one applied
+        # return the versions applied
+        current = self.schema_version()
+        if current is None:
+            raise DBException("no schema version found in the DB - it must be created with ensure_schema")
+        applied = []
+        helper = DBOperationHelper(self.conn)
+        for version, filename in list_migrations(dirname):
+            if current < version <= target:
+                self.version = None
+                helper.run_migration(filename, version)
+                applied.append(version)
+        self.version = None
+        if self.schema_version() < target:
+            raise DBException("DB stays in version %d, no migration found up to version %d in %s" % (self.schema_version(), target, dirname))
+        return applied
+
     def delete_mandragore_related(self, mandragore_ids):
         q, d = TABLES['scenes'].delete_query_one_parameter('mandragoreID', mandragore_ids)
         self.conn.executemany(q, d)
         q, d = TABLES['descriptors'].delete_query_one_parameter('mandragoreID', mandragore_ids)
         self.conn.executemany(q, d)
-        self.conn.commit()
+        self._commit()
 
     def ensure_images(self, images_id_url_w_h: [dict]):
         # images_id_url_w_h is a list of dict(). Each dict has the names of fields as keys
         q, p = TABLES['images'].insert_or_update_query_full_parameters(images_id_url_w_h)
         self.conn.executemany(q, p)
-        self.conn.commit()
+        self._commit()
 
     def update_images(self, images_id_w_h: [dict]):
         # images_id_url_w_h is a list of dict(). Each dict has the names of fields as keys
         q, p = TABLES['images'].update_query_full_parameters(images_id_w_h)
         self.conn.executemany(q, p)
-        self.conn.commit()
+        self._commit()
 
     def add_scenes(self, scenes: [dict]):
         q, p = TABLES['scenes'].insert_or_update_query_full_parameters(scenes)
         self.conn.executemany(q, p)
-        self.conn.commit()
+        self._commit()
 
     def add_descriptors(self, descriptors):
         q, p = TABLES['descriptors'].insert_or_update_query_full_parameters(descriptors)
         self.conn.executemany(q, p)
-        self.conn.commit()
+        self._commit()
 
     def retrieve_image(self, imageID):
         query, data = TABLES['images'].get_query_on_keys([imageID])
         return TABLES['images'].named_data(self.conn.execute(query, data[0]).fetchone())
 
-    def retrieve_images(self, fields, filters, limit=None):
+    def retrieve_images_by_ids(self, image_ids) -> dict:
+        # return imageID -> image (as named data) for all the images of image_ids that are in DB
+        td = TABLES['images']
+        images = {}
+        for chunk in iter_chunks(keep_unique_items(image_ids), self.MAX_QUERY_PARAMETERS):
+            criteria = "%s IN (%s)" % (td.qualify('imageID'), ",".join("?" * len(chunk)))
+            for r in self._read(SQLBuilder.build_select_query("*", td.name, criteria), chunk):
+                images[r[0]] = td.named_data(r)
+        return images
+
+    def add_image_files(self, image_files: [dict]):
+        q, p = TABLES['image_files'].insert_or_update_query_full_parameters(image_files)
+        self.conn.executemany(q, p)
+        self._commit()
+
+    def retrieve_image_files(self, imageID) -> list:
+        # files recorded for the whole image (not the crops), as named data
+        td = TABLES['image_files']
+        criteria = "%s = ? AND region IS NULL" % td.qualify('imageID')
+        return [td.named_data(r) for r in self.conn.execute(SQLBuilder.build_select_query(",".join(td.all_fields), td.name, criteria), (imageID, ))]
+
+    def retrieve_scene_zones(self, image_ids) -> dict:
+        # return imageID -> [(x, y, width, height)] of the scenes located in each image of image_ids
+        td = TABLES['scenes']
+        zones = {}
+        for chunk in iter_chunks(keep_unique_items(image_ids), self.MAX_QUERY_PARAMETERS):
+            criteria = "%s IN (%s) AND x IS NOT NULL AND y IS NOT NULL AND width IS NOT NULL AND height IS NOT NULL" % (td.qualify('imageID'), ",".join("?" * len(chunk)))
+            for r in self._read(SQLBuilder.build_select_query("imageID, x, y, width, height", td.name, criteria), chunk):
+                zones.setdefault(r[0], []).append(r[1:])
+        return zones
+
+    def add_prediction_run(self, runID: str, params: dict = None):
+        # record a run of the prediction - the predictions of a previous run with the same runID are deleted
+        self.conn.execute("DELETE FROM predictions WHERE runID = ?", (runID, ))
+        q, p = TABLES['prediction_runs'].insert_or_update_query_full_parameters([{
+            'runID': runID,
+            'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'params': json.dumps(params) if params is not None else None
+        }])
+        self.conn.executemany(q, p)
+        self._commit()
+
+    def add_predictions(self, runID: str, predictions: typing.Iterable) -> int:
+        # predictions : iterable of (imageID, x, y, width, height, score), streamed by batches of PREDICTIONS_BATCH rows,
+        # each batch being one executemany in one transaction - return the number of predictions written
+        q = SQLBuilder.build_insert_into_query_with_parameters('predictions', TABLES['predictions'].all_fields)
+        count = 0
+        for chunk in iter_chunks(predictions, self.PREDICTIONS_BATCH):
+            self.conn.executemany(q, ((runID, ) + tuple(r) for r in chunk))
+            self._commit()
+            count += len(chunk)
+        return count
+
+    def retrieve_prediction_runs(self) -> list:
+        td = TABLES['prediction_runs']
+        return [td.named_data(r) for r in self.conn.execute(SQLBuilder.build_select_query(",".join(td.all_fields), td.name, order_by='created, runID'))]
+
+    def diff_predictions(self, old_run: str, new_run: str, iou: float = 0.5) -> dict:
+        # compare the predictions of 2 runs, page by page, in the DB:
+        # - added : the boxes of new_run that match no box of old_run (IoU >= iou), as (imageID, x, y, width, height, score)
+        # - removed : the boxes of old_run that match no box of new_run
+        # - moved : the pairs of boxes matching one to one, among the boxes that are not in both runs,
+        #   as (imageID, old x, y, width, height, new x, y, width, height, IoU) - a box added or removed is never moved
+        return {
+            'added': self.conn.execute(PREDICTIONS_UNMATCHED, {'run': new_run, 'other': old_run, 'iou': iou}).fetchall(),
+            'removed': self.conn.execute(PREDICTIONS_UNMATCHED, {'run': old_run, 'other': new_run, 'iou': iou}).fetchall(),
+            'moved': self.conn.execute(PREDICTIONS_MOVED, {'old': old_run, 'new': new_run, 'iou': iou}).fetchall(),
+        }
+
+    @staticmethod
+    def _images_extra_criterias(missing_zoom) -> (list, list):
+        if missing_zoom is None:
+            return [], []
+        return ["NOT EXISTS (SELECT 1 FROM image_files WHERE image_files.imageID = images.imageID AND image_files.zoom = ? AND image_files.region IS NULL)"], [missing_zoom]
+
+    def iter_images(self, fields, filters, limit=None, missing_zoom=None, arraysize=None) -> typing.Iterator[tuple]:
+        # stream the images that match the filters (see retrieve_images), ordered by imageID - each image is returned once
+        # rows are read by pages of arraysize rows, each page being a query that starts after the last imageID read (keyset pagination):
+        # no cursor is kept open between pages, and the first rows are available without running the whole query
+        arraysize = self.ARRAYSIZE if arraysize is None else arraysize
+        td = TABLES['images']
+        fields = list(fields)
+        key_added = 'imageID' not in fields
+        if key_added:
+            fields.append('imageID')
+        key = fields.index('imageID')
+        extra, extra_params = self._images_extra_criterias(missing_zoom)
+
+        last = None
+        remaining = limit
+        while remaining is None or remaining > 0:
+            page = arraysize if remaining is None else min(arraysize, remaining)
+            criterias = extra if last is None else extra + ["%s > ?" % td.qualify('imageID')]
+            query, params = SQLBuilder.build_filtered_query(td.name, fields, filters, page, extra_criterias=criterias, order_by=td.qualify('imageID'), distinct=True,
+                                                            json_lists=self.json_lists)
+            rows = self._read(query, params + extra_params + ([] if last is None else [last]))
+            for r in rows:
+                yield r[:-1] if key_added else r
+            if len(rows) < page:
+                break
+            last = rows[-1][key]
+            if remaining is not None:
+                remaining -= len(rows)
+
+    def count_images(self, filters, limit=None, missing_zoom=None, estimate=False) -> int:
+        # number of images that match the filters (see retrieve_images)
+        # estimate : only the filters on the table images are applied (no join, no check of image_files) - cheap, but an upper bound
+        td = TABLES['images']
+        if estimate:
+            filters = [f for f in filters if f[0] == td.name]
+            missing_zoom = None
+        extra, extra_params = self._images_extra_criterias(missing_zoom)
+        query, params = SQLBuilder.build_filtered_query(td.name, ("COUNT(DISTINCT %s)" % td.qualify('imageID'), ), filters, qualify_fields=False, extra_criterias=extra,
+                                                        json_lists=self.json_lists)
+        total = self._read(query, params + extra_params)[0][0]
+        return total if limit is None else min(total, limit)
+
+    def retrieve_images(self, fields, filters, limit=None, missing_zoom=None, count=COUNT_EXACT, arraysize=None):
         # Build a QUEY that retreive imagesIDs that match corresponding filters
         # filters : a triplet (table, field-like, value) where:
         #  - table is in 'images', 'scenes', 'descriptors'
@@ -470,19 +985,31 @@ class PersistMandlagore(object):
         #  - value is either a direct value (string), a like value (string), or tuple of values (for -list)
         #
         # limit, if defined, provide the number of elements to return
+        # missing_zoom, if defined, keep only the images that have no file recorded in image_files at this zoom
+        # count : COUNT_EXACT, COUNT_ESTIMATE or None (no count) - see count_images
+        # arraysize : number of rows read by each query of the stream (default is ARRAYSIZE)
+        # return a stream of rows (see iter_images) and the count
 
         # "SELECT images.imageID from images JOIN scenes ON images.imageID = scenes.imageID WHERE scenes.width is not null LIMIT 10"
 
-        td = TABLES['images']
-        query = SQLBuilder.build_filtered_query(td.name, fields, filters, limit)
-        queryCount = SQLBuilder.build_filtered_query(td.name, ("COUNT(*)", ), filters, qualify_fields=False)
-        total = self.conn.execute(queryCount).fetchone()[0]
-        if limit is not None:
-            total = min(total, limit)
-        return self.conn.execute(query), total
+        total = None
+        if count is not None:
+            total = self.count_images(filters, limit, missing_zoom, count == self.COUNT_ESTIMATE)
+        return self.iter_images(fields, filters, limit, missing_zoom, arraysize), total
+
+    def read_table(self, tablename, fields, order_by=None) -> list:
+        # all the rows of a table, as tuples of the fields - for the tools that load a whole table at once
+        query = SQLBuilder.build_select_query(",".join(fields), TABLES[tablename].name, order_by=order_by)
+        cursor = self.conn.execute(query)
+        cursor.arraysize = self.ARRAYSIZE
+        return cursor.fetchall()
+
+    def has_table(self, tablename) -> bool:
+        return self.conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (tablename, )).fetchone() is not None
 
     def schema_version(self):
-        if self.version is None:
+        # None if there is no schema yet
+        if self.version is None and self.has_table('config'):
             for r in self.conn.execute("SELECT version FROM config"):
                 self.version = r[0]
         return self.version
@@ -0,0 +1,97 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+
+
+class IIIFInfoCache(object):
+    # Local cache of the IIIF info.json responses, addressed by the sha1 of their URL
+    # each entry is a file <rootdir>/<2 first hex digits>/<sha1>.json, and its modification time gives its age
+    # entries older than ttl are ignored. When the cache grows above max_bytes, the oldest entries are evicted.
+    DEFAULT_TTL = 180 * 24 * 3600
+    DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+    # the size of the cache is checked every EVICTION_PERIOD new entries
+    EVICTION_PERIOD = 1000
+
+    def __init__(self, rootdir: str, ttl: float = DEFAULT_TTL, max_bytes: int = DEFAULT_MAX_BYTES):
+        super().__init__()
+        self._rootdir = rootdir
+        self._ttl = ttl
+        self._max_bytes = max_bytes
+        self._puts = 0
+        self._lock = threading.Lock()
+        os.makedirs(rootdir, exist_ok=True)
+
+    @staticmethod
+    def key(url: str) -> str:
+        return hashlib.sha1(url.encode('utf-8')).hexdigest()
+
+    def _path(self, url: str) -> str:
+        k = self.key(url)
+        return os.path.join(self._rootdir, k[:2], k + ".json")
+
+    def get(self, url: str) -> object:
+        # return the data cached for url, or None if not cached (or expired)
+        path = self._path(url)
+        try:
+            if time.time() - os.path.getmtime(path) > self._ttl:
+                self._remove(path)
+                return None
+            with open(path, 'r', encoding='utf-8') as fp:
+                entry = json.load(fp)
+        except (OSError, ValueError):
+            return None
+        return entry['data'] if entry.get('url') == url else None
+
+    def put(self, url: str, data: object):
+        path = self._path(url)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # written in a temporary file then renamed : a reader never sees a partial entry
+        fd, tmpname = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as fp:
+                json.dump({'url': url, 'data': data}, fp)
+            os.replace(tmpname, path)
+        except OSError:
+            self._remove(tmpname)
+            raise
+
+        with self._lock:
+            self._puts += 1
+            check = self._puts % self.EVICTION_PERIOD == 0
+        if check:
+            self.evict()
+
+    def evict(self) -> int:
+        # remove the expired entries, then the oldest ones until the cache is below 90% of max_bytes. Return the number of entries removed
+        entries = []
+        for r, d, f in os.walk(self._rootdir):
+            for file in f:
+                if file.endswith('.json'):
+                    path = os.path.join(r, file)
+                    try:
+                        st = os.stat(path)
+                    except OSError:
+                        continue
+                    entries.append((st.st_mtime, st.st_size, path))
+
+        entries.sort()
+        now = time.time()
+        total = sum(e[1] for e in entries)
+        removed = 0
+        for mtime, size, path in entries:
+            if now - mtime <= self._ttl and total <= 0.9 * self._max_bytes:
+                break
+            self._remove(path)
+            total -= size
+            removed += 1
+        return removed
+
+    @staticmethod
+    def _remove(path: str):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
@@ -3,39 +3,30 @@ DROP TABLE IF EXISTS "config";
 CREATE TABLE IF NOT EXISTS "config" (
 	"version"	INTEGER
 );
-DROP INDEX IF EXISTS "pk_images";
 DROP TABLE IF EXISTS "images";
 CREATE TABLE IF NOT EXISTS "images" (
-	"imageID"	TEXT,     -- imageID = correspond to a pageID which is DocumentID + "-" + NumPage
+	"imageID"	TEXT NOT NULL PRIMARY KEY,  -- imageID = correspond to a pageID which is DocumentID + "-" + NumPage
+	                                    -- WARNING: if the same image is delivered by several servers, the program wil have to deal with picking the most trustable one.
 	"documentURL"	TEXT, -- download the image. May have different forma depending the server of images (Gallica, DRE, etc ...)
 	"width"	INTEGER,      -- size in pixel of the image downloaded with 'documentURL'
 	"height"	INTEGER
-);
-CREATE UNIQUE INDEX IF NOT EXISTS "pk_images" ON "images" (
-	"imageID"  -- WARNING: if the same image is delivered by several servers, the program wil have to deal with picking the most trustable one.
-);
+) WITHOUT ROWID;
 
-DROP INDEX IF EXISTS "pk_classes";
 DROP TABLE IF EXISTS "classes";
 CREATE TABLE IF NOT EXISTS "classes" (
-	"classID"	TEXT,
+	"classID"	TEXT NOT NULL PRIMARY KEY,
 	"superclassID"	TEXT,
 	"label" TEXT
-);
-
+) WITHOUT ROWID;
 
-CREATE UNIQUE INDEX IF NOT EXISTS "pk_classes" ON "classes" (
-	"classID"	ASC
-);
-DROP INDEX IF EXISTS "pk_mandragore";
 DROP TABLE IF EXISTS "mandragores";
 CREATE TABLE IF NOT EXISTS "mandragores" (
-	"mandragoreID"	INTEGER, -- pk of this table
+	"mandragoreID"	INTEGER PRIMARY KEY, -- pk of this table
 	"description" TEXT
 );
 
+-- scenes keep a rowid : x, y are part of the pk and are null for the scenes not yet localized
 DROP INDEX IF EXISTS "pk_scenes";
-DROP INDEX IF EXISTS "fk_scenes_mandragores";
 DROP INDEX IF EXISTS "fk_scenes_images";
 DROP TABLE IF EXISTS "scenes";
 CREATE TABLE IF NOT EXISTS "scenes" (
@@ -52,34 +43,69 @@ CREATE UNIQUE INDEX IF NOT EXISTS "pk_scenes" ON "scenes" (
 	"x",
 	"y"
 );
-CREATE INDEX IF NOT EXISTS "fk_scenes_mandragores" ON "mandragores" (
-	"mandragoreID"	ASC
-);
+-- covers the join images -> scenes -> mandragores, and the filter 'localized' on scenes
 CREATE INDEX IF NOT EXISTS "fk_scenes_images" ON "scenes" (
-	"imageID"	ASC
+	"imageID",
+	"mandragoreID",
+	"width",
+	"height"
 );
 
-DROP INDEX IF EXISTS "pk_descriptors";
-DROP INDEX IF EXISTS "fk_descriptors_mandragores";
 DROP INDEX IF EXISTS "fk_descriptors_classes";
 DROP TABLE IF EXISTS "descriptors";
 CREATE TABLE IF NOT EXISTS "descriptors" (
-	"mandragoreID"	INTEGER, -- fk to scene - part of pk.
-	"classID" TEXT,           -- fk to class - part of pk.
+	"mandragoreID"	INTEGER NOT NULL, -- fk to scene - part of pk. The pk covers the joins on mandragoreID
+	"classID" TEXT NOT NULL,           -- fk to class - part of pk.
 	"x"	INTEGER,               -- location of the class relative to image. values in pixels
 	"y"	INTEGER,
 	"width"	INTEGER,
-	"height" INTEGER
-);
-CREATE UNIQUE INDEX IF NOT EXISTS "pk_descriptors" ON "descriptors" (
-	"mandragoreID",
-	"classID"
+	"height" INTEGER,
+	PRIMARY KEY ("mandragoreID", "classID")
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS "fk_descriptors_classes" ON "descriptors" (
+	"classID",
+	"mandragoreID"
 );
-CREATE INDEX IF NOT EXISTS "fk_descriptors_mandragores" ON "mandragores" (
-	"mandragoreID"	ASC
+
+DROP INDEX IF EXISTS "fk_image_files_images";
+DROP TABLE IF EXISTS "image_files";
+CREATE TABLE IF NOT EXISTS "image_files" (
+	"path"	TEXT NOT NULL PRIMARY KEY,  -- name of the file, relative to the folder of the images of the server (e.g. images/galactica)
+	"imageID"	TEXT,  -- fk on images
+	"zoom"	INTEGER,   -- pct of the full image downloaded in this file
+	"bytes"	INTEGER,   -- size of the file
+	"width"	INTEGER,   -- size in pixels of the content of the file
+	"height"	INTEGER,
+	"sha256"	TEXT,
+	"region"	TEXT   -- x,y,width,height of the part of the full image saved in this file (in pixels of the full image) - NULL for the whole image
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS "fk_image_files_images" ON "image_files" (
+	"imageID",
+	"zoom"
 );
-CREATE INDEX IF NOT EXISTS "fk_descriptors_classes" ON "classes" (
-	"classID"	ASC
+
+DROP TABLE IF EXISTS "prediction_runs";
+CREATE TABLE IF NOT EXISTS "prediction_runs" (
+	"runID"	TEXT NOT NULL PRIMARY KEY,
+	"created"	TEXT,  -- date of the run, ISO 8601
+	"params"	TEXT   -- json of the params of the post-processing
+) WITHOUT ROWID;
+
+DROP INDEX IF EXISTS "fk_predictions_images";
+DROP TABLE IF EXISTS "predictions";
+CREATE TABLE IF NOT EXISTS "predictions" (
+	"runID"	TEXT NOT NULL,     -- fk on prediction_runs - part of pk. The pk covers the comparison of 2 runs, page by page
+	"imageID"	TEXT NOT NULL,   -- fk on images - part of pk
+	"x"	INTEGER NOT NULL,      -- box predicted, in pixels of the full image - part of pk
+	"y"	INTEGER NOT NULL,
+	"width"	INTEGER NOT NULL,
+	"height"	INTEGER NOT NULL,
+	"score"	REAL,
+	PRIMARY KEY ("runID", "imageID", "x", "y", "width", "height")
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS "fk_predictions_images" ON "predictions" (
+	"imageID",
+	"runID"
 );
-INSERT INTO config VALUES (1);
+INSERT INTO config VALUES (4);
 COMMIT;
@@ -0,0 +1,89 @@
+-- migration of a DB in version 1 to version 2 : tables are rebuilt with their primary key, indexes are rebuilt on the right tables
+-- run in one transaction by the migration engine (see PersistMandlagore.migrate), that also updates config.version
+
+-- image_files may be missing in the DBs created before it was introduced
+CREATE TABLE IF NOT EXISTS "image_files" (
+	"path"	TEXT,
+	"imageID"	TEXT,
+	"zoom"	INTEGER,
+	"bytes"	INTEGER,
+	"width"	INTEGER,
+	"height"	INTEGER,
+	"sha256"	TEXT
+);
+
+DROP TABLE IF EXISTS "images_v2";
+CREATE TABLE "images_v2" (
+	"imageID"	TEXT NOT NULL PRIMARY KEY,
+	"documentURL"	TEXT,
+	"width"	INTEGER,
+	"height"	INTEGER
+) WITHOUT ROWID;
+INSERT OR REPLACE INTO "images_v2" SELECT "imageID", "documentURL", "width", "height" FROM "images" WHERE "imageID" IS NOT NULL;
+DROP TABLE "images";
+ALTER TABLE "images_v2" RENAME TO "images";
+
+DROP TABLE IF EXISTS "classes_v2";
+CREATE TABLE "classes_v2" (
+	"classID"	TEXT NOT NULL PRIMARY KEY,
+	"superclassID"	TEXT,
+	"label" TEXT
+) WITHOUT ROWID;
+INSERT OR REPLACE INTO "classes_v2" SELECT "classID", "superclassID", "label" FROM "classes" WHERE "classID" IS NOT NULL;
+DROP TABLE "classes";
+ALTER TABLE "classes_v2" RENAME TO "classes";
+
+DROP TABLE IF EXISTS "mandragores_v2";
+CREATE TABLE "mandragores_v2" (
+	"mandragoreID"	INTEGER PRIMARY KEY,
+	"description" TEXT
+);
+INSERT OR REPLACE INTO "mandragores_v2" SELECT "mandragoreID", "description" FROM "mandragores" WHERE "mandragoreID" IS NOT NULL;
+DROP TABLE "mandragores";
+ALTER TABLE "mandragores_v2" RENAME TO "mandragores";
+
+DROP TABLE IF EXISTS "descriptors_v2";
+CREATE TABLE "descriptors_v2" (
+	"mandragoreID"	INTEGER NOT NULL,
+	"classID" TEXT NOT NULL,
+	"x"	INTEGER,
+	"y"	INTEGER,
+	"width"	INTEGER,
+	"height" INTEGER,
+	PRIMARY KEY ("mandragoreID", "classID")
+) WITHOUT ROWID;
+INSERT OR REPLACE INTO "descriptors_v2" SELECT "mandragoreID", "classID", "x", "y", "width", "height" FROM "descriptors"
+	WHERE "mandragoreID" IS NOT NULL AND "classID" IS NOT NULL;
+DROP TABLE "descriptors";
+ALTER TABLE "descriptors_v2" RENAME TO "descriptors";
+CREATE INDEX IF NOT EXISTS "fk_descriptors_classes" ON "descriptors" (
+	"classID",
+	"mandragoreID"
+);
+
+DROP TABLE IF EXISTS "image_files_v2";
+CREATE TABLE "image_files_v2" (
+	"path"	TEXT NOT NULL PRIMARY KEY,
+	"imageID"	TEXT,
+	"zoom"	INTEGER,
+	"bytes"	INTEGER,
+	"width"	INTEGER,
+	"height"	INTEGER,
+	"sha256"	TEXT
+) WITHOUT ROWID;
+INSERT OR REPLACE INTO "image_files_v2" SELECT "path", "imageID", "zoom", "bytes", "width", "height", "sha256" FROM "image_files" WHERE "path" IS NOT NULL;
+DROP TABLE "image_files";
+ALTER TABLE "image_files_v2" RENAME TO "image_files";
+CREATE INDEX IF NOT EXISTS "fk_image_files_images" ON "image_files" (
+	"imageID",
+	"zoom"
+);
+
+-- scenes keep their layout, only the indexes change
+DROP INDEX IF EXISTS "fk_scenes_images";
+CREATE INDEX IF NOT EXISTS "fk_scenes_images" ON "scenes" (
+	"imageID",
+	"mandragoreID",
+	"width",
+	"height"
+);
@@ -0,0 +1,2 @@
+-- migration of a DB in version 2 to version 3 : image_files can record a region of an image (crops of scenes)
+ALTER TABLE "image_files" ADD COLUMN "region" TEXT;
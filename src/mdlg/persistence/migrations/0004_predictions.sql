@@ -0,0 +1,24 @@
+-- migration of a DB in version 3 to version 4 : boxes of the scenes predicted in the pages, by run of the prediction
+DROP TABLE IF EXISTS "prediction_runs";
+CREATE TABLE IF NOT EXISTS "prediction_runs" (
+	"runID"	TEXT NOT NULL PRIMARY KEY,
+	"created"	TEXT,  -- date of the run, ISO 8601
+	"params"	TEXT   -- json of the params of the post-processing
+) WITHOUT ROWID;
+
+DROP INDEX IF EXISTS "fk_predictions_images";
+DROP TABLE IF EXISTS "predictions";
+CREATE TABLE IF NOT EXISTS "predictions" (
+	"runID"	TEXT NOT NULL,     -- fk on prediction_runs - part of pk. The pk covers the comparison of 2 runs, page by page
+	"imageID"	TEXT NOT NULL,   -- fk on images - part of pk
+	"x"	INTEGER NOT NULL,      -- box predicted, in pixels of the full image - part of pk
+	"y"	INTEGER NOT NULL,
+	"width"	INTEGER NOT NULL,
+	"height"	INTEGER NOT NULL,
+	"score"	REAL,
+	PRIMARY KEY ("runID", "imageID", "x", "y", "width", "height")
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS "fk_predictions_images" ON "predictions" (
+	"imageID",
+	"runID"
+);
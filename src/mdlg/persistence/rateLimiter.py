@@ -0,0 +1,102 @@
+import random
+import threading
+import time
+
+
+class RateLimiter(object):
+    # Token bucket pacing the requests sent to one host, with a rate adjusted on the responses (AIMD):
+    # - each response that is fast and successful increases the rate by INCREASE requests/s (additive increase)
+    # - a response asking to slow down (429, 503), a server error, or a response slower than latency_target, multiplies the rate by
+    #   DECREASE (multiplicative decrease) - at most once every DECREASE_PERIOD seconds, as the requests in flight report the same congestion
+    # - a Retry-After received pauses all the requests until it is over
+    INCREASE = 0.5
+    DECREASE = 0.5
+    DECREASE_PERIOD = 1.0
+    SLOW_DOWN_STATUS = (429, 503)
+
+    def __init__(self, rate: float = 4.0, min_rate: float = 0.2, max_rate: float = 50.0, burst: float = 4.0, latency_target: float = 2.0,
+                 clock=time.monotonic, sleep=time.sleep):
+        super().__init__()
+        self.rate = rate
+        self.min_rate, self.max_rate = min_rate, max_rate
+        self.burst = burst
+        self.latency_target = latency_target
+        self._clock, self._sleep = clock, sleep
+        self._tokens = burst
+        self._last = clock()
+        self._paused_until = 0.0
+        self._last_decrease = None
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+        self._last = now
+
+    def acquire(self):
+        # block until a request can be sent
+        while True:
+            with self._lock:
+                now = self._clock()
+                if now < self._paused_until:
+                    wait = self._paused_until - now
+                else:
+                    self._refill(now)
+                    if self._tokens >= 1:
+                        self._tokens -= 1
+                        return
+                    wait = (1 - self._tokens) / self.rate
+            self._sleep(wait)
+
+    def on_response(self, status: int = None, latency: float = None, retry_after: float = None):
+        # status None : no response received (connection error, timeout) - considered as congestion
+        # latency None : not relevant for this request (e.g. the download of a large content)
+        with self._lock:
+            now = self._clock()
+            if retry_after is not None:
+                self._paused_until = max(self._paused_until, now + retry_after)
+            congested = status is None or status in self.SLOW_DOWN_STATUS or status >= 500 or \
+                (latency is not None and latency > self.latency_target)
+            if congested:
+                if self._last_decrease is None or now - self._last_decrease >= self.DECREASE_PERIOD:
+                    self._refill(now)
+                    self.rate = max(self.min_rate, self.rate * self.DECREASE)
+                    self._last_decrease = now
+            elif status < 400:
+                self._refill(now)
+                self.rate = min(self.max_rate, self.rate + self.INCREASE)
+
+
+class RetryPolicy(object):
+    # Retries of the requests that failed on a transient error (see CannotRetriveInformation), after a jittered exponential backoff
+    # ("full jitter"): the n-th retry waits a random time in [0, min(max_delay, base_delay * 2^n)]
+    # Retries are limited by a budget shared by all the requests: at most budget_ratio retries per request sent (plus min_retries),
+    # so that a server that is down is not flooded with retries.
+    def __init__(self, max_attempts: int = 5, base_delay: float = 0.5, max_delay: float = 30.0, budget_ratio: float = 0.2, min_retries: int = 10,
+                 rand=random.random):
+        super().__init__()
+        self.max_attempts = max_attempts
+        self.base_delay, self.max_delay = base_delay, max_delay
+        self.budget_ratio, self.min_retries = budget_ratio, min_retries
+        self._rand = rand
+        self._requests = 0
+        self._retries = 0
+        self._lock = threading.Lock()
+
+    def on_request(self):
+        with self._lock:
+            self._requests += 1
+
+    def backoff(self, attempt: int, retry_after: float = None) -> float:
+        # time to wait before the attempt (1 for the first retry) - the Retry-After of the server is a minimum
+        delay = self._rand() * min(self.max_delay, self.base_delay * (2 ** attempt))
+        return max(delay, retry_after) if retry_after is not None else delay
+
+    def allow_retry(self, attempt: int) -> bool:
+        # attempt : number of attempts already done for the request - consumes the budget if allowed
+        if attempt >= self.max_attempts:
+            return False
+        with self._lock:
+            if self._retries >= self.min_retries + self.budget_ratio * self._requests:
+                return False
+            self._retries += 1
+            return True
@@ -1,14 +1,43 @@
 import requests
 from mdlg.model.model import GalacticaURL
+from mdlg.persistence.iiifCache import IIIFInfoCache
+from mdlg.persistence.rateLimiter import RateLimiter, RetryPolicy
 import json
 from requests import RequestException, Session
+from requests.adapters import HTTPAdapter
 from click import progressbar
+from urllib.parse import urlsplit
 import os
 import io
+import hashlib
+import tempfile
+import threading
+import time
 
 
 class CannotRetriveInformation(Exception):
-    pass
+    # status_code : HTTP status of the response, None if no response was received
+    # retry_after : delay (in seconds) asked by the server before sending new requests
+    # transient : the request may succeed later - by default, when no response was received (connection error, timeout), or the server
+    # is overloaded (429) or failing (5xx). Errors on the local files, or on the content received, are not transient.
+    def __init__(self, message, status_code: int = None, retry_after: float = None, transient: bool = None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.retry_after = retry_after
+        self.transient = transient if transient is not None else status_code is None or status_code == 429 or status_code >= 500
+
+
+def retry_after(response) -> float:
+    # delay of the Retry-After header of the response, in seconds (the HTTP-date form is ignored)
+    value = response.headers.get('retry-after') if response is not None else None
+    try:
+        return float(value) if value is not None else None
+    except ValueError:
+        return None
+
+
+# connect and read timeouts (in seconds) of the requests to galactica
+TIMEOUT = (5, 30)
 
 
 def iter_slices(string, slice_length):
@@ -29,6 +58,7 @@ class FakeDownloadResponse(object):
         super().__init__()
         self._content = content
         self._status = 200
+        self.status_code = self._status
         self.headers = {'content-length': len(self._content)}
 
     def raise_for_status(self):
@@ -47,58 +77,231 @@ def clean_file(filename: str):
             pass
 
 
-def download_binary_file(session: requests.Session, url: str, filename: str, titlebar: str = None, dryrun: bool = False):
+# A download is written in <filename>.part, then renamed to <filename> once complete.
+# The sidecar manifest <filename>.manifest.json records the url and the expected length while downloading (to resume the .part file with
+# an HTTP Range request), then the final length and sha256 of the file.
+PARTIAL_SUFFIX = '.part'
+MANIFEST_SUFFIX = '.manifest.json'
+
+
+def read_manifest(filename: str) -> dict:
+    try:
+        with open(filename + MANIFEST_SUFFIX, 'r', encoding='utf-8') as fp:
+            return json.load(fp)
+    except (OSError, ValueError):
+        return None
+
+
+def write_manifest(filename: str, manifest: dict):
+    fd, tmpname = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(filename)), suffix='.tmp')
+    with os.fdopen(fd, 'w', encoding='utf-8') as fp:
+        json.dump(manifest, fp)
+    os.replace(tmpname, filename + MANIFEST_SUFFIX)
+
+
+def file_sha256(filename: str, sha=None) -> 'hashlib._Hash':
+    sha = hashlib.sha256() if sha is None else sha
+    with open(filename, 'rb') as fd:
+        for block in iter(lambda: fd.read(1024 * 1024), b''):
+            sha.update(block)
+    return sha
+
+
+def is_complete_download(filename: str, verify: bool = False) -> bool:
+    # a file without manifest (downloaded by a former version) is considered complete
+    if not os.path.isfile(filename):
+        return False
+    manifest = read_manifest(filename)
+    if manifest is None:
+        return True
+    if manifest.get('length') is not None and os.path.getsize(filename) != manifest['length']:
+        return False
+    if verify and manifest.get('sha256') is not None:
+        return file_sha256(filename).hexdigest() == manifest['sha256']
+    return True
+
+
+def download_binary_file(session: requests.Session,
+                         url: str,
+                         filename: str,
+                         titlebar: str = None,
+                         dryrun: bool = False,
+                         progress: bool = True,
+                         timeout=TIMEOUT):
+    partname = filename + PARTIAL_SUFFIX
+    manifest = read_manifest(filename)
+    offset = 0
+    if manifest is not None and manifest.get('url') == url and os.path.isfile(partname):
+        offset = os.path.getsize(partname)
+
+    r = None
     try:
-        r = FakeDownloadResponse() if dryrun else session.get(url, stream=True)
+        headers = {'Range': 'bytes=%d-' % offset} if offset > 0 else {}
+        r = FakeDownloadResponse() if dryrun else session.get(url, stream=True, headers=headers, timeout=timeout)
+        if r.status_code == 416:
+            # the partial file does not match the remote one any more : restart from scratch
+            offset = 0
+            r = session.get(url, stream=True, timeout=timeout)
         r.raise_for_status()
-        total_size = int(r.headers['content-length'])
-        with progressbar(r.iter_content(1024), length=total_size, label=url if titlebar is None else titlebar) as bar:
-            with open(filename, 'wb') as fd:
-                for chunk in bar:
-                    bar.update(fd.write(chunk))
+        if offset > 0 and r.status_code != 206:
+            # range not supported by the server : the whole content is sent again
+            offset = 0
+
+        content_length = r.headers.get('content-length')
+        length = int(content_length) + offset if content_length is not None else None
+        write_manifest(filename, {'url': url, 'length': length})
+
+        sha = file_sha256(partname) if offset > 0 else hashlib.sha256()
+        chunks = r.iter_content(1024)
+        with open(partname, 'ab' if offset > 0 else 'wb') as fd:
+            if progress:
+                with progressbar(chunks, length=length - offset if length is not None else None, label=url if titlebar is None else titlebar) as bar:
+                    for chunk in bar:
+                        sha.update(chunk)
+                        bar.update(fd.write(chunk))
+            else:
+                # no per-file progress: used when several downloads are running concurrently
+                for chunk in chunks:
+                    sha.update(chunk)
+                    fd.write(chunk)
+
+        size = os.path.getsize(partname)
+        if length is not None and size != length:
+            raise CannotRetriveInformation("getting url : %s - download interrupted at %d bytes on %d, will be resumed on next call" % (url, size, length))
+        os.replace(partname, filename)
+        write_manifest(filename, {'url': url, 'length': size, 'sha256': sha.hexdigest()})
 
     except RequestException as re:
-        clean_file(filename)
-        raise CannotRetriveInformation("getting url : %s - return status code %d (exception raised is : %s)" % (url, r.status_code, str(re)))
+        # the partial file is kept, to resume the download
+        status = r.status_code if r is not None and re.response is not None else None
+        raise CannotRetriveInformation("getting url : %s - return status code %s (exception raised is : %s)" % (url, status, str(re)), status,
+                                       retry_after(r))
     except IOError as e:
-        clean_file(filename)
-        raise CannotRetriveInformation("saving url: %s in file %s - (exception raised is : %s)" % (url, filename, str(e)))
+        raise CannotRetriveInformation("saving url: %s in file %s - (exception raised is : %s)" % (url, filename, str(e)), transient=False)
 
 
-def download_json(session: requests.Session, url: str) -> object:
+def download_json(session: requests.Session, url: str, timeout=TIMEOUT) -> object:
+    r = None
     try:
-        r = session.get(url)
+        r = session.get(url, timeout=timeout)
         r.raise_for_status()
     except RequestException as re:
-        raise CannotRetriveInformation("getting url : %s - return status code %d (exception raised is : %s)" % (url, r.status_code, str(re)))
+        status = r.status_code if r is not None else None
+        raise CannotRetriveInformation("getting url : %s - return status code %s (exception raised is : %s)" % (url, status, str(re)), status,
+                                       retry_after(r))
 
     return r.json()
 
 
 class GalacticaSession(object):
-    def __init__(self):
+    # A requests.Session is not safe to share between threads: each thread gets its own session (and its own pool of connections).
+    # The number of connections opened at the same time on one host is bounded by max_connections_per_host, whatever the number of threads.
+    # If a cache is provided, the info.json responses are read from it first, and saved in it once downloaded.
+    # The requests sent to one host are paced by its RateLimiter (created with rate_options), and the requests that fail on a transient
+    # error are retried as decided by the retry_policy (shared by all the hosts).
+    def __init__(self,
+                 max_connections_per_host: int = 4,
+                 cache: IIIFInfoCache = None,
+                 rate_options: dict = None,
+                 retry_policy: RetryPolicy = None,
+                 timeout=TIMEOUT,
+                 sleep=time.sleep):
         super().__init__()
-        self._session = None
+        self._max_connections_per_host = max_connections_per_host
+        self._cache = cache
+        self._rate_options = rate_options if rate_options is not None else {}
+        self._retry_policy = retry_policy if retry_policy is not None else RetryPolicy()
+        self._timeout = timeout
+        self._sleep = sleep
+        self._local = None
+        self._sessions = []
+        self._host_slots = {}
+        self._limiters = {}
+        self._lock = threading.Lock()
 
     def __enter__(self):
-        self._session = requests.Session()
+        self._local = threading.local()
         return self
 
     def __exit__(self, *exc):
-        self._session = None
+        with self._lock:
+            for s in self._sessions:
+                s.close()
+            self._sessions = []
+            self._host_slots = {}
+            self._limiters = {}
+        self._local = None
+
+    def _session(self) -> requests.Session:
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self._max_connections_per_host)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            self._local.session = session
+            with self._lock:
+                self._sessions.append(session)
+        return session
+
+    def _host_slot(self, url: str) -> threading.BoundedSemaphore:
+        host = urlsplit(url).netloc
+        with self._lock:
+            if host not in self._host_slots:
+                self._host_slots[host] = threading.BoundedSemaphore(self._max_connections_per_host)
+            return self._host_slots[host]
 
-    def download_image(self, documentURL: str, filename: str, titlebar: str = None, dryrun: bool = False):
-        download_binary_file(self._session, documentURL, filename, titlebar, dryrun)
+    def rate_limiter(self, url: str) -> RateLimiter:
+        host = urlsplit(url).netloc
+        with self._lock:
+            if host not in self._limiters:
+                self._limiters[host] = RateLimiter(**self._rate_options)
+            return self._limiters[host]
+
+    def _call(self, url: str, request, measure_latency: bool):
+        # run request() paced by the rate limiter of the host of url, and retried on transient errors
+        # measure_latency : the duration of the request reflects the load of the server (not true for the download of large contents)
+        limiter = self.rate_limiter(url)
+        attempt = 0
+        while True:
+            limiter.acquire()
+            self._retry_policy.on_request()
+            start = time.monotonic()
+            try:
+                with self._host_slot(url):
+                    result = request()
+            except CannotRetriveInformation as e:
+                if not e.transient:
+                    raise
+                limiter.on_response(e.status_code, None, e.retry_after)
+                attempt += 1
+                if not self._retry_policy.allow_retry(attempt):
+                    raise
+                self._sleep(self._retry_policy.backoff(attempt, e.retry_after))
+                continue
+            limiter.on_response(200, time.monotonic() - start if measure_latency else None)
+            return result
+
+    def download_image(self, documentURL: str, filename: str, titlebar: str = None, dryrun: bool = False, progress: bool = True):
+        if dryrun:
+            download_binary_file(None, documentURL, filename, titlebar, dryrun, progress)
+            return
+        # a download interrupted is resumed by the retry, from the partial file
+        self._call(documentURL, lambda: download_binary_file(self._session(), documentURL, filename, titlebar, dryrun, progress, self._timeout), False)
 
     def collect_image_size(self, documentURL: str, dryrun: bool = False) -> (int, int):
         if dryrun:
             return 10, 20
         else:
             url = GalacticaURL.from_url(documentURL).url_image_properties().as_url()
-            data = download_json(self._session, url)
-            if "width" not in data or "height" not in data:
-                raise CannotRetriveInformation("getting url : %s - request return is correct, but json data does not containe wiht/height : JSON = %s" %
-                                               (url, json.dumps(data)))
+            data = self._cache.get(url) if self._cache is not None else None
+            if data is None:
+                data = self._call(url, lambda: download_json(self._session(), url, self._timeout), True)
+                if "width" not in data or "height" not in data:
+                    raise CannotRetriveInformation("getting url : %s - request return is correct, but json data does not containe wiht/height : JSON = %s" %
+                                                   (url, json.dumps(data)), transient=False)
+                if self._cache is not None:
+                    self._cache.put(url, data)
             return data["width"], data["height"]
 
         # {"profile": "http://library.stanford.edu/iiif/image-api/1.1/compliance.html#level2",
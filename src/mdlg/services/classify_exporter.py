@@ -0,0 +1,212 @@
+# Training set of the classification of descriptors, as shards of crops
+#
+# Each located descriptor is cut from the largest file of its page held locally (see PyramidStore), and resized so that its longest
+# side is max_side pixels. The descriptors are located in pixels of their scene (the image labelled in VIA is the scene).
+# Crops are packed in tar files of shard_size crops (the last one may be smaller), instead of one file per crop, so that an epoch
+# reads a few large files sequentially:
+#   <outdir>/classify-NNNNNN.tar    for each crop <key>.jpg and <key>.cls (the classID, utf-8)
+#   <outdir>/index.json             classes, and shards with their number of crops, size and class histogram
+#   <outdir>/samples.csv            key, shard, offset and size of the jpeg in the shard, classID, imageID of each crop
+# Crops of the same page are consecutive, so that each page is decoded once. Shards are written in a pool of processes.
+
+from mdlg.services.dataset_snapshot import DatasetSnapshot
+from mdlg.services.pyramid_store import PyramidStore
+from mdlg.persistence.remoteHttp import PARTIAL_SUFFIX
+from mdlg.model import geometry
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from PIL import Image
+import numpy as np
+import tarfile
+import json
+import csv
+import io
+import os
+import click
+
+SHARD_PREFIX = 'classify-'
+SHARD_SUFFIX = '.tar'
+
+
+def shard_name(index: int) -> str:
+    return "%s%06d%s" % (SHARD_PREFIX, index, SHARD_SUFFIX)
+
+
+def _add_member(tar: tarfile.TarFile, name: str, data: bytes) -> int:
+    # add data as the member name of the tar, return the offset of data in the tar file
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    tar.addfile(info, io.BytesIO(data))
+    # the data is padded to a whole number of blocks, after the header(s)
+    return tar.offset - -(-len(data) // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+
+
+def write_shard(filename: str, pages: list, max_side: int) -> dict:
+    # run in a worker process : cut the crops of the pages, and pack them in the shard filename
+    # pages : list of (imageID, source file, zoom of the file, keys, classIDs, boxes in pixels of the full page)
+    # return the description of the shard, with the samples it contains
+    partname = filename + PARTIAL_SUFFIX
+    histogram = {}
+    samples = []
+    with tarfile.open(partname, 'w', format=tarfile.GNU_FORMAT) as tar:
+        for imageID, source, zoom, keys, classes, boxes in pages:
+            with Image.open(source) as im:
+                im = im.convert('RGB')
+                boxes = geometry.clip(geometry.rescale(boxes, zoom), im.size).astype(np.int64)
+                for key, cls, (x, y, w, h) in zip(keys, classes, boxes):
+                    if w <= 0 or h <= 0:
+                        continue
+                    with im.crop((x, y, x + w, y + h)) as crop:
+                        crop.thumbnail((max_side, max_side), Image.LANCZOS)
+                        data = io.BytesIO()
+                        crop.save(data, 'JPEG', quality=90)
+                    offset = _add_member(tar, key + '.jpg', data.getvalue())
+                    samples.append((key, offset, data.tell(), cls, imageID))
+                    _add_member(tar, key + '.cls', cls.encode('utf-8'))
+                    histogram[cls] = histogram.get(cls, 0) + 1
+    os.replace(partname, filename)
+    return {'name': os.path.basename(filename), 'count': len(samples), 'bytes': os.path.getsize(filename), 'histogram': histogram, 'samples': samples}
+
+
+def read_shard(filename: str):
+    # iterate on (key, jpeg content, classID) of the crops of a shard, reading it sequentially
+    with tarfile.open(filename, 'r|') as tar:
+        key, data = None, None
+        for member in tar:
+            name, ext = os.path.splitext(member.name)
+            content = tar.extractfile(member).read()
+            if ext == '.jpg':
+                key, data = name, content
+            elif ext == '.cls' and name == key:
+                yield key, data, content.decode('utf-8')
+
+
+class ClassifyExporter:
+    SHARD_SIZE = 1000
+    MAX_SIDE = 224
+    INDEX_FILENAME = 'index.json'
+    SAMPLES_FILENAME = 'samples.csv'
+
+    def __init__(self, outdir: str, snapshot: DatasetSnapshot, store: PyramidStore, max_side: int = MAX_SIDE, shard_size: int = SHARD_SIZE):
+        super().__init__()
+        self._outdir = outdir
+        self._snapshot = snapshot
+        self._store = store
+        self._max_side = max_side
+        self._shard_size = shard_size
+
+    def _page_samples(self, image_code: int):
+        # keys, classIDs and boxes (in pixels of the full page) of the located descriptors of the located scenes of the page
+        snap = self._snapshot
+        keys, classes, boxes = [], [], []
+        scenes = snap.scenes_of(image_code)
+        scene_boxes = geometry.as_boxes(scenes)
+        for scene, scene_box in zip(scenes[~geometry.undefined(scene_boxes)], scene_boxes[~geometry.undefined(scene_boxes)]):
+            first = snap.descriptor_offsets[scene['mandragore']]
+            descriptors = snap.descriptors_of(scene['mandragore'])
+            located = geometry.as_boxes(descriptors)
+            defined = ~geometry.undefined(located)
+            located[:, :2] += scene_box[:2]
+            for row in np.flatnonzero(defined):
+                keys.append("%s_D-%d" % (snap.image_ids[image_code], first + row))
+                classes.append(str(snap.class_ids[descriptors['cls'][row]]))
+            boxes.append(located[defined])
+        return keys, classes, np.concatenate(boxes) if len(boxes) > 0 else np.empty((0, 4))
+
+    def count_samples(self) -> int:
+        # number of descriptors of the located scenes (an upper bound of the crops exported)
+        snap = self._snapshot
+        scenes = snap.scenes[snap.scenes['width'] > 0]
+        return int((snap.descriptor_offsets[scenes['mandragore'] + 1] - snap.descriptor_offsets[scenes['mandragore']]).sum())
+
+    def _pages(self, limit: int, skipped: list):
+        # arguments of write_shard for each page having located descriptors, and a file held locally
+        count = 0
+        for image_code in np.flatnonzero(np.diff(self._snapshot.scene_offsets) > 0):
+            if limit is not None and count >= limit:
+                return
+            keys, classes, boxes = self._page_samples(image_code)
+            if len(keys) == 0:
+                continue
+            imageID = str(self._snapshot.image_ids[image_code])
+            levels = self._store.levels(imageID)
+            if len(levels) == 0:
+                skipped.append(imageID)
+                continue
+            count += 1
+            yield imageID, self._store.filename(levels[0]), levels[0]['zoom'], keys, classes, boxes
+
+    def _shards(self, pages):
+        # the pages cut in lists of shard_size crops - the crops of a page may be spread on 2 shards
+        shard, size = [], 0
+        for imageID, source, zoom, keys, classes, boxes in pages:
+            start = 0
+            while start < len(keys):
+                end = start + min(len(keys) - start, self._shard_size - size)
+                shard.append((imageID, source, zoom, keys[start:end], classes[start:end], boxes[start:end]))
+                size += end - start
+                start = end
+                if size >= self._shard_size:
+                    yield shard
+                    shard, size = [], 0
+        if size > 0:
+            yield shard
+
+    def _write_index(self, shards: list):
+        # samples.csv then index.json, each written as <filename>.part then renamed - the shards of a previous export are removed
+        classes = {}
+        for shard in shards:
+            for cls, n in shard['histogram'].items():
+                classes[cls] = classes.get(cls, 0) + n
+        filename = os.path.join(self._outdir, self.SAMPLES_FILENAME)
+        with open(filename + PARTIAL_SUFFIX, 'w', newline='', encoding='utf-8') as f:
+            writer = csv.writer(f)
+            writer.writerow(('key', 'shard', 'offset', 'size', 'classID', 'imageID'))
+            for shard in shards:
+                writer.writerows((key, shard['name'], offset, size, cls, imageID) for key, offset, size, cls, imageID in shard['samples'])
+        os.replace(filename + PARTIAL_SUFFIX, filename)
+
+        index = {
+            'max_side': self._max_side,
+            'count': sum(s['count'] for s in shards),
+            'classes': dict(sorted(classes.items())),
+            'shards': [{k: v for k, v in s.items() if k != 'samples'} for s in shards],
+        }
+        filename = os.path.join(self._outdir, self.INDEX_FILENAME)
+        with open(filename + PARTIAL_SUFFIX, 'w', encoding='utf-8') as f:
+            json.dump(index, f, indent=1)
+        os.replace(filename + PARTIAL_SUFFIX, filename)
+
+        names = {s['name'] for s in shards}
+        for name in os.listdir(self._outdir):
+            if name.startswith(SHARD_PREFIX) and name.endswith(SHARD_SUFFIX) and name not in names:
+                os.remove(os.path.join(self._outdir, name))
+
+    def export(self, limit: int = None, workers: int = None) -> str:
+        # limit : number of pages exported - workers : number of processes (default is the number of cores)
+        os.makedirs(self._outdir, exist_ok=True)
+        workers = workers or os.cpu_count() or 1
+        skipped = []
+        shards = []
+        pending = {}
+        with ProcessPoolExecutor(max_workers=workers) as executor, \
+                click.progressbar(length=self.count_samples(), label=f"Export crops of descriptors with {workers} processes") as bar:
+
+            def collect(done):
+                for f in done:
+                    shard = f.result()
+                    shards.append((pending.pop(f), shard))
+                    bar.update(shard['count'])
+
+            # at most 2 shards per process are in flight
+            for index, pages in enumerate(self._shards(self._pages(limit, skipped))):
+                if len(pending) >= 2 * workers:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    collect(done)
+                pending[executor.submit(write_shard, os.path.join(self._outdir, shard_name(index)), pages, self._max_side)] = index
+            done, _ = wait(pending)
+            collect(done)
+
+        shards = [s for _, s in sorted(shards, key=lambda s: s[0])]
+        self._write_index(shards)
+        return "%d crops exported in %d shards in %s, %d pages skipped (no file downloaded)" % (sum(s['count'] for s in shards), len(shards), self._outdir,
+                                                                                               len(skipped))
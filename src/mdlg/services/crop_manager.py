@@ -0,0 +1,163 @@
+# Crops of the pages are downloaded instead of the whole pages: only the regions located by scenes (descriptors are located
+# inside their scene), at full resolution, with IIIF region requests.
+# - the scenes of a page that overlap are merged into one region
+# - a region larger than TILE_SIZE is requested as tiles, in parallel, then the tiles are stitched locally
+# Crops are saved in <rootdir>/crops, and recorded in image_files with their region
+
+from mdlg.persistence.db import PersistMandlagore, iter_chunks
+from mdlg.persistence.remoteHttp import GalacticaSession, is_complete_download, read_manifest, write_manifest, file_sha256, PARTIAL_SUFFIX, \
+    MANIFEST_SUFFIX
+from mdlg.model.model import GalacticaURL, ZONE_FULL, SIZE_FULL
+from mdlg.model import geometry
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from PIL import Image
+import numpy as np
+import os
+import click
+
+
+class CropsManager:
+    CROPS_DIR = 'crops'
+    # regions larger than TILE_SIZE (width or height) are requested by tiles of TILE_SIZE x TILE_SIZE pixels
+    TILE_SIZE = 1024
+    # the crops downloaded are written in DB by batches of this many files, and committed at most every COMMIT_PERIOD seconds
+    FILES_BATCH = 100
+    COMMIT_PERIOD = 30
+    # crops are downloaded at full resolution
+    ZOOM = 100
+
+    def __init__(self, rootdir: str, db: PersistMandlagore, gal: GalacticaSession, tile_size: int = None):
+        super().__init__()
+        self._rootdir = rootdir
+        self._db = db
+        self._gal = gal
+        self._tile_size = self.TILE_SIZE if tile_size is None else tile_size
+        os.makedirs(os.path.join(self._rootdir, self.CROPS_DIR), exist_ok=True)
+
+    def _regions(self, filter, limit: int = None):
+        # (imageID, url of the page, region) of all the regions to fetch - the scenes are read for chunks of images at once
+        # the regions are clipped to the page, when its size is known
+        rows = self._db.iter_images(('imageID', 'documentURL', 'width', 'height'), list(filter) + [['scenes', 'localized', None]], limit)
+        for chunk in iter_chunks(rows, self._db.MAX_QUERY_PARAMETERS):
+            zones = self._db.retrieve_scene_zones([r[0] for r in chunk])
+            for id, url, width, height in chunk:
+                if id not in zones:
+                    continue
+                gal = GalacticaURL.from_url(url).set_zone(ZONE_FULL).set_size(SIZE_FULL)
+                regions = geometry.merge_overlapping(geometry.as_boxes(zones[id], dtype=np.int64))
+                if width is not None and height is not None:
+                    regions = geometry.clip(regions, (width, height))
+                for region in regions:
+                    if region[2] > 0 and region[3] > 0:
+                        yield id, gal, tuple(int(v) for v in region)
+
+    def _crop_path(self, gal: GalacticaURL, region) -> str:
+        # path of the crop, relative to rootdir
+        stem, ext = os.path.splitext(gal.as_filename())
+        return os.path.join(self.CROPS_DIR, "%s_R-%s%s" % (stem, "-".join(map(str, region)), ext))
+
+    def _parts(self, region, faked: bool) -> list:
+        # the boxes requested to build the crop of the region : the region itself, or its tiles
+        if faked or (region[2] <= self._tile_size and region[3] <= self._tile_size):
+            return [region]
+        return [tuple(int(v) for v in t) for t in geometry.tiles(region, self._tile_size)]
+
+    def _prepare_task(self, id, gal, region, faked: bool) -> tuple:
+        path = self._crop_path(gal, region)
+        exists = is_complete_download(os.path.join(self._rootdir, path))
+        return id, gal, region, path, [] if exists else self._parts(region, faked)
+
+    def _image_file(self, id, region, path) -> dict:
+        filename = os.path.join(self._rootdir, path)
+        manifest = read_manifest(filename)
+        return {
+            'path': path,
+            'imageID': id,
+            'zoom': self.ZOOM,
+            'bytes': os.path.getsize(filename),
+            'width': region[2],
+            'height': region[3],
+            'sha256': manifest.get('sha256') if manifest is not None else None,
+            'region': ",".join(map(str, region)),
+        }
+
+    @staticmethod
+    def _stitch(region, parts, part_filenames, filename, url):
+        # paste the tiles in the crop, saved as <filename>.part then renamed - the tiles are removed once the crop is saved
+        partname = filename + PARTIAL_SUFFIX
+        fmt = Image.registered_extensions().get(os.path.splitext(filename)[1].lower(), 'JPEG')
+        with Image.new('RGB', (region[2], region[3])) as crop:
+            for box, part in zip(parts, part_filenames):
+                with Image.open(part) as tile:
+                    crop.paste(tile, (box[0] - region[0], box[1] - region[1]))
+            crop.save(partname, fmt)
+        os.replace(partname, filename)
+        write_manifest(filename, {'url': url, 'length': os.path.getsize(filename), 'sha256': file_sha256(filename).hexdigest()})
+        for part in part_filenames:
+            for f in (part, part + MANIFEST_SUFFIX):
+                if os.path.exists(f):
+                    os.remove(f)
+
+    def _process_task(self, task, faked: bool, tiles_executor: ThreadPoolExecutor) -> tuple:
+        # download the crop of one region - return its image_files record and the number of requests sent
+        id, gal, region, path, parts = task
+        filename = os.path.join(self._rootdir, path)
+        url = gal.set_zone(region).as_url()
+        if len(parts) == 1:
+            self._gal.download_image(url, filename, None, faked, False)
+        elif len(parts) > 1:
+            part_filenames = ["%s.tile-%d" % (filename, i) for i in range(len(parts))]
+            downloads = [
+                tiles_executor.submit(self._gal.download_image,
+                                      gal.set_zone(box).as_url(), part, None, faked, False) for box, part in zip(parts, part_filenames)
+            ]
+            for d in downloads:
+                d.result()
+            self._stitch(region, parts, part_filenames, filename, url)
+        return self._image_file(id, region, path), len(parts)
+
+    def ensure_crop_images(self, filter, limit: int = None, dryrun: bool = False, faked: bool = False, workers: int = 1) -> str:
+        # filter, limit: select the images as ImagesManager.ensure_content_images - only the images having located scenes are kept
+        # workers: number of regions downloaded concurrently, and number of tiles of one region downloaded concurrently
+        #   (the connections to galactica are limited by the GalacticaSession anyway)
+        # return a report
+        tasks = (self._prepare_task(id, gal, region, faked) for id, gal, region in self._regions(filter, limit))
+        if dryrun:
+            for id, gal, region, path, parts in tasks:
+                click.echo(f"Crop {gal.set_zone(region).as_url()}->{path}" + (f" ({len(parts)} tiles)" if len(parts) > 1 else ""))
+            return "dry run"
+
+        workers = max(1, workers or 1)
+        stats = {'regions': 0, 'requests': 0, 'bytes': 0}
+        pending_files = []
+        pending = set()
+
+        def collect(done):
+            for f in done:
+                image_file, requests = f.result()
+                stats['regions'] += 1
+                stats['requests'] += requests
+                stats['bytes'] += image_file['bytes'] if requests > 0 else 0
+                pending_files.append(image_file)
+                if len(pending_files) >= self.FILES_BATCH:
+                    self._db.add_image_files(pending_files)
+                    pending_files.clear()
+
+        with self._db.batch(max_seconds=self.COMMIT_PERIOD):
+            try:
+                with ThreadPoolExecutor(max_workers=workers) as executor, ThreadPoolExecutor(max_workers=workers) as tiles_executor:
+                    # at most 2 regions per worker are in flight, as for the download of pages
+                    for task in tasks:
+                        if len(pending) >= 2 * workers:
+                            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                            collect(done)
+                        pending.add(executor.submit(self._process_task, task, faked, tiles_executor))
+                    done, pending = wait(pending)
+                    collect(done)
+            finally:
+                for f in pending:
+                    f.cancel()
+                if len(pending_files) > 0:
+                    self._db.add_image_files(pending_files)
+
+        return "%d crops recorded - %d requests sent, %d bytes downloaded" % (stats['regions'], stats['requests'], stats['bytes'])
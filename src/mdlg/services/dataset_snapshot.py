@@ -0,0 +1,127 @@
+# Columnar snapshot of images, scenes and descriptors, for the tools that need the whole dataset in memory (training sets generation)
+#
+# - the identifiers are coded as integers: the code of an imageID (resp. mandragoreID, classID) is its index in image_ids
+#   (resp. mandragore_ids, class_ids), each of these dictionaries being sorted. The identifiers are kept as strings, the schema
+#   does not guarantee that mandragoreIDs are numbers (they are sorted as strings : '10' < '9')
+# - images, scenes and descriptors are NumPy structured arrays - an undefined value (NULL in DB) is NULL_VALUE
+# - scenes are sorted by image, descriptors are sorted by mandragore, and CSR-style offsets give the rows of each:
+#   the scenes of image i are scenes[scene_offsets[i]:scene_offsets[i + 1]]
+#   the descriptors of mandragore m are descriptors[descriptor_offsets[m]:descriptor_offsets[m + 1]]
+#
+# a snapshot is saved as a folder of .npy files, that are memory-mapped when loaded
+
+from mdlg.persistence.db import PersistMandlagore
+import numpy as np
+import json
+import os
+import shutil
+
+NULL_VALUE = -1
+
+IMAGE_DTYPE = np.dtype([('width', '<i4'), ('height', '<i4')])
+SCENE_DTYPE = np.dtype([('image', '<i4'), ('mandragore', '<i4'), ('x', '<i4'), ('y', '<i4'), ('width', '<i4'), ('height', '<i4')])
+DESCRIPTOR_DTYPE = np.dtype([('mandragore', '<i4'), ('cls', '<i4'), ('x', '<i4'), ('y', '<i4'), ('width', '<i4'), ('height', '<i4')])
+
+
+def encode(ids: np.ndarray, values: np.ndarray) -> np.ndarray:
+    # code of each of the values in the sorted dictionary ids - NULL_VALUE if the value is not in ids
+    codes = np.searchsorted(ids, values)
+    found = codes < len(ids)
+    found[found] = ids[codes[found]] == values[found]
+    return np.where(found, codes, NULL_VALUE).astype('<i4')
+
+
+def offsets(codes: np.ndarray, count: int) -> np.ndarray:
+    # CSR offsets of the sorted codes: the rows having code c are [offsets[c]:offsets[c + 1]]
+    return np.searchsorted(codes, np.arange(count + 1)).astype('<i8')
+
+
+def structured(rows: list, dtype: np.dtype) -> np.ndarray:
+    # array of dtype from rows of values, None being replaced by NULL_VALUE
+    values = np.array(rows, dtype=object).reshape(len(rows), len(dtype.names))
+    values[np.equal(values, None)] = NULL_VALUE
+    result = np.empty(len(rows), dtype=dtype)
+    for i, name in enumerate(dtype.names):
+        result[name] = values[:, i]
+    return result
+
+
+class DatasetSnapshot:
+    ARRAYS = ('image_ids', 'mandragore_ids', 'class_ids', 'images', 'scenes', 'descriptors', 'scene_offsets', 'descriptor_offsets')
+    META_FILENAME = 'snapshot.json'
+
+    def __init__(self, arrays: dict, meta: dict = None):
+        super().__init__()
+        for name in self.ARRAYS:
+            setattr(self, name, arrays[name])
+        self.meta = meta if meta is not None else {}
+
+    @classmethod
+    def from_db(cls, db: PersistMandlagore):
+        # read each table in one query - the rows referring to an image (resp. mandragore, class) that is not known are ignored
+        image_rows = db.read_table('images', ('imageID', 'width', 'height'), 'imageID')
+        image_ids = np.array([r[0] for r in image_rows], dtype=str)
+        images = structured([r[1:] for r in image_rows], IMAGE_DTYPE)
+        del image_rows
+
+        scene_rows = db.read_table('scenes', ('imageID', 'mandragoreID', 'x', 'y', 'width', 'height'), 'imageID, mandragoreID')
+        scene_rows = [r for r in scene_rows if r[0] is not None and r[1] is not None]
+        descriptor_rows = db.read_table('descriptors', ('mandragoreID', 'classID', 'x', 'y', 'width', 'height'), 'mandragoreID, classID')
+        class_ids = np.array(sorted({r[0] for r in db.read_table('classes', ('classID', ))} | {r[1] for r in descriptor_rows}), dtype=str)
+        mandragore_ids = np.unique(np.array([str(r[1]) for r in scene_rows] + [str(r[0]) for r in descriptor_rows], dtype=str))
+
+        scenes = structured([(0, 0) + r[2:] for r in scene_rows], SCENE_DTYPE)
+        scenes['image'] = encode(image_ids, np.array([r[0] for r in scene_rows], dtype=str))
+        scenes['mandragore'] = encode(mandragore_ids, np.array([str(r[1]) for r in scene_rows], dtype=str))
+        scenes = scenes[scenes['image'] != NULL_VALUE]
+        del scene_rows
+
+        descriptors = structured([(0, 0) + r[2:] for r in descriptor_rows], DESCRIPTOR_DTYPE)
+        descriptors['mandragore'] = encode(mandragore_ids, np.array([str(r[0]) for r in descriptor_rows], dtype=str))
+        descriptors['cls'] = encode(class_ids, np.array([r[1] for r in descriptor_rows], dtype=str))
+        del descriptor_rows
+        # the DB orders numeric mandragoreIDs as numbers : the descriptors are sorted by code, keeping the order of the classes
+        descriptors = descriptors[np.argsort(descriptors['mandragore'], kind='stable')]
+
+        # scenes are read in the order of the imageIDs, and image_ids is sorted : their codes are already sorted
+        return cls({
+            'image_ids': image_ids,
+            'mandragore_ids': mandragore_ids,
+            'class_ids': class_ids,
+            'images': images,
+            'scenes': scenes,
+            'descriptors': descriptors,
+            'scene_offsets': offsets(scenes['image'], len(image_ids)),
+            'descriptor_offsets': offsets(descriptors['mandragore'], len(mandragore_ids)),
+        }, {'schema_version': db.schema_version()})
+
+    def save(self, dirname: str):
+        # files are written in a temporary folder, that replaces dirname once complete
+        tmpdir = dirname.rstrip(os.sep) + '.tmp'
+        shutil.rmtree(tmpdir, ignore_errors=True)
+        os.makedirs(tmpdir)
+        for name in self.ARRAYS:
+            np.save(os.path.join(tmpdir, name + '.npy'), getattr(self, name), allow_pickle=False)
+        meta = dict(self.meta, counts={name: len(getattr(self, name)) for name in ('images', 'scenes', 'descriptors')})
+        with open(os.path.join(tmpdir, self.META_FILENAME), 'w') as f:
+            json.dump(meta, f)
+        shutil.rmtree(dirname, ignore_errors=True)
+        os.rename(tmpdir, dirname)
+
+    @classmethod
+    def load(cls, dirname: str, mmap: bool = True):
+        # with mmap, the arrays are read-only views on the files : only the pages used are read
+        mode = 'r' if mmap else None
+        arrays = {name: np.load(os.path.join(dirname, name + '.npy'), mmap_mode=mode, allow_pickle=False) for name in cls.ARRAYS}
+        with open(os.path.join(dirname, cls.META_FILENAME), 'r') as f:
+            meta = json.load(f)
+        return cls(arrays, meta)
+
+    def image_code(self, imageID: str) -> int:
+        return int(encode(self.image_ids, np.array([imageID], dtype=str))[0])
+
+    def scenes_of(self, image_code: int) -> np.ndarray:
+        return self.scenes[self.scene_offsets[image_code]:self.scene_offsets[image_code + 1]]
+
+    def descriptors_of(self, mandragore_code: int) -> np.ndarray:
+        return self.descriptors[self.descriptor_offsets[mandragore_code]:self.descriptor_offsets[mandragore_code + 1]]
@@ -0,0 +1,172 @@
+# Training set of dh_segment (Ornaments) for the location of the scenes in the pages
+#
+# For each page having located scenes:
+# - the page is resized from the smallest level held in the PyramidStore whose longest side is at least max_side pixels (the largest
+#   level held if none is), so that its longest side is max_side pixels
+# - its label is a 2 colors PNG of the same size: BACKGROUND_COLOR, and SCENE_COLOR on the boxes of the scenes
+# Pages are spread in the sets train, test and validation, by a hash of their imageID (a page stays in the same set when regenerated):
+#   <outdir>/classes.txt
+#   <outdir>/<set>/images/<page>.jpg
+#   <outdir>/<set>/labels/<page>.png
+# Pages are resized and labels rasterized in a pool of processes.
+
+from mdlg.persistence.db import PersistMandlagore, iter_chunks
+from mdlg.services.pyramid_store import PyramidStore, level_size
+from mdlg.model.model import GalacticaURL
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from PIL import Image
+import numpy as np
+import hashlib
+import os
+import click
+
+BACKGROUND_COLOR = (0, 0, 0)
+SCENE_COLOR = (0, 255, 0)
+SETS = ('train', 'test', 'validation')
+
+
+def split_of(imageID: str, ratios) -> str:
+    # set of the page : the sha1 of the imageID, as a number in [0, 1), is compared to the cumulated ratios of the sets
+    h = int(hashlib.sha1(imageID.encode('utf-8')).hexdigest()[:8], 16) / 0x100000000
+    total = sum(ratios)
+    bound = 0
+    for name, ratio in zip(SETS, ratios):
+        bound += ratio / total
+        if h < bound:
+            return name
+    return SETS[-1]
+
+
+def rasterize(boxes: np.ndarray, size) -> np.ndarray:
+    # boolean mask (height, width) of the pixels inside at least one of the boxes (in pixels of the mask)
+    # the rows and columns covered by each box are 2 masks (n, height) and (n, width) : their product counts the boxes covering each pixel
+    width, height = size
+    boxes = np.round(boxes).astype(np.int64)
+    ys, xs = np.arange(height), np.arange(width)
+    rows = (ys[None, :] >= boxes[:, 1:2]) & (ys[None, :] < boxes[:, 1:2] + boxes[:, 3:4])
+    cols = (xs[None, :] >= boxes[:, 0:1]) & (xs[None, :] < boxes[:, 0:1] + boxes[:, 2:3])
+    return (rows.T.astype(np.int32) @ cols.astype(np.int32)) > 0
+
+
+def label_image(mask: np.ndarray) -> Image.Image:
+    colors = np.array([BACKGROUND_COLOR, SCENE_COLOR], dtype=np.uint8)
+    return Image.fromarray(colors[mask.astype(np.uint8)], 'RGB')
+
+
+def generate_page(source: str, zoom: int, boxes: np.ndarray, max_side: int, image_filename: str, label_filename: str) -> (int, int):
+    # run in a worker process : resize the page, and rasterize the boxes (in pixels of the full page) at the same size
+    with Image.open(source) as im:
+        source_size = im.size
+        scale = min(1.0, max_side / max(source_size))
+        size = (max(1, round(source_size[0] * scale)), max(1, round(source_size[1] * scale)))
+        # JPEG files are decoded at a reduced scale when possible
+        im.draft('RGB', size)
+        with im.convert('RGB') as rgb, rgb.resize(size, Image.LANCZOS) as page:
+            page.save(image_filename, 'JPEG', quality=90)
+        # from pixels of the full page to pixels of the file, then of the page generated
+        factor = zoom / 100 * size[0] / source_size[0]
+    label_image(rasterize(boxes * factor, size)).save(label_filename, 'PNG', optimize=True)
+    return size
+
+
+class DhSegmentGenerator:
+    MAX_SIDE = 1000
+    SPLIT = (80, 10, 10)
+
+    def __init__(self, outdir: str, db: PersistMandlagore, store: PyramidStore, max_side: int = MAX_SIDE, split=SPLIT):
+        super().__init__()
+        self._outdir = outdir
+        self._db = db
+        self._store = store
+        self._max_side = max_side
+        self._split = split
+
+    def _prepare(self):
+        for s in SETS:
+            for d in ('images', 'labels'):
+                os.makedirs(os.path.join(self._outdir, s, d), exist_ok=True)
+        with open(os.path.join(self._outdir, 'classes.txt'), 'w') as f:
+            for color in (BACKGROUND_COLOR, SCENE_COLOR):
+                f.write("%d %d %d\n" % color)
+
+    def _source(self, id, size) -> (str, int):
+        # file and zoom of the smallest level held whose longest side is at least max_side (the largest one if none is) - None if no level
+        # is held. The level is only looked up : it is decoded and resized in the worker process
+        # size : size of the full page (None when unknown), for the levels recorded without their size
+        levels = self._store.levels(id)
+        if len(levels) == 0:
+            return None
+        chosen = levels[0]
+        for f in levels:
+            if f['width'] is not None and f['height'] is not None:
+                side = max(f['width'], f['height'])
+            elif size[0] is not None and size[1] is not None:
+                side = max(level_size(size, f['zoom']))
+            else:
+                continue
+            if side < self._max_side:
+                break
+            chosen = f
+        return self._store.filename(chosen), chosen['zoom']
+
+    def _jobs(self, filter, limit, skipped: list):
+        # imageID, set and arguments of generate_page of each page having located scenes and a file held locally
+        rows = self._db.iter_images(('imageID', 'documentURL', 'width', 'height'), list(filter) + [['scenes', 'localized', None]], limit)
+        for chunk in iter_chunks(rows, self._db.MAX_QUERY_PARAMETERS):
+            zones = self._db.retrieve_scene_zones([r[0] for r in chunk])
+            for id, url, width, height in chunk:
+                if id not in zones:
+                    skipped.append(id)
+                    continue
+                source = self._source(id, (width, height))
+                if source is None:
+                    skipped.append(id)
+                    continue
+                name = os.path.splitext(GalacticaURL.from_url(url).as_filename())[0]
+                subset = split_of(id, self._split)
+                yield id, subset, source + (np.array(zones[id], dtype=np.float64), self._max_side,
+                               os.path.join(self._outdir, subset, 'images', name + '.jpg'), os.path.join(self._outdir, subset, 'labels', name + '.png'))
+
+    def generate(self, filter=(), limit: int = None, workers: int = None) -> str:
+        # workers : number of processes (default is the number of cores)
+        self._prepare()
+        workers = workers or os.cpu_count() or 1
+        # exact count : the filter on the located scenes is applied
+        count = self._db.count_images(list(filter) + [['scenes', 'localized', None]], limit)
+        counts = {s: 0 for s in SETS}
+        skipped = []
+        # imageID and error of the pages that could not be generated (file corrupted or missing)
+        failed = []
+        reported = 0
+        pending = {}
+        with ProcessPoolExecutor(max_workers=workers) as executor, \
+                click.progressbar(length=count, label=f"Generate dh_segment training set with {workers} processes") as bar:
+
+            def collect(done):
+                for f in done:
+                    id, subset = pending.pop(f)
+                    try:
+                        f.result()
+                        counts[subset] += 1
+                    except Exception as e:
+                        failed.append((id, str(e)))
+                    bar.update(1)
+
+            # at most 2 pages per process are in flight : the pages are streamed from the DB
+            for id, subset, job in self._jobs(filter, limit, skipped):
+                # the pages skipped are counted as done
+                bar.update(len(skipped) - reported)
+                reported = len(skipped)
+                if len(pending) >= 2 * workers:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    collect(done)
+                pending[executor.submit(generate_page, *job)] = id, subset
+            bar.update(len(skipped) - reported)
+            done, _ = wait(pending)
+            collect(done)
+
+        report = "%d pages generated in %s (%s), %d pages skipped (no scene located, or no file downloaded)" % (
+            sum(counts.values()), self._outdir, ", ".join("%s %d" % (s, counts[s]) for s in SETS), len(skipped))
+        if len(failed) > 0:
+            report += ", %d pages failed:\n" % len(failed) + "\n".join("%s : %s" % f for f in failed)
+        return report
@@ -8,45 +8,144 @@
 
 from mdlg.persistence.db import PersistMandlagore
 from mdlg.model.model import GalacticaURL, SIZE_FULL
-from mdlg.persistence.remoteHttp import GalacticaSession
+from mdlg.persistence.remoteHttp import GalacticaSession, is_complete_download, read_manifest
+from mdlg.services.pyramid_store import level_filename
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 import os
 import click
 
 
 class ImagesManager:
-    def __init__(self, rootdir: str, db: PersistMandlagore, gal: GalacticaSession):
+    # sizes collected from galactica, and files downloaded, are written in DB by batches of this many images
+    SIZES_BATCH = 100
+    # the writes in DB are committed at most every COMMIT_PERIOD seconds
+    COMMIT_PERIOD = 30
+    DOWNLOAD_ZOOM = 20
+
+    def __init__(self, rootdir: str, db: PersistMandlagore, gal: GalacticaSession, zoom: int = DOWNLOAD_ZOOM):
         super().__init__()
         self._rootdir = rootdir
         self._db = db
         self._gal = gal
+        self._zoom = zoom
+
+    def _prepare_task(self, id, url, w, h) -> tuple:
+        gal = GalacticaURL.from_url(url)
+        gal = gal.set_size(self._zoom)
+        filename = os.path.join(self._rootdir, level_filename(gal, self._zoom))
+        exists = is_complete_download(filename)
+        if not exists and self._zoom == self.DOWNLOAD_ZOOM and is_complete_download(os.path.join(self._rootdir, gal.as_filename())):
+            # downloaded by a former version, named without its zoom
+            filename, exists = os.path.join(self._rootdir, gal.as_filename()), True
+        return id, gal, filename, (w, h), w is None or h is None, not exists, exists
+
+    def _image_file(self, id, gal, filename, size) -> dict:
+        # record of a downloaded file for the table image_files - the size in pixels is deduced from the size of the full image
+        manifest = read_manifest(filename)
+        w, h = size
+        return {
+            'path': os.path.relpath(filename, self._rootdir),
+            'imageID': id,
+            'zoom': self._zoom,
+            'bytes': os.path.getsize(filename),
+            'width': w * self._zoom // 100 if w is not None else None,
+            'height': h * self._zoom // 100 if h is not None else None,
+            'sha256': manifest.get('sha256') if manifest is not None else None,
+        }
+
+    def _process_task(self, task, title: str, faked: bool, progress: bool, register_existing: bool) -> tuple:
+        # run the network operations of one image
+        # return the size to be updated in DB and the image_files record of the content downloaded (each can be None)
+        id, gal, filename, size, need_size, need_content, exists = task
+        new_size, image_file = None, None
+        if need_size:
+            size = self._gal.collect_image_size(gal.as_url(), faked)
+            new_size = {'imageID': id, 'width': size[0], 'height': size[1]}
+        if need_content:
+            self._gal.download_image(gal.as_url(), filename, title, faked, progress)
+        if need_content or (exists and register_existing):
+            image_file = self._image_file(id, gal, filename, size)
+        return new_size, image_file
 
-    def ensure_content_images(self, filter, limit: int = None, dryrun: bool = False, faked=False):
+    def _record(self, pending: dict, result: tuple, force: bool = False):
+        new_size, image_file = result if result is not None else (None, None)
+        if new_size is not None:
+            pending['sizes'].append(new_size)
+        if image_file is not None:
+            pending['files'].append(image_file)
+        if len(pending['sizes']) > 0 and (force or len(pending['sizes']) >= self.SIZES_BATCH):
+            self._db.update_images(pending['sizes'])
+            pending['sizes'] = []
+        if len(pending['files']) > 0 and (force or len(pending['files']) >= self.SIZES_BATCH):
+            self._db.add_image_files(pending['files'])
+            pending['files'] = []
+
+    def ensure_content_images(self, filter, limit: int = None, dryrun: bool = False, faked=False, workers: int = 1, missing_only: bool = False):
         # filter: an iteratable on imagesIDs
         # ensure that each image of the DB has its content downloaded
-        ids_and_urls, count = self._db.retrieve_images(('imageID', 'documentURL', 'width', 'height'), filter, limit)
-        downloading = 0
-        for id, url, w, h in ids_and_urls:
-            downloading += 1
-            gal = GalacticaURL.from_url(url)
-            gal = gal.set_size(20)
-            filename = os.path.join(self._rootdir, gal.as_filename())
-
-            if w is None or h is None:
-                click.echo(f"download {downloading}/{count} - retriveing and updating size for image {gal.as_filename()}")
-                if not dryrun:
-                    nw, nh = self._gal.collect_image_size(gal.as_url(), faked)
-                    self._db.update_images([{'imageID': id, 'width': nw, 'height': nh}])
-
-            if os.path.exists(filename):
-                # TODO should verify if the file is the right one
-                # TODO should check the size defined in the file
-                pass
+        # workers: number of images processed concurrently (network operations only, the DB is updated from the calling thread)
+        # missing_only: only the images that have no file recorded in image_files (at the download zoom) are processed.
+        #   a file found complete on disk for one of them is only recorded in image_files
+        # the count is only used to display progress: an estimate avoids to run the whole query twice
+        ids_and_urls, count = self._db.retrieve_images(('imageID', 'documentURL', 'width', 'height'), filter, limit,
+                                                       self._zoom if missing_only else None, PersistMandlagore.COUNT_ESTIMATE)
+        tasks = (self._prepare_task(*row) for row in ids_and_urls)
+        if dryrun:
+            self._echo_tasks(tasks, count)
+            return
+        with self._db.batch(max_seconds=self.COMMIT_PERIOD):
+            if workers is None or workers <= 1:
+                self._run_tasks_sequentially(tasks, count, faked, missing_only)
             else:
-                title = f"Download {downloading}/{count} - {gal.as_url()}->{gal.as_filename()}"
-                if dryrun:
-                    click.echo(title)
-                else:
-                    self._gal.download_image(gal.as_url(), filename, title, faked)
+                self._run_tasks_concurrently(tasks, count, faked, workers, missing_only)
+
+    def _echo_tasks(self, tasks, count: int):
+        for downloading, (id, gal, filename, size, need_size, need_content, exists) in enumerate(tasks, 1):
+            if need_size:
+                click.echo(f"download {downloading}/{count} - retriveing and updating size for image {gal.as_filename()}")
+            if need_content:
+                click.echo(f"Download {downloading}/{count} - {gal.as_url()}->{os.path.basename(filename)}")
+
+    def _run_tasks_sequentially(self, tasks, count: int, faked: bool, register_existing: bool):
+        pending = {'sizes': [], 'files': []}
+        try:
+            for downloading, task in enumerate(tasks, 1):
+                id, gal, filename, size, need_size, need_content, exists = task
+                if need_size:
+                    click.echo(f"download {downloading}/{count} - retriveing and updating size for image {gal.as_filename()}")
+                title = f"Download {downloading}/{count} - {gal.as_url()}->{os.path.basename(filename)}"
+                self._record(pending, self._process_task(task, title, faked, True, register_existing))
+        finally:
+            self._record(pending, None, force=True)
+
+    def _run_tasks_concurrently(self, tasks, count: int, faked: bool, workers: int, register_existing: bool):
+        # at most 2 tasks per worker are in flight, so that huge selections of images are never fully loaded in memory
+        pending_db = {'sizes': [], 'files': []}
+        pending = set()
+        try:
+            with ThreadPoolExecutor(max_workers=workers) as executor, \
+                    click.progressbar(length=count, label=f"Download {count} images with {workers} workers") as bar:
+
+                def collect(done):
+                    for f in done:
+                        self._record(pending_db, f.result())
+                        bar.update(1)
+
+                for task in tasks:
+                    if not (task[4] or task[5] or (task[6] and register_existing)):
+                        bar.update(1)
+                        continue
+                    if len(pending) >= 2 * workers:
+                        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                        collect(done)
+                    pending.add(executor.submit(self._process_task, task, None, faked, False, register_existing))
+
+                done, pending = wait(pending)
+                collect(done)
+        finally:
+            for f in pending:
+                f.cancel()
+            self._record(pending_db, None, force=True)
 
     def ensure_documenting_sizes_of_images(self):
         # download missing sizes from the remote web services
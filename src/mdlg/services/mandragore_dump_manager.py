@@ -80,25 +80,28 @@ class MandragoreDumpManager:
         },
     }
 
-    BnfDumpData = collections.namedtuple('BnfDumpData', ['filename', 'encoding', 'table', 'fields', 'mode', 'columns', 'delimiter', 'transform'])
+    # each file of the dump is read once, and its rows are imported in all the target tables
+    BnfDumpTarget = collections.namedtuple('BnfDumpTarget', ['table', 'fields', 'columns', 'distinct'])
+    BnfDumpData = collections.namedtuple('BnfDumpData', ['filename', 'encoding', 'mode', 'delimiter', 'transform', 'targets'])
     BNF_DUMP_DATA = [
         # 53138757-80	https://gallica.bnf.fr/iiif/ark:/12148/btv1b531387571/f80/full/pct:50/0/native.jpg
-        BnfDumpData('Zoologie-URLs-Gallica.txt', 'utf-8', "images", ["imageID", "documentURL"], DBOperationHelper.SINGLE_RECORD, [0, 1], '\t', None),
+        BnfDumpData('Zoologie-URLs-Gallica.txt', 'utf-8', DBOperationHelper.SINGLE_RECORD, '\t', None,
+                    [BnfDumpTarget("images", ["imageID", "documentURL"], [0, 1], False)]),
 
         # 7842457-1	http://visualiseur.bnf.fr/ConsulterElementNum?O=IFN-7842457&E=JPEG&Deb=1&Fin=1&Param=E
-        BnfDumpData('Zoologie-URLs-DRE-Mandragore.txt', 'utf-8', "images", ["imageID", "documentURL"], DBOperationHelper.SINGLE_RECORD, [0, 1], '\t', None),
+        BnfDumpData('Zoologie-URLs-DRE-Mandragore.txt', 'utf-8', DBOperationHelper.SINGLE_RECORD, '\t', None,
+                    [BnfDumpTarget("images", ["imageID", "documentURL"], [0, 1], False)]),
 
         # 10507217-143;#78047;#78048;#78049;#78050
-        BnfDumpData('Zoologie-images-notices.csv', 'latin_1', "scenes", ["mandragoreID", "imageID"], DBOperationHelper.MULTI_RECORD, [1, 0], ';',
-                    _descriptor_image_csv_preprocess),
+        BnfDumpData('Zoologie-images-notices.csv', 'latin_1', DBOperationHelper.MULTI_RECORD, ';', _descriptor_image_csv_preprocess,
+                    [BnfDumpTarget("scenes", ["mandragoreID", "imageID"], [1, 0], False)]),
 
         # 100327;chien (100327);faucon (100327);oiseau (100327);perdrix (100327);
-        BnfDumpData('Zoologie-notices-descripteurs.csv', 'latin_1', "descriptors", ["mandragoreID", "classID"], DBOperationHelper.MULTI_RECORD, [0, 1], ';',
-                    _descriptor_classe_csv_preprocess),
-
-        # 100327;chien (100327);faucon (100327);oiseau (100327);perdrix (100327);
-        BnfDumpData('Zoologie-notices-descripteurs.csv', 'latin_1', "classes", ["classID"], DBOperationHelper.MULTI_RECORD, [1], ';',
-                    _descriptor_classe_csv_preprocess),
+        # the same class appears in many lines: classes are de-duplicated before being sent to the DB
+        BnfDumpData('Zoologie-notices-descripteurs.csv', 'latin_1', DBOperationHelper.MULTI_RECORD, ';', _descriptor_classe_csv_preprocess, [
+            BnfDumpTarget("descriptors", ["mandragoreID", "classID"], [0, 1], False),
+            BnfDumpTarget("classes", ["classID"], [1], True),
+        ]),
     ]
 
     def __init__(self, rootdir: str, persistance: PersistMandlagore):
@@ -117,7 +120,7 @@ class MandragoreDumpManager:
                 # need to warn the file is not processed
                 raise FileNotFoundError("Cannot import basic data as file {} is mising.".format(full_docname))
             query = SQLBuilder.build_insert_into_query_with_parameters(params["table"], params["fields"])
-            report, warnings = dbHelper.import_csv_file(full_docname, query, params["csv"], params["preprocess"])
+            report, warnings = dbHelper.import_csv_file(full_docname, query, params["csv"], params["preprocess"], params["table"])
             imported.append((doc, report, warnings))
         return imported
 
@@ -126,12 +129,15 @@ class MandragoreDumpManager:
 
         imported = []
         dbHelper = DBOperationHelper(self.persistance.conn)
-        for filename, encoding, tablename, fields, record_mode, columns, delim, transform in self.BNF_DUMP_DATA:
+        for filename, encoding, record_mode, delim, transform, targets in self.BNF_DUMP_DATA:
             full_docname = os.path.join(self.rootdir, filename)
             if not (os.path.exists(full_docname) and os.path.isfile(full_docname)):
                 # need to warn the file is not processed
                 raise FileNotFoundError("Cannot import basic data as file {} is mising.".format(full_docname))
-            query = SQLBuilder.build_insert_into_query_with_parameters(tablename, fields)
-            report, warnings = dbHelper.import_csv_mode_file(full_docname, query, encoding, delim, record_mode, columns, transform)
-            imported.append((filename, report, warnings))
+            import_targets = [
+                DBOperationHelper.ImportTarget(t.table, SQLBuilder.build_insert_into_query_with_parameters(t.table, t.fields), t.columns, t.distinct)
+                for t in targets
+            ]
+            for tablename, report, warnings in dbHelper.import_csv_mode_file_to_tables(full_docname, encoding, delim, record_mode, import_targets, transform):
+                imported.append((filename, report, warnings))
         return imported
@@ -0,0 +1,178 @@
+# Evaluation of the post-processing of the predictions of dh_segment, for a grid of params (see ornaments_postprocess)
+#
+# The boxes found in the predictions are compared with the scenes located in DB (the ground truth, read once for all the pages):
+# - a box matches a scene if their IoU is at least a cutoff, each box and each scene being matched once, the pairs of best IoU first
+# - precision is the part of the boxes found that match a scene, recall the part of the scenes matched by a box, for each IoU cutoff
+# Each worker process reads a chunk of pages, and evaluates all the params of the grid on each page: a map is read once, and the
+# masks shared by several params (same threshold, same threshold and opening) are computed once.
+
+from mdlg.persistence.db import PersistMandlagore
+from mdlg.services.ornaments_postprocess import load_probabilities, binarize, opening, closing, component_boxes, to_page, image_id_of, \
+    DEFAULT_PARAMS, MIN_AREA
+from mdlg.model.model import GalacticaURL
+from mdlg.model import geometry
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+import numpy as np
+import itertools
+import csv
+import os
+import click
+
+CUTOFFS = (0.5, 0.75, 0.9)
+DEFAULT_GRID = {'threshold': [-1, 0.3, 0.5, 0.7], 'ksize_open': [[0, 0], [5, 5], [10, 10]], 'ksize_close': [[0, 0], [5, 5], [10, 10]]}
+
+
+def _values(key: str, value) -> list:
+    # values of a key of a grid : a list of values, or a single value (a ksize being itself a list)
+    if key == 'threshold':
+        return value if isinstance(value, list) else [value]
+    return value if len(value) > 0 and isinstance(value[0], list) else [value]
+
+
+def param_grid(grid: dict) -> list:
+    # params of all the combinations of the values of the grid - the keys missing take their default value
+    unknown = sorted(set(grid) - set(DEFAULT_PARAMS))
+    if len(unknown) > 0:
+        raise ValueError("unknown params %s in the grid - the params are %s" % (", ".join(unknown), ", ".join(DEFAULT_PARAMS)))
+    grid = dict(DEFAULT_PARAMS, **grid)
+    return [dict(zip(grid.keys(), combination)) for combination in itertools.product(*(_values(k, v) for k, v in grid.items()))]
+
+
+def f1(precision: float, recall: float) -> float:
+    return 2 * precision * recall / (precision + recall) if precision + recall > 0 else 0.0
+
+
+def matched_ious(predicted: np.ndarray, truth: np.ndarray) -> np.ndarray:
+    # IoU of the pairs (box predicted, box of the truth) matched one to one, the pairs of best IoU first
+    # matching the pairs of IoU >= cutoff gives the same pairs as keeping the pairs of this matching with IoU >= cutoff
+    if len(predicted) == 0 or len(truth) == 0:
+        return np.empty(0)
+    ious = geometry.iou_matrix(predicted, truth)
+    order = np.argsort(-ious, axis=None, kind='stable')
+    order = order[ious.ravel()[order] > 0]
+    used_predicted = np.zeros(len(predicted), dtype=bool)
+    used_truth = np.zeros(len(truth), dtype=bool)
+    matched = []
+    for i, j in zip(*np.unravel_index(order, ious.shape)):
+        if not used_predicted[i] and not used_truth[j]:
+            used_predicted[i] = used_truth[j] = True
+            matched.append(ious[i, j])
+    return np.array(matched)
+
+
+def evaluate_pages(pages: list, grid: list, cutoffs, min_area: float) -> (np.ndarray, np.ndarray, int):
+    # run in a worker process : for each params of the grid, number of boxes matched at each cutoff (len(grid), len(cutoffs)),
+    # and number of boxes predicted (len(grid), ) - with the number of boxes of the truth
+    # pages : list of (prediction file, url of the page, size of the page, box array of the truth in pixels of the page)
+    cutoffs = np.asarray(cutoffs)
+    matched = np.zeros((len(grid), len(cutoffs)), dtype=np.int64)
+    predicted = np.zeros(len(grid), dtype=np.int64)
+    truth_count = 0
+    for filename, url, page_size, truth in pages:
+        probs = np.asarray(load_probabilities(filename), dtype=np.float32)
+        gal = GalacticaURL.from_url(url)
+        truth_count += len(truth)
+        masks, opened = {}, {}
+        for p, params in enumerate(grid):
+            threshold, ksize_open = params['threshold'], tuple(params['ksize_open'])
+            if threshold not in masks:
+                masks[threshold] = binarize(probs, threshold)
+            if (threshold, ksize_open) not in opened:
+                opened[(threshold, ksize_open)] = opening(masks[threshold], ksize_open)
+            boxes, areas, _ = component_boxes(closing(opened[(threshold, ksize_open)], params['ksize_close']))
+            boxes = to_page(boxes[areas >= min_area * probs.size], probs.shape, gal, page_size)
+            predicted[p] += len(boxes)
+            ious = matched_ious(boxes, truth)
+            matched[p] += (ious[:, None] >= cutoffs[None, :]).sum(axis=0)
+    return matched, predicted, truth_count
+
+
+class OrnamentsEvaluator:
+    RESULTS_FILENAME = 'eval.csv'
+    # pages evaluated by a worker process at once
+    CHUNK_SIZE = 8
+
+    def __init__(self, db: PersistMandlagore, grid: dict = None, cutoffs=CUTOFFS, min_area: float = MIN_AREA):
+        super().__init__()
+        self._db = db
+        self._grid = param_grid(grid if grid is not None else DEFAULT_GRID)
+        # the params sharing their threshold and opening are consecutive
+        self._grid.sort(key=lambda p: (p['threshold'], p['ksize_open'], p['ksize_close']))
+        self._cutoffs = tuple(cutoffs)
+        self._min_area = min_area
+
+    def _pages(self, filenames: list, skipped: list) -> list:
+        # arguments of evaluate_pages : the pages and the scenes located in them are read from DB at once
+        image_ids = [image_id_of(f) for f in filenames]
+        images = self._db.retrieve_images_by_ids(image_ids)
+        zones = self._db.retrieve_scene_zones(image_ids)
+        pages = []
+        for filename, imageID in zip(filenames, image_ids):
+            image = images.get(imageID)
+            if image is None or image['width'] is None or image['height'] is None:
+                skipped.append(filename)
+                continue
+            pages.append((filename, image['documentURL'], (image['width'], image['height']), geometry.as_boxes(zones.get(imageID, []))))
+        return pages
+
+    def evaluate(self, filenames: list, workers: int = None, skipped: list = None) -> list:
+        # precision and recall at each cutoff, for each params of the grid : list of dict, ordered as the grid
+        skipped = skipped if skipped is not None else []
+        pages = self._pages(filenames, skipped)
+        workers = workers or os.cpu_count() or 1
+        matched = np.zeros((len(self._grid), len(self._cutoffs)), dtype=np.int64)
+        predicted = np.zeros(len(self._grid), dtype=np.int64)
+        truth = 0
+        pending = {}
+        with ProcessPoolExecutor(max_workers=workers) as executor, \
+                click.progressbar(length=len(pages), label=f"Evaluate {len(self._grid)} params with {workers} processes") as bar:
+
+            def collect(done):
+                nonlocal truth
+                for f in done:
+                    m, p, t = f.result()
+                    matched[:] += m
+                    predicted[:] += p
+                    truth += t
+                    bar.update(pending.pop(f))
+
+            # at most 2 chunks per process are in flight
+            for start in range(0, len(pages), self.CHUNK_SIZE):
+                if len(pending) >= 2 * workers:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    collect(done)
+                chunk = pages[start:start + self.CHUNK_SIZE]
+                pending[executor.submit(evaluate_pages, chunk, self._grid, self._cutoffs, self._min_area)] = len(chunk)
+            done, _ = wait(pending)
+            collect(done)
+
+        precision = np.divide(matched, predicted[:, None], out=np.zeros(matched.shape), where=predicted[:, None] > 0)
+        recall = matched / truth if truth > 0 else np.zeros(matched.shape)
+        return [{
+            'params': params,
+            'predicted': int(predicted[p]),
+            'truth': truth,
+            'precision': dict(zip(self._cutoffs, precision[p].tolist())),
+            'recall': dict(zip(self._cutoffs, recall[p].tolist())),
+        } for p, params in enumerate(self._grid)]
+
+    def evaluate_dir(self, dirname: str, outname: str = None, workers: int = None) -> str:
+        # evaluate the grid on all the predictions of dirname, the results being written in outname (csv) - return a report
+        filenames = sorted(os.path.join(dirname, f) for f in os.listdir(dirname) if f.endswith('.npy') and image_id_of(f) is not None)
+        outname = outname or os.path.join(dirname, self.RESULTS_FILENAME)
+        skipped = []
+        results = self.evaluate(filenames, workers, skipped)
+        with open(outname, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['threshold', 'ksize_open', 'ksize_close', 'predicted', 'truth'] + ['precision@%g' % c for c in self._cutoffs] +
+                            ['recall@%g' % c for c in self._cutoffs])
+            for r in results:
+                params = r['params']
+                writer.writerow([params['threshold'], "x".join(map(str, params['ksize_open'])), "x".join(map(str, params['ksize_close'])), r['predicted'],
+                                 r['truth']] + ["%.4f" % r['precision'][c] for c in self._cutoffs] + ["%.4f" % r['recall'][c] for c in self._cutoffs])
+        cutoff = self._cutoffs[0]
+        best = max(results, key=lambda r: f1(r['precision'][cutoff], r['recall'][cutoff]))
+        return "%d params evaluated on %d predictions, written in %s, %d predictions skipped (page not in DB, or without size)\n" \
+               "best F1 at IoU %g : %s (precision %.3f, recall %.3f)" % (len(results), len(filenames) - len(skipped), outname, len(skipped), cutoff,
+                                                                       best['params'], best['precision'][cutoff], best['recall'][cutoff])
+
@@ -0,0 +1,261 @@
+# Post-processing of the predictions of dh_segment for the location of the scenes (as Ornaments does, see prediction.md)
+#
+# a prediction is a .npy map of probabilities (height, width), or (height, width, classes) - the scenes being the class SCENE_CLASS
+# for each map:
+# - the map is binarized with params['threshold'] (Otsu's threshold of the map when negative)
+# - a morphological opening with a rectangle of params['ksize_open'] (rows, columns) removes the small spots,
+#   then a closing with a rectangle of params['ksize_close'] fills the small holes
+# - the boxes of the connected components (8-connectivity) are extracted, with the mean probability of their pixels as score
+# - the boxes are mapped back to pixels of the full page, with the zone of the GalacticaURL predicted and the size of the page
+# All the steps are vectorized with NumPy: the morphology uses sliding sums, the connected components are built on the runs of pixels
+# of the rows. The maps are memory-mapped, and processed in a pool of processes.
+
+from mdlg.persistence.db import PersistMandlagore
+from mdlg.model.model import GalacticaURL, ZONE_FULL
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import re
+import os
+import csv
+import click
+
+SCENE_CLASS = 1
+DEFAULT_PARAMS = {'threshold': -1, 'ksize_open': [5, 5], 'ksize_close': [5, 5]}
+# components smaller than this part of the map are ignored
+MIN_AREA = 0.0
+
+PREDICTION_NAME = re.compile(r'IMG-(.+)_P-(\d+)')
+
+
+def load_probabilities(filename: str, channel: int = SCENE_CLASS) -> np.ndarray:
+    # map of probabilities of the scenes, memory-mapped : the file is read when the map is used
+    # for a map (height, width, classes), the channel is a strided view : all the channels are read with it
+    probs = np.load(filename, mmap_mode='r', allow_pickle=False)
+    return probs[..., channel] if probs.ndim == 3 else probs
+
+
+def otsu_threshold(probs: np.ndarray) -> np.ndarray:
+    # Otsu's threshold of each map of probabilities (..., height, width) - on 256 levels, returned as probabilities
+    levels = np.clip(np.asarray(probs) * 255, 0, 255).astype(np.int64)
+    batch = levels.reshape(-1, levels.shape[-2] * levels.shape[-1])
+    hist = np.bincount((batch + 256 * np.arange(len(batch))[:, None]).ravel(), minlength=256 * len(batch)).reshape(len(batch), 256)
+    p = hist / hist.sum(axis=1, keepdims=True)
+    omega = np.cumsum(p, axis=1)
+    mu = np.cumsum(p * np.arange(256), axis=1)
+    denominator = omega * (1 - omega)
+    between = np.divide((mu[:, -1:] * omega - mu) ** 2, denominator, out=np.zeros(denominator.shape), where=denominator > 0)
+    # the pixels above the level found are kept : the threshold is the upper bound of the level
+    return ((np.argmax(between, axis=1) + 1) / 255).reshape(levels.shape[:-2])
+
+
+def binarize(probs: np.ndarray, threshold: float) -> np.ndarray:
+    # mask of the pixels above threshold - with a negative threshold, the threshold of Otsu of each map
+    probs = np.asarray(probs)
+    if threshold < 0:
+        threshold = otsu_threshold(probs)[..., None, None]
+    return probs >= threshold if np.ndim(threshold) > 0 else probs > threshold
+
+
+def _window_sums(mask: np.ndarray, size: int, axis: int, fill: bool) -> np.ndarray:
+    # number of pixels set in the window of size pixels along axis (centered as opencv does), the borders being filled with fill
+    pad = [(0, 0)] * mask.ndim
+    pad[axis] = (size // 2, size - 1 - size // 2)
+    padded = np.pad(mask, pad, constant_values=fill)
+    sums = np.cumsum(padded, axis=axis, dtype=np.int32)
+    sums = np.concatenate([np.zeros_like(np.take(sums, [0], axis=axis)), sums], axis=axis)
+    n = mask.shape[axis]
+    return np.take(sums, np.arange(size, size + n), axis=axis) - np.take(sums, np.arange(n), axis=axis)
+
+
+def erode(mask: np.ndarray, ksize) -> np.ndarray:
+    # erosion of the masks (..., height, width) by a rectangle of ksize (rows, columns) - the rectangle is separable
+    for axis, size in zip((-2, -1), ksize):
+        if size > 1:
+            mask = _window_sums(mask, size, axis, True) == size
+    return mask
+
+
+def dilate(mask: np.ndarray, ksize) -> np.ndarray:
+    for axis, size in zip((-2, -1), ksize):
+        if size > 1:
+            mask = _window_sums(mask, size, axis, False) > 0
+    return mask
+
+
+def opening(mask: np.ndarray, ksize) -> np.ndarray:
+    return dilate(erode(mask, ksize), ksize)
+
+
+def closing(mask: np.ndarray, ksize) -> np.ndarray:
+    return erode(dilate(mask, ksize), ksize)
+
+
+def _runs(mask: np.ndarray) -> (np.ndarray, np.ndarray, np.ndarray):
+    # row, first column and last column + 1 of each run of pixels set in the rows of mask, in the order of the rows
+    padded = np.zeros((mask.shape[0], mask.shape[1] + 2), dtype=np.int8)
+    padded[:, 1:-1] = mask
+    steps = np.diff(padded, axis=1)
+    rows, starts = np.nonzero(steps == 1)
+    _, ends = np.nonzero(steps == -1)
+    return rows, starts, ends
+
+
+def _touching_runs(rows, starts, ends, width: int) -> (np.ndarray, np.ndarray):
+    # pairs (a, b) of runs touching each other (8-connectivity), b being on the row below a
+    # the runs of a row are ordered and disjoint : the runs below a run are a range of the runs, found by a search on sorted keys
+    stride = width + 2
+    start_keys, end_keys = rows * stride + starts, rows * stride + ends
+    below = (rows + 1) * stride
+    lo = np.searchsorted(end_keys, below + starts - 1, side='right')
+    hi = np.searchsorted(start_keys, below + ends + 1, side='left')
+    counts = np.maximum(hi - lo, 0)
+    a = np.repeat(np.arange(len(rows)), counts)
+    b = np.repeat(lo, counts) + np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    return a, b
+
+
+def _components(n: int, a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    # component of each of the n runs, from the pairs of runs touching each other : each run takes the smallest label of its pairs,
+    # and points to the label of its label (pointer jumping), until nothing changes
+    labels = np.arange(n)
+    while True:
+        smallest = np.minimum(labels[a], labels[b])
+        updated = labels.copy()
+        np.minimum.at(updated, a, smallest)
+        np.minimum.at(updated, b, smallest)
+        updated = updated[updated]
+        if np.array_equal(updated, labels):
+            return labels
+        labels = updated
+
+
+def component_boxes(mask: np.ndarray, probs: np.ndarray = None) -> (np.ndarray, np.ndarray, np.ndarray):
+    # box array (x, y, width, height) of the connected components of mask (8-connectivity), with their area in pixels,
+    # and the mean of probs on their pixels (None without probs) - ordered by the first pixel of the components
+    rows, starts, ends = _runs(mask)
+    if len(rows) == 0:
+        return np.empty((0, 4), dtype=np.int64), np.empty(0, dtype=np.int64), None if probs is None else np.empty(0)
+    labels = _components(len(rows), *_touching_runs(rows, starts, ends, mask.shape[1]))
+    _, component = np.unique(labels, return_inverse=True)
+    order = np.argsort(component, kind='stable')
+    first = np.flatnonzero(np.r_[True, np.diff(component[order]) > 0])
+    x0 = np.minimum.reduceat(starts[order], first)
+    x1 = np.maximum.reduceat(ends[order], first)
+    y0 = np.minimum.reduceat(rows[order], first)
+    y1 = np.maximum.reduceat(rows[order], first) + 1
+    lengths = ends - starts
+    areas = np.bincount(component, weights=lengths).astype(np.int64)
+    boxes = np.stack([x0, y0, x1 - x0, y1 - y0], axis=-1)
+    if probs is None:
+        return boxes, areas, None
+    # sums of probs on the runs, from the cumulated sums of the rows
+    cumulated = np.zeros((probs.shape[0], probs.shape[1] + 1))
+    np.cumsum(probs, axis=1, out=cumulated[:, 1:])
+    sums = cumulated[rows, ends] - cumulated[rows, starts]
+    return boxes, areas, np.bincount(component, weights=sums) / areas
+
+
+def post_process(probs: np.ndarray, params: dict = DEFAULT_PARAMS, min_area: float = MIN_AREA) -> (np.ndarray, np.ndarray):
+    # boxes (in pixels of the map) and scores of the scenes found in the map of probabilities
+    probs = np.asarray(probs, dtype=np.float32)
+    mask = binarize(probs, params.get('threshold', DEFAULT_PARAMS['threshold']))
+    mask = opening(mask, params.get('ksize_open', DEFAULT_PARAMS['ksize_open']))
+    mask = closing(mask, params.get('ksize_close', DEFAULT_PARAMS['ksize_close']))
+    boxes, areas, scores = component_boxes(mask, probs)
+    kept = areas >= min_area * probs.shape[0] * probs.shape[1]
+    return boxes[kept], scores[kept]
+
+
+def to_page(boxes: np.ndarray, map_shape, gal: GalacticaURL, page_size) -> np.ndarray:
+    # boxes in pixels of a map (height, width) of the image of gal, to pixels of the full page of page_size (width, height)
+    # the map covers the zone of gal, whatever the size requested
+    zone = gal.zone()
+    if zone == ZONE_FULL:
+        zone = {'x': 0, 'y': 0, 'width': page_size[0], 'height': page_size[1]}
+    scale = np.array([zone['width'] / map_shape[1], zone['height'] / map_shape[0]] * 2)
+    offset = np.array([zone['x'], zone['y'], 0, 0])
+    return np.rint(np.asarray(boxes) * scale + offset).astype(np.int64)
+
+
+def image_id_of(filename: str) -> str:
+    # imageID of the page of a prediction, named as the images of the training set (IMG-<document>_P-<page>) - None if not
+    match = PREDICTION_NAME.match(os.path.basename(filename))
+    return None if match is None else "%s-%s" % match.groups()
+
+
+def process_file(filename: str, params: dict, min_area: float) -> (np.ndarray, np.ndarray, tuple):
+    # run in a worker process : boxes (in pixels of the map), scores, and shape of the map of a prediction file
+    probs = load_probabilities(filename)
+    boxes, scores = post_process(probs, params, min_area)
+    return boxes, scores, probs.shape
+
+
+class OrnamentsPostProcessor:
+    BOXES_FILENAME = 'boxes.csv'
+    # maps sent to a worker process at once
+    CHUNK_SIZE = 16
+
+    def __init__(self, db: PersistMandlagore, params: dict = None, min_area: float = MIN_AREA):
+        super().__init__()
+        self._db = db
+        self._params = dict(DEFAULT_PARAMS, **(params or {}))
+        self._min_area = min_area
+
+    def list_predictions(self, dirname: str) -> list:
+        return sorted(os.path.join(dirname, f) for f in os.listdir(dirname) if f.endswith('.npy') and image_id_of(f) is not None)
+
+    def _pages(self, filenames: list, skipped: list) -> list:
+        # (filename, image) of the prediction files whose page is in DB with its size - the others are reported in skipped
+        images = self._db.retrieve_images_by_ids([image_id_of(f) for f in filenames])
+        pages = []
+        for filename in filenames:
+            image = images.get(image_id_of(filename))
+            if image is None or image['width'] is None or image['height'] is None:
+                if skipped is not None:
+                    skipped.append(filename)
+                continue
+            pages.append((filename, image))
+        return pages
+
+    def process(self, filenames: list, workers: int = None, skipped: list = None):
+        # iterator on (imageID, boxes in pixels of the full page, scores) of the prediction files
+        # the pages that are not in DB, or have no size, are reported in skipped before any file is processed
+        pages = self._pages(filenames, skipped)
+        return self._process_pages(pages, workers or os.cpu_count() or 1)
+
+    def _process_pages(self, pages: list, workers: int):
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = executor.map(process_file, [f for f, _ in pages], [self._params] * len(pages), [self._min_area] * len(pages),
+                                   chunksize=self.CHUNK_SIZE)
+            for (filename, image), (boxes, scores, shape) in zip(pages, results):
+                gal = GalacticaURL.from_url(image['documentURL'])
+                yield image['imageID'], to_page(boxes, shape, gal, (image['width'], image['height'])), scores
+
+    def process_dir(self, dirname: str, outname: str = None, workers: int = None, run: str = None) -> str:
+        # post-process all the predictions of dirname, the boxes being written in outname (csv) - return a report
+        # run : if defined, the boxes are also recorded in DB as the predictions of this run (replacing a previous run of the same id)
+        filenames = self.list_predictions(dirname)
+        outname = outname or os.path.join(dirname, self.BOXES_FILENAME)
+        skipped = []
+        with open(outname, 'w', newline='') as f, click.progressbar(length=len(filenames), label="Post-process predictions") as bar:
+            writer = csv.writer(f)
+            writer.writerow(('imageID', 'x', 'y', 'width', 'height', 'score'))
+
+            def rows():
+                results = self.process(filenames, workers, skipped)
+                bar.update(len(skipped))
+                for imageID, boxes, scores in results:
+                    for box, score in zip(boxes, scores):
+                        row = (imageID, ) + tuple(box.tolist()) + (round(float(score), 4), )
+                        writer.writerow(row)
+                        yield row
+                    bar.update(1)
+
+            if run is None:
+                count = sum(1 for _ in rows())
+            else:
+                self._db.add_prediction_run(run, self._params)
+                count = self._db.add_predictions(run, rows())
+        recorded = "" if run is None else " and recorded in DB as run %s" % run
+        return "%d boxes found in %d predictions, written in %s%s, %d predictions skipped (page not in DB, or without size)" % (
+            count, len(filenames) - len(skipped), outname, recorded, len(skipped))
@@ -0,0 +1,125 @@
+# Local pyramid of the pages: each page can be held at several zooms (pct of the full image), each level in its own file
+# - the levels held are the files recorded in image_files (whole pages only, not the crops)
+# - a level is derived locally from the smallest level held that is larger than it, without going to the network
+# - galactica is only requested when no level held is large enough
+# Levels are saved as IMG-<document>_P-<page>_Z-<zoom>.<format>, in the folder of the galactica images
+
+from mdlg.persistence.db import PersistMandlagore
+from mdlg.persistence.remoteHttp import GalacticaSession, is_complete_download, read_manifest, write_manifest, file_sha256, PARTIAL_SUFFIX
+from mdlg.model.model import GalacticaURL, ZONE_FULL
+from PIL import Image
+import math
+import os
+
+
+class LevelNotAvailable(Exception):
+    pass
+
+
+def level_filename(gal: GalacticaURL, zoom: int) -> str:
+    stem, ext = os.path.splitext(gal.as_filename())
+    return "%s_Z-%d%s" % (stem, zoom, ext)
+
+
+def level_size(full_size, zoom: int) -> (int, int):
+    # size in pixels of the page at zoom, rounded down as galactica does
+    return full_size[0] * zoom // 100, full_size[1] * zoom // 100
+
+
+class PyramidStore:
+    # zooms of the levels built - a request is served by the smallest of them that is large enough
+    ZOOMS = (5, 10, 20, 25, 50, 100)
+    JPEG_QUALITY = 90
+
+    def __init__(self, rootdir: str, db: PersistMandlagore, gal: GalacticaSession = None):
+        super().__init__()
+        self._rootdir = rootdir
+        self._db = db
+        self._gal = gal
+
+    def levels(self, imageID) -> list:
+        # image_files records of the levels held on disk for the image, from the largest to the smallest
+        levels = [f for f in self._db.retrieve_image_files(imageID) if f['zoom'] is not None and is_complete_download(self.filename(f))]
+        return sorted(levels, key=lambda f: f['zoom'], reverse=True)
+
+    def filename(self, image_file: dict) -> str:
+        return os.path.join(self._rootdir, image_file['path'])
+
+    def _full_size(self, image: dict, levels: list) -> (int, int):
+        # size of the full page : from DB, or deduced from a level held, or requested to galactica
+        if image['width'] is not None and image['height'] is not None:
+            return image['width'], image['height']
+        for f in levels:
+            if f['width'] is not None and f['height'] is not None:
+                return f['width'] * 100 // f['zoom'], f['height'] * 100 // f['zoom']
+        if self._gal is None:
+            raise LevelNotAvailable("size of image %s unknown" % image['imageID'])
+        w, h = self._gal.collect_image_size(image['documentURL'])
+        self._db.update_images([{'imageID': image['imageID'], 'width': w, 'height': h}])
+        return w, h
+
+    def zoom_for(self, full_size, min_size) -> int:
+        # smallest zoom of ZOOMS giving at least min_size (width, height - None for no constraint on one of them)
+        needed = 0
+        for full, minimum in zip(full_size, min_size):
+            if minimum is not None:
+                needed = max(needed, math.ceil(100 * minimum / full))
+        for zoom in self.ZOOMS:
+            if zoom >= needed and all(m is None or s >= m for s, m in zip(level_size(full_size, zoom), min_size)):
+                return zoom
+        return self.ZOOMS[-1]
+
+    def get(self, imageID, min_size=(None, None)) -> str:
+        # file of the smallest level of the image that is at least min_size (width, height) in pixels - built if not held yet
+        image = self._db.retrieve_image(imageID)
+        if image is None:
+            raise LevelNotAvailable("image %s is not in DB" % imageID)
+        levels = self.levels(imageID)
+        full_size = self._full_size(image, levels)
+        zoom = self.zoom_for(full_size, min_size)
+
+        for f in levels:
+            if f['zoom'] == zoom:
+                return self.filename(f)
+        larger = [f for f in levels if f['zoom'] > zoom]
+        if len(larger) > 0:
+            return self._derive(image, larger[-1], zoom, full_size)
+        return self._download(image, zoom, full_size)
+
+    def _record(self, image: dict, path: str, zoom: int, size) -> str:
+        filename = os.path.join(self._rootdir, path)
+        manifest = read_manifest(filename)
+        self._db.add_image_files([{
+            'path': path,
+            'imageID': image['imageID'],
+            'zoom': zoom,
+            'bytes': os.path.getsize(filename),
+            'width': size[0],
+            'height': size[1],
+            'sha256': manifest.get('sha256') if manifest is not None else None,
+        }])
+        return filename
+
+    def _derive(self, image: dict, source: dict, zoom: int, full_size) -> str:
+        # downscale the level source to zoom - the file is written as <filename>.part then renamed
+        size = level_size(full_size, zoom)
+        path = level_filename(GalacticaURL.from_url(image['documentURL']), zoom)
+        filename = os.path.join(self._rootdir, path)
+        partname = filename + PARTIAL_SUFFIX
+        with Image.open(self.filename(source)) as im:
+            fmt = im.format
+            # JPEG files are decoded at a reduced scale when possible : only the pixels needed are decoded
+            im.draft('RGB', size)
+            with im.resize(size, Image.LANCZOS) as level:
+                level.save(partname, fmt, quality=self.JPEG_QUALITY)
+        os.replace(partname, filename)
+        write_manifest(filename, {'url': None, 'source': source['path'], 'length': os.path.getsize(filename), 'sha256': file_sha256(filename).hexdigest()})
+        return self._record(image, path, zoom, size)
+
+    def _download(self, image: dict, zoom: int, full_size) -> str:
+        if self._gal is None:
+            raise LevelNotAvailable("no level of image %s at zoom %d or more, and no galactica session to download it" % (image['imageID'], zoom))
+        gal = GalacticaURL.from_url(image['documentURL']).set_zone(ZONE_FULL).set_size(zoom)
+        path = level_filename(gal, zoom)
+        self._gal.download_image(gal.as_url(), os.path.join(self._rootdir, path), None, False, False)
+        return self._record(image, path, zoom, level_size(full_size, zoom))
@@ -3,6 +3,7 @@ import os
 from mdlg.model.model import GalacticaURL, zone_in_zone_as_pct, ZONE_FULL
 import tempfile
 import click
+from concurrent.futures import ThreadPoolExecutor
 from mdlg.persistence.remoteHttp import CannotRetriveInformation
 
 # JSON_DATA_PATH = "/Users/francois/Documents/Mandragore/DetourageImages"
@@ -48,11 +49,11 @@ class ViaLabelManager:
     #       ...
     #  }
 
-    def __init__(self, rootdir, db, galactica):
+    def __init__(self, rootdir, db, galactica, workers: int = 4):
         self.rootdir = rootdir
         self.db = db
         self.galactica = galactica
-        pass
+        self.workers = workers
 
     def list_labeled_files(self) -> []:
         files = []
@@ -116,36 +117,55 @@ class ViaLabelManager:
 
         return {'mandragoreID': mandragore_id, 'documentURL': document_url, 'imageID': image_id, 'size': size_image, 'descriptors': descriptors}
 
-    def record_scenes(self, scenes, title='prepare scenes') -> str:
+    def _collect_image_size(self, url: str) -> ((int, int), str):
+        # the size, or the reason why it cannot be collected (once the retries of the galactica session are exhausted)
+        try:
+            return self.galactica.collect_image_size(url), None
+        except CannotRetriveInformation as cri:
+            return (None, None), str(cri)
+
+    def _collect_missing_sizes(self, urls: list) -> (dict, list):
+        # collect the sizes of all the urls concurrently - each url is requested once, even if shared by several scenes
+        # return the sizes by url (None, None for the sizes not collected) and the warnings on the sizes not collected
+        urls = list(set(urls))
+        if len(urls) == 0:
+            return {}, []
+        with ThreadPoolExecutor(max_workers=max(1, min(self.workers, len(urls)))) as executor:
+            results = dict(zip(urls, executor.map(self._collect_image_size, urls)))
+        warnings = ["size of image %s not collected. Reason : %s" % (url, error) for url, (size, error) in results.items() if error is not None]
+        return {url: size for url, (size, error) in results.items()}, warnings
+
+    def record_scenes(self, scenes, title='prepare scenes', warnings: list = None) -> str:
         # ensure to delete data tied to the corresponding 'mandragoreID'
         # then add
         #   - images's records
         #   - scene's records
         #   - descriptors's records
+        # the sizes of images that cannot be collected are reported in warnings (the images are recorded without size)
+
+        # prefetch : all the images of the scenes are read from DB at once, then the missing sizes are collected concurrently
+        images = self.db.retrieve_images_by_ids([sc['imageID'] for sc in scenes])
+        page_urls = [gal.set_zone(ZONE_FULL).as_url() for gal in GalacticaURL.parse_many([sc['documentURL'] for sc in scenes])]
+        # TODO - WARNING - we may have a side effect on location of scenes and descriptors if the initial image has been resized in VIA (eg pct:50)
+        sizes, size_warnings = self._collect_missing_sizes([
+            url for sc, url in zip(scenes, page_urls) if sc['imageID'] not in images or images[sc['imageID']]['width'] is None
+            or images[sc['imageID']]['height'] is None
+        ])
+        if warnings is not None:
+            warnings.extend(size_warnings)
 
         # build all lists of information needed to create the data related to the scenes
 
         mandragore_ids = set()
-        images_fields = []
+        images_fields = {}
         scene_fields = []
         descriptor_fields = []
-        with click.progressbar(scenes, label=title) as bar:
-            for sc in bar:
+        with click.progressbar(list(zip(scenes, page_urls)), label=title) as bar:
+            for sc, url in bar:
                 mandragore_ids.add(sc['mandragoreID'])
-                image = self.db.retrieve_image(sc['imageID'])
-                gal = GalacticaURL.from_url(sc['documentURL']).set_zone(ZONE_FULL)
-                # TODO - WARNING - we may have a side effect on location of scenes and descriptors if the initial image has been resized in VIA (eg pct:50)
-                if image is None or image['width'] is None or image['height'] is None:
-                    # need to retrieve the size of the image
-                    w, h = None, None
-                    try:
-                        w, h = self.galactica.collect_image_size(gal.as_url())
-                    except CannotRetriveInformation as cri:
-                        # TODO - Manage exception
-                        pass
-                    images_fields.append({'imageID': sc['imageID'], 'documentURL': gal.as_url(), 'width': w, 'height': h})
-                else:
-                    w, h = image['width'], image['height']
+                if url in sizes and sc['imageID'] not in images_fields:
+                    w, h = sizes[url]
+                    images_fields[sc['imageID']] = {'imageID': sc['imageID'], 'documentURL': url, 'width': w, 'height': h}
 
                 scene_info = {'mandragoreID': sc['mandragoreID'], 'imageID': sc['imageID']}
                 scene_info.update(sc['size'])
@@ -156,11 +176,14 @@ class ViaLabelManager:
                     desc_info.update(d['location'])
                     descriptor_fields.append(desc_info)
         try:
-            self.db.delete_mandragore_related(mandragore_ids)
-            self.db.ensure_images(images_fields)
-            self.db.add_scenes(scene_fields)
-            self.db.add_descriptors(descriptor_fields)
-            return "%d scenes imported in DB." % len(scenes)
+            # all the scenes are imported, or none
+            with self.db.batch():
+                self.db.delete_mandragore_related(mandragore_ids)
+                self.db.ensure_images(list(images_fields.values()))
+                self.db.add_scenes(scene_fields)
+                self.db.add_descriptors(descriptor_fields)
+            missing = " %d image sizes could not be collected." % len(size_warnings) if len(size_warnings) > 0 else ""
+            return "%d scenes imported in DB.%s" % (len(scenes), missing)
         except Exception as e:
             return "Was not able to import the %d scenes in DB. Reason : %s" % (len(scenes), str(e))
 
@@ -170,7 +193,7 @@ class ViaLabelManager:
         if len(files) > 0:
             for f in files:
                 scenes, warnings = self.load_one_labeled_file(f)
-                rep = self.record_scenes(scenes, f)
+                rep = self.record_scenes(scenes, f, warnings)
                 report.append((f, warnings, rep))
         else:
             report.append(("--NO FILE--", [], "No .json files found in %s" % self.rootdir))
@@ -0,0 +1,80 @@
+import unittest
+import tempfile
+import tarfile
+import json
+import csv
+import io
+import os
+from PIL import Image
+from mdlg.persistence.db import PersistMandlagore
+from mdlg.services.dataset_snapshot import DatasetSnapshot
+from mdlg.services.pyramid_store import PyramidStore
+from mdlg.services.classify_exporter import ClassifyExporter, read_shard, shard_name
+
+
+class TestClassifyExporter(unittest.TestCase):
+    def _fill(self, db, rootdir):
+        db.ensure_schema(True)
+        db.ensure_images([{
+            'imageID': '8470209-%d' % p,
+            'documentURL': 'https://gallica.bnf.fr/iiif/ark:/12148/btv1b8470209d/f%d/full/full/0/native.jpg' % p,
+            'width': 2000,
+            'height': 1000
+        } for p in range(1, 4)])
+        db.add_scenes([
+            {'mandragoreID': 1, 'imageID': '8470209-1', 'x': 1000, 'y': 0, 'width': 1000, 'height': 500},
+            {'mandragoreID': 2, 'imageID': '8470209-2', 'x': 0, 'y': 0, 'width': 1000, 'height': 1000},
+            {'mandragoreID': 3, 'imageID': '8470209-3', 'x': 0, 'y': 0, 'width': 1000, 'height': 1000},
+        ])
+        db.add_descriptors([
+            {'mandragoreID': 1, 'classID': 'dog', 'x': 0, 'y': 0, 'width': 500, 'height': 250},
+            {'mandragoreID': 1, 'classID': 'lion', 'x': 500, 'y': 250, 'width': 500, 'height': 250},
+            {'mandragoreID': 1, 'classID': 'unknown'},
+            {'mandragoreID': 2, 'classID': 'dog', 'x': 0, 'y': 0, 'width': 100, 'height': 100},
+            {'mandragoreID': 3, 'classID': 'dog', 'x': 0, 'y': 0, 'width': 100, 'height': 100},
+        ])
+        # pages 1 and 2 are downloaded at 20%, page 3 is not downloaded
+        for p in (1, 2):
+            path = 'IMG-8470209_P-%d_Z-20.jpg' % p
+            with Image.new('RGB', (400, 200), (255, 255, 255)) as im:
+                # the lower right quarter of the scene of page 1 is red
+                im.paste((255, 0, 0), (300, 50, 400, 100))
+                im.save(os.path.join(rootdir, path))
+            db.add_image_files([{'path': path, 'imageID': '8470209-%d' % p, 'zoom': 20, 'width': 400, 'height': 200}])
+
+    def test_export(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            outdir = os.path.join(tmpdir, 'classify')
+            os.makedirs(outdir)
+            # a shard left by a previous export is removed
+            open(os.path.join(outdir, shard_name(7)), 'w').close()
+            with PersistMandlagore(os.path.join(tmpdir, 'mdlg-test.db')) as db:
+                self._fill(db, tmpdir)
+                exporter = ClassifyExporter(outdir, DatasetSnapshot.from_db(db), PyramidStore(tmpdir, db), max_side=50, shard_size=2)
+                self.assertEqual(5, exporter.count_samples())
+                report = exporter.export(workers=2)
+
+            self.assertEqual("3 crops exported in 2 shards in %s, 1 pages skipped (no file downloaded)" % outdir, report)
+            self.assertEqual(['classify-000000.tar', 'classify-000001.tar', 'index.json', 'samples.csv'], sorted(os.listdir(outdir)))
+            with open(os.path.join(outdir, 'index.json')) as f:
+                index = json.load(f)
+            self.assertEqual(3, index['count'])
+            self.assertEqual({'dog': 2, 'lion': 1}, index['classes'])
+            self.assertEqual([{'dog': 1, 'lion': 1}, {'dog': 1}], [s['histogram'] for s in index['shards']])
+
+            crops = list(read_shard(os.path.join(outdir, shard_name(0))))
+            self.assertEqual([('8470209-1_D-0', 'dog'), ('8470209-1_D-1', 'lion')], [(k, c) for k, _, c in crops])
+            with Image.open(io.BytesIO(crops[1][1])) as im:
+                self.assertEqual((50, 25), im.size)
+                r, g, b = im.getpixel((25, 12))
+                self.assertTrue(r > 200 and g < 50 and b < 50)
+
+            # the offsets of the index give a direct access to the crops
+            with open(os.path.join(outdir, 'samples.csv'), newline='') as f:
+                samples = list(csv.DictReader(f))
+            self.assertEqual(['8470209-1_D-0', '8470209-1_D-1', '8470209-2_D-3'], [s['key'] for s in samples])
+            with open(os.path.join(outdir, samples[1]['shard']), 'rb') as f:
+                f.seek(int(samples[1]['offset']))
+                self.assertEqual(crops[1][1], f.read(int(samples[1]['size'])))
+            with tarfile.open(os.path.join(outdir, shard_name(1))) as tar:
+                self.assertEqual(['8470209-2_D-3.jpg', '8470209-2_D-3.cls'], tar.getnames())
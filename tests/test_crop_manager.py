@@ -0,0 +1,74 @@
+import unittest
+import unittest.mock
+import tempfile
+import os
+from PIL import Image
+from mdlg.persistence.db import PersistMandlagore
+from mdlg.persistence.remoteHttp import GalacticaSession
+from mdlg.model.model import GalacticaURL
+from mdlg.services.crop_manager import CropsManager
+
+IMAGES = [{
+    'imageID': '8470209-%d' % p,
+    'documentURL': 'https://gallica.bnf.fr/iiif/ark:/12148/btv1b8470209d/f%d/full/full/0/native.jpg' % p
+} for p in range(1, 4)]
+
+SCENES = [
+    {'mandragoreID': 1, 'imageID': '8470209-1', 'x': 10, 'y': 10, 'width': 50, 'height': 40},
+    {'mandragoreID': 2, 'imageID': '8470209-1', 'x': 40, 'y': 30, 'width': 30, 'height': 30},
+    {'mandragoreID': 3, 'imageID': '8470209-1', 'x': 200, 'y': 200, 'width': 20, 'height': 20},
+    {'mandragoreID': 4, 'imageID': '8470209-2', 'x': 0, 'y': 0, 'width': 150, 'height': 70},
+    {'mandragoreID': 5, 'imageID': '8470209-3'},
+]
+
+
+def fake_download(url, filename, titlebar=None, dryrun=False, progress=True):
+    # the region requested, filled with a color depending on its position
+    zone = GalacticaURL.from_url(url).zone()
+    Image.new('RGB', (zone['width'], zone['height']), (zone['x'] % 256, zone['y'] % 256, 0)).save(filename, 'JPEG')
+
+
+class TestCropsManager(unittest.TestCase):
+    def test_ensure_crop_images(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            with PersistMandlagore(os.path.join(tmpdir, 'mdlg-test.db')) as db, GalacticaSession() as gal:
+                db.ensure_schema(True)
+                db.ensure_images(IMAGES)
+                db.add_scenes(SCENES)
+                gal.download_image = unittest.mock.Mock(side_effect=fake_download)
+                cmgr = CropsManager(tmpdir, db, gal, tile_size=64)
+                report = cmgr.ensure_crop_images([], workers=2)
+
+                # overlapping scenes of page 1 are merged, the region of page 2 is fetched as 3x2 tiles, page 3 has no located scene
+                self.assertEqual("3 crops recorded - 8 requests sent", report[:report.index(', ')])
+                recorded = db.conn.execute("SELECT imageID, zoom, width, height, region FROM image_files ORDER BY imageID, region").fetchall()
+                self.assertEqual([('8470209-1', 100, 60, 50, '10,10,60,50'), ('8470209-1', 100, 20, 20, '200,200,20,20'),
+                                  ('8470209-2', 100, 150, 70, '0,0,150,70')], recorded)
+
+                crop = os.path.join(tmpdir, 'crops', 'IMG-8470209_P-2_R-0-0-150-70.jpg')
+                with Image.open(crop) as im:
+                    self.assertEqual((150, 70), im.size)
+                    r, g, b = im.getpixel((130, 65))
+                    self.assertTrue(abs(r - 128) < 8 and abs(g - 64) < 8)
+                self.assertEqual(['IMG-8470209_P-1_R-10-10-60-50.jpg', 'IMG-8470209_P-1_R-200-200-20-20.jpg', 'IMG-8470209_P-2_R-0-0-150-70.jpg'],
+                                 sorted(f for f in os.listdir(os.path.join(tmpdir, 'crops')) if f.endswith('.jpg')))
+
+                # crops already there are not downloaded again
+                gal.download_image.reset_mock()
+                self.assertEqual("3 crops recorded - 0 requests sent", cmgr.ensure_crop_images([])[:34])
+                gal.download_image.assert_not_called()
+
+                # images downloaded at zoom 20 are still considered missing, whatever the crops recorded
+                ids, count = db.retrieve_images(('imageID', ), [], missing_zoom=100)
+                self.assertEqual(3, count)
+
+    def test_regions_clipped(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            with PersistMandlagore(os.path.join(tmpdir, 'mdlg-test.db')) as db:
+                db.ensure_schema(True)
+                db.ensure_images([dict(IMAGES[0], width=210, height=300), IMAGES[1]])
+                db.add_scenes(SCENES[:4] + [{'mandragoreID': 6, 'imageID': '8470209-1', 'x': 250, 'y': 0, 'width': 20, 'height': 20}])
+                regions = [(id, region) for id, _, region in CropsManager(tmpdir, db, None)._regions([])]
+
+        # the regions of page 1 are clipped to its size, the scene outside the page is dropped - page 2 has no size
+        self.assertEqual([('8470209-1', (10, 10, 60, 50)), ('8470209-1', (200, 200, 10, 20)), ('8470209-2', (0, 0, 150, 70))], sorted(regions))
@@ -0,0 +1,54 @@
+import unittest
+import tempfile
+import os
+from mdlg.persistence.db import PersistMandlagore
+from mdlg.services.dataset_snapshot import DatasetSnapshot, NULL_VALUE
+
+
+class TestDatasetSnapshot(unittest.TestCase):
+    def _fill(self, db):
+        db.ensure_schema(True)
+        db.ensure_images([{'imageID': 'doc-%d' % i, 'documentURL': 'http://localhost/%d' % i, 'width': 100 * i, 'height': None} for i in range(1, 4)])
+        db.add_scenes([
+            {'mandragoreID': 12, 'imageID': 'doc-3', 'x': 1, 'y': 2, 'width': 3, 'height': 4},
+            {'mandragoreID': 10, 'imageID': 'doc-1'},
+            {'mandragoreID': 11, 'imageID': 'doc-3', 'x': 5, 'y': 6, 'width': 7, 'height': 8},
+            {'mandragoreID': 13, 'imageID': 'unknown'},
+        ])
+        db.add_descriptors([
+            {'mandragoreID': 11, 'classID': 'lion', 'x': 0, 'y': 0, 'width': 1, 'height': 1},
+            {'mandragoreID': 11, 'classID': 'dog', 'x': 1, 'y': 1, 'width': 2, 'height': 2},
+            {'mandragoreID': 12, 'classID': 'dog'},
+            # mandragoreIDs are not always numbers
+            {'mandragoreID': 'M-20', 'classID': 'lion'},
+            {'mandragoreID': 9, 'classID': 'lion'},
+        ])
+
+    def test_snapshot(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            with PersistMandlagore(os.path.join(tmpdir, 'mdlg-test.db')) as db:
+                self._fill(db)
+                snapshot = DatasetSnapshot.from_db(db)
+
+            dirname = os.path.join(tmpdir, 'snapshot')
+            snapshot.save(dirname)
+            for s in (snapshot, DatasetSnapshot.load(dirname)):
+                self.assertEqual(['doc-1', 'doc-2', 'doc-3'], list(s.image_ids))
+                self.assertEqual(['dog', 'lion'], list(s.class_ids))
+                self.assertEqual(['10', '11', '12', '13', '9', 'M-20'], list(s.mandragore_ids))
+                self.assertEqual([100, 200, 300], list(s.images['width']))
+                self.assertEqual([NULL_VALUE] * 3, list(s.images['height']))
+                self.assertEqual([0, 1, 1, 3], list(s.scene_offsets))
+
+                doc3 = s.scenes_of(s.image_code('doc-3'))
+                self.assertEqual(['11', '12'], [s.mandragore_ids[m] for m in doc3['mandragore']])
+                self.assertEqual([5, 1], list(doc3['x']))
+                self.assertEqual(0, len(s.scenes_of(s.image_code('doc-2'))))
+                self.assertEqual(NULL_VALUE, s.image_code('unknown'))
+
+                descriptors = s.descriptors_of(doc3['mandragore'][0])
+                self.assertEqual(['dog', 'lion'], [s.class_ids[c] for c in descriptors['cls']])
+                self.assertEqual([1, 0], list(descriptors['x']))
+                self.assertEqual(0, len(s.descriptors_of(s.scenes_of(0)['mandragore'][0])))
+                self.assertEqual([0, 0, 2, 3, 3, 4, 5], list(s.descriptor_offsets))
+                self.assertEqual(['9', 'M-20'], [s.mandragore_ids[m] for m in s.descriptors['mandragore'][3:]])
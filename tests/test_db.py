@@ -1,6 +1,10 @@
 import unittest
+import unittest.mock
 import tempfile
-from mdlg.persistence.db import PersistMandlagore, SQLBuilder, DBException
+import os
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from mdlg.persistence.db import PersistMandlagore, SQLBuilder, DBException, DBOperationHelper, SCHEMA_VERSION, list_migrations
 
 
 class TestDB(unittest.TestCase):
@@ -41,6 +45,200 @@ class TestDB(unittest.TestCase):
             self.assertTrue(len(data), 1)
             self.assertEqual(data, IMAGE_UPDATED)
 
+    def test_retrieve_images_by_ids(self):
+        IMAGES = [{'imageID': 'doc-%d' % i, 'documentURL': 'http://localhist:8080/%d' % i, 'width': i, 'height': 2 * i} for i in range(1, 6)]
+        tmp = tempfile.NamedTemporaryFile(suffix='db', prefix='tmp-mdlg')
+        with PersistMandlagore(tmp.name) as db:
+            db.ensure_schema(rebuilt=True)
+            db.ensure_images(IMAGES)
+            db.MAX_QUERY_PARAMETERS = 2
+
+            images = db.retrieve_images_by_ids(['doc-1', 'doc-3', 'doc-5', 'doc-3', 'unknown'])
+            self.assertEqual({'doc-1', 'doc-3', 'doc-5'}, set(images.keys()))
+            self.assertEqual(IMAGES[2], images['doc-3'])
+
+    def test_iter_images(self):
+        IMAGES = [{'imageID': 'doc-%d' % i, 'documentURL': 'http://localhist:8080/%d' % i} for i in range(1, 8)]
+        # 2 scenes on doc-2 : the image must be returned once
+        SCENES = [{'mandragoreID': m, 'imageID': i, 'width': 10, 'height': 10} for m, i in [(1, 'doc-2'), (2, 'doc-2'), (3, 'doc-4'), (4, 'doc-7')]]
+        tmp = tempfile.NamedTemporaryFile(suffix='db', prefix='tmp-mdlg')
+        with PersistMandlagore(tmp.name) as db:
+            db.ensure_schema(rebuilt=True)
+            db.ensure_images(IMAGES)
+            db.add_scenes(SCENES)
+
+            ids = [r[0] for r in db.iter_images(('documentURL', ), [], arraysize=3)]
+            self.assertEqual(['http://localhist:8080/%d' % i for i in range(1, 8)], ids)
+            ids = [r[0] for r in db.iter_images(('imageID', ), [('scenes', 'localized', None)], arraysize=1)]
+            self.assertEqual(['doc-2', 'doc-4', 'doc-7'], ids)
+            ids = [r[0] for r in db.iter_images(('imageID', ), [], limit=5, arraysize=2)]
+            self.assertEqual(['doc-%d' % i for i in range(1, 6)], ids)
+
+            self.assertEqual(3, db.count_images([('scenes', 'localized', None)]))
+            self.assertEqual(7, db.count_images([('scenes', 'localized', None)], estimate=True))
+            self.assertEqual(2, db.count_images([('scenes', 'localized', None)], limit=2))
+
+            # the arraysize of retrieve_images is the one of its stream : 4 pages of at most 2 rows, after the count
+            with unittest.mock.patch.object(db, '_read', wraps=db._read) as read:
+                rows, count = db.retrieve_images(('imageID', ), [], arraysize=2)
+                self.assertEqual(7, len(list(rows)))
+                self.assertEqual(1 + 4, read.call_count)
+
+    def test_batch(self):
+        IMAGES = [{'imageID': 'doc-%d' % i, 'documentURL': 'http://localhist:8080/%d' % i} for i in range(1, 6)]
+        tmp = tempfile.NamedTemporaryFile(suffix='db', prefix='tmp-mdlg')
+        with PersistMandlagore(tmp.name) as db:
+            db.ensure_schema(rebuilt=True)
+
+            # atomic batch : nothing is written if an exception is raised
+            with self.assertRaises(ValueError):
+                with db.batch():
+                    db.ensure_images(IMAGES[:2])
+                    with db.batch():
+                        db.ensure_images(IMAGES[2:])
+                    self.assertTrue(db.conn.in_transaction)
+                    raise ValueError()
+            self.assertEqual(0, db.conn.execute("SELECT COUNT(*) FROM images").fetchone()[0])
+
+            # commit each time the threshold is reached, and at the end even if an exception is raised
+            with self.assertRaises(ValueError):
+                with db.batch(max_operations=2):
+                    db.ensure_images(IMAGES[:1])
+                    self.assertTrue(db.conn.in_transaction)
+                    db.ensure_images(IMAGES[1:2])
+                    self.assertFalse(db.conn.in_transaction)
+                    db.ensure_images(IMAGES[2:])
+                    raise ValueError()
+            self.assertEqual(5, db.conn.execute("SELECT COUNT(*) FROM images").fetchone()[0])
+
+    def test_readers(self):
+        IMAGES = [{'imageID': 'doc-%d' % i, 'documentURL': 'http://localhist:8080/%d' % i} for i in range(1, 6)]
+        with tempfile.TemporaryDirectory() as tmpdir:
+            with PersistMandlagore(os.path.join(tmpdir, 'mdlg-test.db')) as db:
+                db.ensure_schema(rebuilt=True)
+                self.assertEqual('wal', db.conn.execute("PRAGMA journal_mode").fetchone()[0])
+                db.ensure_images(IMAGES[:2])
+
+                def count():
+                    with db.reader() as conn:
+                        return conn.execute("SELECT COUNT(*) FROM images").fetchone()[0]
+
+                # readers see the committed data, and are not blocked by a running write transaction
+                with db.batch():
+                    db.ensure_images(IMAGES[2:])
+                    with ThreadPoolExecutor(max_workers=3) as executor:
+                        self.assertEqual([2] * 6, list(executor.map(lambda _: count(), range(6))))
+                    # the images are streamed on the readers too
+                    self.assertEqual(['doc-1', 'doc-2'], [r[0] for r in db.iter_images(('imageID', ), [])])
+                self.assertEqual(5, count())
+                with self.assertRaises(sqlite3.OperationalError):
+                    with db.reader() as conn:
+                        conn.execute("DELETE FROM images")
+
+    SCHEMA_V1 = '''
+        CREATE TABLE config (version INTEGER);
+        CREATE TABLE images (imageID TEXT, documentURL TEXT, width INTEGER, height INTEGER);
+        CREATE UNIQUE INDEX pk_images ON images (imageID);
+        CREATE TABLE classes (classID TEXT, superclassID TEXT, label TEXT);
+        CREATE UNIQUE INDEX pk_classes ON classes (classID ASC);
+        CREATE TABLE mandragores (mandragoreID INTEGER, description TEXT);
+        CREATE TABLE scenes (mandragoreID INTEGER, imageID TEXT, x INTEGER, y INTEGER, width INTEGER, height INTEGER);
+        CREATE UNIQUE INDEX pk_scenes ON scenes (mandragoreID, imageID, x, y);
+        CREATE INDEX fk_scenes_mandragores ON mandragores (mandragoreID ASC);
+        CREATE INDEX fk_scenes_images ON scenes (imageID ASC);
+        CREATE TABLE descriptors (mandragoreID INTEGER, classID TEXT, x INTEGER, y INTEGER, width INTEGER, height INTEGER);
+        CREATE UNIQUE INDEX pk_descriptors ON descriptors (mandragoreID, classID);
+        CREATE INDEX fk_descriptors_mandragores ON mandragores (mandragoreID ASC);
+        CREATE INDEX fk_descriptors_classes ON classes (classID ASC);
+        INSERT INTO config VALUES (1);
+        INSERT INTO images VALUES ('doc-1', 'http://localhist:8080/1', 10, 20);
+        INSERT INTO scenes VALUES (1, 'doc-1', NULL, NULL, NULL, NULL);
+        INSERT INTO descriptors VALUES (1, 'dog', 1, 2, 3, 4);
+        INSERT INTO classes VALUES ('dog', NULL, NULL);
+        '''
+
+    def test_migrate_schema_v1(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            with PersistMandlagore(os.path.join(tmpdir, 'mdlg-test.db')) as db:
+                db.conn.executescript(self.SCHEMA_V1)
+                self.assertEqual(1, db.schema_version())
+
+                self.assertEqual(SCHEMA_VERSION, db.ensure_schema(rebuilt=False))
+                self.assertEqual(SCHEMA_VERSION, db.conn.execute("SELECT version FROM config").fetchone()[0])
+                self.assertEqual({'imageID': 'doc-1', 'documentURL': 'http://localhist:8080/1', 'width': 10, 'height': 20}, db.retrieve_image('doc-1'))
+                self.assertEqual([(1, 'dog', 1, 2, 3, 4)], db.conn.execute("SELECT * FROM descriptors").fetchall())
+                self.assertTrue(db.has_table('image_files'))
+                for table in ('images', 'classes', 'descriptors', 'image_files'):
+                    sql = db.conn.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = ?", (table, )).fetchone()[0]
+                    self.assertIn('WITHOUT ROWID', sql)
+
+                # the join from images to descriptors does not scan descriptors any more
+                sql, params = SQLBuilder.build_filtered_query('images', ['imageID'], [('descriptors', 'classID', 'dog')])
+                plan = " ".join(r[-1] for r in db.conn.execute("EXPLAIN QUERY PLAN " + sql, params))
+                self.assertNotIn("SCAN descriptors", plan)
+
+    def test_migrations(self):
+        self.assertEqual(SCHEMA_VERSION, list_migrations()[-1][0])
+        with tempfile.TemporaryDirectory() as tmpdir:
+            with PersistMandlagore(os.path.join(tmpdir, 'mdlg-test.db')) as db:
+                self.assertIsNone(db.schema_version())
+                db.conn.executescript(self.SCHEMA_V1)
+                self.assertEqual(list(range(2, SCHEMA_VERSION + 1)), db.migrate())
+                self.assertEqual([], db.migrate())
+                self.assertEqual(SCHEMA_VERSION, db.ensure_schema(rebuilt=False))
+
+                # a failing migration leaves the DB in the version of the last migration applied
+                migrations = os.path.join(tmpdir, 'migrations')
+                os.mkdir(migrations)
+                with open(os.path.join(migrations, '%04d_ok.sql' % (SCHEMA_VERSION + 1)), 'w') as f:
+                    f.write("CREATE TABLE t3 (a INTEGER);")
+                with open(os.path.join(migrations, '%04d_ko.sql' % (SCHEMA_VERSION + 2)), 'w') as f:
+                    f.write("CREATE TABLE t4 (a INTEGER);\nINSERT INTO missing VALUES (1);")
+                with self.assertRaises(sqlite3.OperationalError):
+                    db.migrate(SCHEMA_VERSION + 2, migrations)
+                self.assertEqual(SCHEMA_VERSION + 1, db.schema_version())
+                self.assertTrue(db.has_table('t3'))
+                self.assertFalse(db.has_table('t4'))
+
+    def test_predictions(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            with PersistMandlagore(os.path.join(tmpdir, 'mdlg-test.db')) as db:
+                db.ensure_schema(rebuilt=True)
+                db.PREDICTIONS_BATCH = 2
+                db.add_prediction_run('old', {'threshold': -1})
+                self.assertEqual(4, db.add_predictions('old', iter([
+                    ('doc-1', 0, 0, 100, 100, 0.9),
+                    ('doc-1', 200, 200, 100, 100, 0.8),
+                    ('doc-1', 500, 500, 10, 10, 0.5),
+                    ('doc-2', 0, 0, 100, 100, 0.9),
+                ])))
+                db.add_prediction_run('new')
+                db.add_predictions('new', [
+                    ('doc-1', 0, 0, 100, 100, 0.95),  # same box
+                    ('doc-1', 210, 200, 100, 100, 0.8),  # moved, IoU 0.82
+                    ('doc-1', 260, 200, 100, 100, 0.7),  # overlaps the box moved, IoU 0.25
+                    ('doc-3', 0, 0, 100, 100, 0.9),
+                ])
+                self.assertEqual({'old', 'new'}, {r['runID'] for r in db.retrieve_prediction_runs()})
+                self.assertEqual(['{"threshold": -1}'], [r['params'] for r in db.retrieve_prediction_runs() if r['runID'] == 'old'])
+
+                diff = db.diff_predictions('old', 'new', 0.5)
+                self.assertEqual([('doc-1', 260, 200, 100, 100, 0.7), ('doc-3', 0, 0, 100, 100, 0.9)], diff['added'])
+                self.assertEqual([('doc-1', 500, 500, 10, 10, 0.5), ('doc-2', 0, 0, 100, 100, 0.9)], diff['removed'])
+                self.assertEqual([('doc-1', 200, 200, 100, 100, 210, 200, 100, 100)], [m[:-1] for m in diff['moved']])
+                self.assertAlmostEqual(90 / 110, diff['moved'][0][-1])
+                # the box moved is matched once, to its best match
+                self.assertEqual([('doc-1', 200, 200, 100, 100, 210, 200, 100, 100)], [m[:-1] for m in db.diff_predictions('old', 'new', 0.2)['moved']])
+                # a box that is in both runs is not moved
+                self.assertEqual([], [m for m in db.diff_predictions('old', 'new', 0.0)['moved'] if m[1:3] == (0, 0)])
+
+                # a run recorded again replaces its predictions
+                db.add_prediction_run('new')
+                self.assertEqual(4, len(db.diff_predictions('old', 'new')['removed']))
+
+                plan = " ".join(r[-1] for r in db.conn.execute("EXPLAIN QUERY PLAN SELECT * FROM predictions WHERE runID = ? AND imageID = ?", ('a', 'b')))
+                self.assertIn("USING PRIMARY KEY", plan)
+
 
 class TestSQLHelper(unittest.TestCase):
     def test_find_path(self):
@@ -64,6 +262,16 @@ class TestSQLHelper(unittest.TestCase):
                 set(exp_paths),
             )
 
+    def test_build_join(self):
+        join = SQLBuilder.build_join('images', ['descriptors', 'scenes', 'images'])
+        self.assertEqual(
+            "images JOIN scenes ON (scenes.imageID = images.imageID) JOIN mandragores ON (scenes.mandragoreID = mandragores.mandragoreID)"
+            " JOIN descriptors ON (descriptors.mandragoreID = mandragores.mandragoreID)", join)
+        self.assertEqual(join, SQLBuilder.build_join('images', ['scenes', 'descriptors']))
+        self.assertEqual("image_files JOIN images ON (image_files.imageID = images.imageID)", SQLBuilder.build_join('image_files', ['images']))
+        with self.assertRaises(DBException):
+            SQLBuilder.build_join('images', ['config'])
+
     def test_build_filtered_query(self):
 
         TEST = {
@@ -91,8 +299,67 @@ class TestSQLHelper(unittest.TestCase):
             self.assertIsNotNone(version)
 
             for k, ts in TEST.items():
-                sql = SQLBuilder.build_filtered_query('images', '*', ts[0], limit=None)
+                sql, params = SQLBuilder.build_filtered_query('images', '*', ts[0], limit=None)
                 try:
-                    db.conn.execute(sql)
+                    db.conn.execute(sql, params)
                 except Exception as e:
                     self.fail("%s - query %s failed : %s " % (k, sql, str(e)))
+
+    def test_build_filtered_query_parameters(self):
+        IMAGES = [{'imageID': 'doc-%d' % i, 'documentURL': 'http://localhist:8080/%d' % i, 'height': i} for i in range(1, 101)]
+        tmp = tempfile.NamedTemporaryFile(suffix='db', prefix='tmp-mdlg')
+        with PersistMandlagore(tmp.name) as db:
+            db.ensure_schema(rebuilt=True)
+            db.ensure_images(IMAGES)
+
+            sql1, params1 = SQLBuilder.build_filtered_query('images', ['imageID'], [('images', 'ID', 'doc-1'), ('images', 'height', 1)])
+            sql2, params2 = SQLBuilder.build_filtered_query('images', ['imageID'], [('images', 'ID', '"doc-2"'), ('images', 'height', 2)])
+            self.assertEqual(sql1, sql2)
+            self.assertNotIn('doc-', sql1)
+            self.assertEqual(['doc-2', 2], params2)
+            self.assertEqual([('doc-2', )], db.conn.execute(sql2, params2).fetchall())
+
+            # a long list is bound as one parameter
+            ids = ['doc-%d' % i for i in range(1, 100, 2)] + ['doc-%d' % i for i in range(2, 30, 2)]
+            sql, params = SQLBuilder.build_filtered_query('images', ['imageID'], [('images', 'ID:list', ids)])
+            self.assertEqual(1, len(params))
+            self.assertEqual(len(ids), len(db.conn.execute(sql, params).fetchall()))
+            sql_short, params = SQLBuilder.build_filtered_query('images', ['imageID'], [('images', 'ID:list', ids[:3])])
+            self.assertEqual(3, len(params))
+            self.assertEqual(3, len(db.conn.execute(sql_short, params).fetchall()))
+
+            # without JSON1, a long list is bound as a list of placeholders, padded to a multiple of IN_LIST_MAX
+            sql_in, params = SQLBuilder.build_filtered_query('images', ['imageID'], [('images', 'ID:list', ids)], json_lists=False)
+            self.assertNotIn('json_each', sql_in)
+            self.assertEqual(2 * SQLBuilder.IN_LIST_MAX, len(params))
+            self.assertEqual(sorted(ids), sorted(r[0] for r in db.conn.execute(sql_in, params).fetchall()))
+            self.assertTrue(db.json_lists)
+            db.json_lists = False
+            rows, count = db.retrieve_images(('imageID', ), [('images', 'ID:list', ids[:60])])
+            self.assertEqual(sorted(ids[:60]), sorted(r[0] for r in rows))
+            self.assertEqual(60, count)
+
+
+class TestDBOperationHelper(unittest.TestCase):
+    def test_import_csv_mode_file_reports_failing_rows(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            datafile = os.path.join(tmpdir, 'urls.txt')
+            with open(datafile, 'w', encoding='utf-8') as f:
+                f.write("img-1\turl-1\nimg-2\turl-2\textra\nimg-3\turl-3\n")
+            with PersistMandlagore(os.path.join(tmpdir, 'mdlg-test.db')) as db:
+                db.ensure_schema(rebuilt=True)
+                helper = DBOperationHelper(db.conn)
+                helper.IMPORT_CHUNK_SIZE = 2
+                journal_mode = db.conn.execute("PRAGMA journal_mode").fetchone()[0]
+                indexes = db.conn.execute("SELECT name, sql FROM sqlite_master WHERE type = 'index' ORDER BY name").fetchall()
+                query = SQLBuilder.build_insert_into_query_with_parameters('images', ['imageID', 'documentURL'])
+                report, warnings = helper.import_csv_mode_file(datafile, query, 'utf-8', '\t', DBOperationHelper.SINGLE_RECORD, None, None, 'images')
+
+                self.assertTrue(report.startswith("3 lines imported"), report)
+                self.assertEqual(1, len(warnings))
+                self.assertIn("img-2", warnings[0])
+                ids = [r[0] for r in db.conn.execute("SELECT imageID FROM images ORDER BY imageID")]
+                self.assertEqual(['img-1', 'img-3'], ids)
+                self.assertEqual(indexes, db.conn.execute("SELECT name, sql FROM sqlite_master WHERE type = 'index' ORDER BY name").fetchall())
+                self.assertEqual(journal_mode, db.conn.execute("PRAGMA journal_mode").fetchone()[0])
+                self.assertEqual(1, db.conn.execute("PRAGMA synchronous").fetchone()[0])
@@ -0,0 +1,76 @@
+import unittest
+import tempfile
+import os
+import numpy as np
+from PIL import Image
+from mdlg.persistence.db import PersistMandlagore
+from mdlg.services.pyramid_store import PyramidStore
+from mdlg.services.dhsegment_generator import DhSegmentGenerator, rasterize, split_of, SCENE_COLOR
+
+IMAGES = [{
+    'imageID': '8470209-%d' % p,
+    'documentURL': 'https://gallica.bnf.fr/iiif/ark:/12148/btv1b8470209d/f%d/full/full/0/native.jpg' % p,
+    'width': 2000,
+    'height': 1000
+} for p in range(1, 6)]
+
+
+class TestDhSegmentGenerator(unittest.TestCase):
+    def test_rasterize(self):
+        mask = rasterize(np.array([[1, 1, 2, 3], [2, 2, 3, 1], [8, 4, 5, 5]]), (10, 6))
+        self.assertEqual((6, 10), mask.shape)
+        # the boxes overlap on one pixel, the last one is clipped to the mask
+        self.assertEqual(6 + 2 + 2 * 2, mask.sum())
+        self.assertTrue(mask[2, 4] and mask[1, 1] and mask[5, 9])
+        self.assertFalse(mask[0, 0] or mask[3, 4])
+
+    def test_split_of(self):
+        ids = ['doc-%d' % i for i in range(1000)]
+        sets = [split_of(i, (80, 10, 10)) for i in ids]
+        self.assertEqual(sets, [split_of(i, (80, 10, 10)) for i in ids])
+        self.assertTrue(700 < sets.count('train') < 900)
+        self.assertEqual(['test'] * 10, [split_of(i, (0, 1, 0)) for i in ids[:10]])
+
+    def test_generate(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            with PersistMandlagore(os.path.join(tmpdir, 'mdlg-test.db')) as db:
+                db.ensure_schema(True)
+                db.ensure_images(IMAGES)
+                db.add_scenes([
+                    {'mandragoreID': 1, 'imageID': '8470209-1', 'x': 1000, 'y': 0, 'width': 1000, 'height': 500},
+                    {'mandragoreID': 2, 'imageID': '8470209-2', 'x': 0, 'y': 0, 'width': 100, 'height': 100},
+                    {'mandragoreID': 3, 'imageID': '8470209-3', 'x': 0, 'y': 0, 'width': 100, 'height': 100},
+                    {'mandragoreID': 4, 'imageID': '8470209-4'},
+                    {'mandragoreID': 5, 'imageID': '8470209-5', 'x': 0, 'y': 0, 'width': 100, 'height': 100},
+                ])
+                # pages 1 and 2 are downloaded at 20%, page 3 is not downloaded, the file of page 5 is corrupted
+                for p in (1, 2, 5):
+                    path = 'IMG-8470209_P-%d_Z-20.jpg' % p
+                    Image.new('RGB', (400, 200), (255, 255, 255)).save(os.path.join(tmpdir, path))
+                    db.add_image_files([{'path': path, 'imageID': '8470209-%d' % p, 'zoom': 20, 'width': 400, 'height': 200}])
+                with open(os.path.join(tmpdir, 'IMG-8470209_P-5_Z-20.jpg'), 'wb') as f:
+                    f.write(b'not a jpeg')
+                # the level at 50% of page 1 is not read : the level at 20% is the smallest covering max_side
+                with open(os.path.join(tmpdir, 'IMG-8470209_P-1_Z-50.jpg'), 'wb') as f:
+                    f.write(b'not a jpeg')
+                db.add_image_files([{'path': 'IMG-8470209_P-1_Z-50.jpg', 'imageID': '8470209-1', 'zoom': 50, 'width': 1000, 'height': 500}])
+
+                outdir = os.path.join(tmpdir, 'dhsegment')
+                generator = DhSegmentGenerator(outdir, db, PyramidStore(tmpdir, db), max_side=100, split=(1, 0, 0))
+                report = generator.generate(workers=2)
+                # no level is built in the main process
+                self.assertEqual([20, 50], sorted(f['zoom'] for f in db.retrieve_image_files('8470209-1')))
+
+            self.assertTrue(report.startswith("2 pages generated"), report)
+            self.assertIn("1 pages skipped (no scene located, or no file downloaded), 1 pages failed:\n8470209-5 : ", report)
+            with open(os.path.join(outdir, 'classes.txt')) as f:
+                self.assertEqual("0 0 0\n0 255 0\n", f.read())
+            self.assertEqual(['IMG-8470209_P-1.jpg', 'IMG-8470209_P-2.jpg'], sorted(os.listdir(os.path.join(outdir, 'train', 'images'))))
+            with Image.open(os.path.join(outdir, 'train', 'images', 'IMG-8470209_P-1.jpg')) as im:
+                self.assertEqual((100, 50), im.size)
+            with Image.open(os.path.join(outdir, 'train', 'labels', 'IMG-8470209_P-1.png')) as im:
+                label = np.asarray(im)
+            self.assertEqual((50, 100, 3), label.shape)
+            # the scene is the upper right quarter of the page
+            self.assertEqual(50 * 25, (label == SCENE_COLOR).all(axis=-1).sum())
+            self.assertTrue((label[:25, 50:] == SCENE_COLOR).all())
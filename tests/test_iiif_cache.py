@@ -0,0 +1,44 @@
+import unittest
+import tempfile
+import os
+import time
+from mdlg.persistence.iiifCache import IIIFInfoCache
+
+URL = "https://gallica.bnf.fr/iiif/ark:/12148/btv1b8470209d/f%d/info.json"
+
+
+class TestIIIFInfoCache(unittest.TestCase):
+    def test_get_put(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            cache = IIIFInfoCache(tmpdir)
+            self.assertIsNone(cache.get(URL % 1))
+            cache.put(URL % 1, {'width': 100, 'height': 200})
+            self.assertEqual({'width': 100, 'height': 200}, cache.get(URL % 1))
+            self.assertIsNone(cache.get(URL % 2))
+
+            # the cache survives to the object
+            self.assertEqual({'width': 100, 'height': 200}, IIIFInfoCache(tmpdir).get(URL % 1))
+
+    def test_ttl(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            cache = IIIFInfoCache(tmpdir, ttl=60)
+            cache.put(URL % 1, {'width': 100, 'height': 200})
+            old = time.time() - 120
+            os.utime(cache._path(URL % 1), (old, old))
+            self.assertIsNone(cache.get(URL % 1))
+
+    def test_evict_oldest_entries(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            cache = IIIFInfoCache(tmpdir)
+            for p in range(10):
+                cache.put(URL % p, {'width': p, 'height': p})
+                t = time.time() - 1000 + p
+                os.utime(cache._path(URL % p), (t, t))
+            entry_size = os.path.getsize(cache._path(URL % 9))
+
+            cache._max_bytes = 5 * entry_size
+            removed = cache.evict()
+
+            self.assertTrue(removed >= 5)
+            self.assertIsNone(cache.get(URL % 0))
+            self.assertIsNotNone(cache.get(URL % 9))
@@ -0,0 +1,55 @@
+import unittest
+import unittest.mock
+import tempfile
+import os
+from mdlg.persistence.db import PersistMandlagore
+from mdlg.persistence.remoteHttp import GalacticaSession
+from mdlg.services.image_manager import ImagesManager
+
+IMAGES = [{
+    'imageID': '8470209-%d' % p,
+    'documentURL': 'https://gallica.bnf.fr/iiif/ark:/12148/btv1b8470209d/f%d/full/full/0/native.jpg' % p
+} for p in range(1, 8)]
+
+
+class TestImagesManager(unittest.TestCase):
+    def _ensure_content(self, workers):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            with PersistMandlagore(os.path.join(tmpdir, 'mdlg-test.db')) as db, GalacticaSession() as gal:
+                db.ensure_schema(True)
+                db.ensure_images(IMAGES)
+                imgr = ImagesManager(tmpdir, db, gal)
+                imgr.SIZES_BATCH = 3
+                imgr.ensure_content_images([], faked=True, workers=workers)
+
+                sizes = db.conn.execute("SELECT width, height FROM images").fetchall()
+                self.assertEqual([(10, 20)] * len(IMAGES), sizes)
+                files = [f for f in os.listdir(tmpdir) if f.startswith('IMG-') and f.endswith('.jpg')]
+                self.assertEqual(len(IMAGES), len(files))
+                recorded = db.conn.execute("SELECT path, zoom, width, height FROM image_files ORDER BY path").fetchall()
+                self.assertEqual(sorted((f, 20, 2, 4) for f in files), recorded)
+
+    def test_ensure_content_images_sequential(self):
+        self._ensure_content(1)
+
+    def test_ensure_content_images_concurrent(self):
+        self._ensure_content(4)
+
+    def test_ensure_content_images_missing_only(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            with PersistMandlagore(os.path.join(tmpdir, 'mdlg-test.db')) as db, GalacticaSession() as gal:
+                db.ensure_schema(True)
+                db.ensure_images(IMAGES)
+                imgr = ImagesManager(tmpdir, db, gal)
+                imgr.ensure_content_images([], faked=True)
+
+                # files are on disk, but not recorded any more : they are recorded again without being downloaded
+                db.conn.execute("DELETE FROM image_files WHERE imageID IN ('8470209-1', '8470209-2')")
+                db.conn.commit()
+                with unittest.mock.patch.object(gal, 'download_image') as download:
+                    ids, count = db.retrieve_images(('imageID', ), [], missing_zoom=imgr.DOWNLOAD_ZOOM)
+                    self.assertEqual(2, count)
+                    imgr.ensure_content_images([], faked=True, missing_only=True)
+                    download.assert_not_called()
+                count = db.conn.execute("SELECT COUNT(*) FROM image_files").fetchone()[0]
+                self.assertEqual(len(IMAGES), count)
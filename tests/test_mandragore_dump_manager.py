@@ -188,3 +188,18 @@ class TestViaLabelManager(unittest.TestCase):
                 # now try to import the files
                 mng.load_bnf_data()
                 self.verify_db_content(db, queries)
+
+    def test_bnf_dumps_single_pass_per_file(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            self.prepare_data(tmpdir, TEST_BNF_FILES)
+            with PersistMandlagore(os.path.join(tmpdir, 'mdlg-test.db')) as db:
+                db.ensure_schema(True)
+
+                mng = MandragoreDumpManager(tmpdir, db)
+                report = mng.load_bnf_data()
+
+                descriptors_reports = [r for f, r, w in report if f == 'Zoologie-notices-descripteurs.csv']
+                self.assertEqual(2, len(descriptors_reports))
+                self.assertIn("11 rows into classes", descriptors_reports[1])
+                count = db.conn.execute("SELECT COUNT(*) FROM classes").fetchone()[0]
+                self.assertEqual(11, count)
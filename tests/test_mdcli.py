@@ -1,5 +1,11 @@
 import unittest
-from mdlg.mdcli import build_filter_from_option
+import tempfile
+import os
+import json
+from click.testing import CliRunner
+from mdlg.mdcli import mdcli, build_filter_from_option, MdlgEnv
+from mdlg.persistence.db import SCHEMA_VERSION
+from mdlg.services.dataset_snapshot import DatasetSnapshot
 
 class TestUtils(unittest.TestCase):
     def test_build_filter_from_option(self):
@@ -17,3 +23,64 @@ class TestUtils(unittest.TestCase):
             result = build_filter_from_option(*params)
             for exp, real in zip(exp_results, result):
                 self.assertEqual(exp, real)
+
+
+class TestCommands(unittest.TestCase):
+    # each command run on an empty root dir : MdlgEnv creates its folders, and the DB is created on the first command
+
+    def setUp(self):
+        self._tmpdir = tempfile.TemporaryDirectory()
+        self.root = self._tmpdir.name
+        self.runner = CliRunner()
+
+    def tearDown(self):
+        self._tmpdir.cleanup()
+
+    def invoke(self, *args) -> str:
+        result = self.runner.invoke(mdcli, ['--root', self.root] + list(args))
+        self.assertEqual(0, result.exit_code, result.output)
+        return result.output
+
+    def test_migrate(self):
+        self.assertIn("version %d (was None)" % SCHEMA_VERSION, self.invoke('migrate'))
+        self.assertIn("version %d (was %d)" % (SCHEMA_VERSION, SCHEMA_VERSION), self.invoke('migrate'))
+        self.assertTrue(os.path.isdir(os.path.join(self.root, MdlgEnv.DIR_LOCATION['dhsegment_predict'])))
+
+    def test_snapshot(self):
+        self.assertIn("0 images, 0 scenes, 0 descriptors", self.invoke('snapshot'))
+        self.assertTrue(os.path.exists(os.path.join(self.root, MdlgEnv.DIR_LOCATION['snapshot'], DatasetSnapshot.META_FILENAME)))
+
+    def test_dhsegment(self):
+        self.assertIn("0 pages generated", self.invoke('dhsegment', '-w', '1', '--split', '1,0,0'))
+        self.assertTrue(os.path.exists(os.path.join(self.root, MdlgEnv.DIR_LOCATION['dhsegment_train'], 'classes.txt')))
+        result = self.runner.invoke(mdcli, ['--root', self.root, 'dhsegment', '--split', '1,0'])
+        self.assertEqual(2, result.exit_code)
+        self.assertIn("expected 3 ratios", result.output)
+
+    def test_postprocess_and_diff(self):
+        self.assertIn("0 boxes found in 0 predictions", self.invoke('postprocess', '-w', '1'))
+        self.assertIn("recorded in DB as run run-1", self.invoke('postprocess', '-w', '1', '--run', 'run-1'))
+        self.invoke('postprocess', '-w', '1', '--run', 'run-2')
+        output = os.path.join(self.root, 'diff.csv')
+        self.assertIn("run-1 -> run-2 : 0 boxes added, 0 boxes removed, 0 boxes moved", self.invoke('diff', 'run-1', 'run-2', '-o', output))
+        with open(output) as f:
+            self.assertEqual(1, len(f.read().splitlines()))
+        result = self.runner.invoke(mdcli, ['--root', self.root, 'diff', 'run-1', 'run-3'])
+        self.assertEqual(2, result.exit_code)
+        self.assertIn("no run run-3 in DB", result.output)
+
+    def test_evaluate(self):
+        self.assertIn("0 predictions skipped", self.invoke('evaluate', '-w', '1', '--cutoffs', '0.5'))
+        self.assertTrue(os.path.exists(os.path.join(self.root, MdlgEnv.DIR_LOCATION['dhsegment_predict'], 'eval.csv')))
+        result = self.runner.invoke(mdcli, ['--root', self.root, 'evaluate', '--cutoffs', 'half'])
+        self.assertEqual(2, result.exit_code)
+        params = os.path.join(self.root, 'grid.json')
+        with open(params, 'w') as f:
+            json.dump({'params': {'thresold': [0.5]}}, f)
+        result = self.runner.invoke(mdcli, ['--root', self.root, 'evaluate', '-p', params])
+        self.assertEqual(2, result.exit_code)
+        self.assertIn("unknown params thresold", result.output)
+
+    def test_classify(self):
+        self.assertIn("0 crops exported in 0 shards", self.invoke('classify', '-w', '1'))
+        self.assertTrue(os.path.exists(os.path.join(self.root, MdlgEnv.DIR_LOCATION['classify_train'], 'index.json')))
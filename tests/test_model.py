@@ -1,4 +1,6 @@
-from mdlg.model.model import GalacticaURL, ZONE_FULL, ZONE_KEYS, SIZE_FULL, SIZE_KEYS
+from mdlg.model.model import GalacticaURL, ZONE_FULL, ZONE_KEYS, SIZE_FULL, SIZE_KEYS, zone_in_zone_as_pct, zone_iou, zone_in_zone
+from mdlg.model import geometry
+import numpy as np
 import unittest
 
 
@@ -28,3 +30,69 @@ class TestGalacticaURL(unittest.TestCase):
         self.assertEqual("https://gallica.bnf.fr/iiif/ark:/12148/btv1bDOCUMENTIDd/f200/11,12,13,14/full/0/bicolor.jpg-1", gal.set_quality('bicolor').as_url())
         self.assertEqual("https://gallica.bnf.fr/iiif/ark:/12148/btv1bDOCUMENTIDd/f200/11,12,13,14/full/0/bicolor.png",
                          gal.set_quality('bicolor').set_file_format('png').as_url())
+
+    def test_immutable_and_shared(self):
+        url = "https://gallica.bnf.fr/iiif/ark:/12148/btv1bDOCUMENTIDd/f200/full/full/0/native.jpg"
+        gal = GalacticaURL.from_url(url)
+        self.assertIs(url, gal.as_url())
+        with self.assertRaises(AttributeError):
+            gal.other = 1
+        with self.assertRaises(AttributeError):
+            gal.params = ()
+
+        zoomed = gal.set_size(20)
+        self.assertEqual("https://gallica.bnf.fr/iiif/ark:/12148/btv1bDOCUMENTIDd/f200/full/pct:20/0/native.jpg", zoomed.as_url())
+        self.assertEqual(url, gal.as_url())
+        self.assertEqual(gal.as_filename(), zoomed.as_filename())
+        self.assertEqual(gal, zoomed.set_size(SIZE_FULL))
+        self.assertIs(gal, gal.set_zone(ZONE_FULL))
+        self.assertEqual('IMG-DOCUMENTID_P-200.png', zoomed.set_file_format('png').as_filename())
+
+        # short urls are padded
+        short = GalacticaURL.from_url("https://gallica.bnf.fr/iiif/ark:/12148/btv1bDOCUMENTIDd/f3")
+        self.assertEqual(12, len(short.params))
+        self.assertEqual(3, short.page_number())
+
+    def test_parse_many(self):
+        urls = ["https://gallica.bnf.fr/iiif/ark:/12148/btv1bDOC%dd/f%d/full/full/0/native.jpg" % (i % 2, i % 3) for i in range(12)]
+        parsed = GalacticaURL.parse_many(urls)
+        self.assertEqual(urls, [g.as_url() for g in parsed])
+        self.assertEqual(6, len({id(g) for g in parsed}))
+        self.assertEqual([GalacticaURL.from_url(u).as_filename() for u in urls], [g.as_filename() for g in parsed])
+
+
+class TestGeometry(unittest.TestCase):
+    def test_zone_in_zone_as_pct(self):
+        pct = zone_in_zone_as_pct({'x': 100, 'y': 100, 'width': 200, 'height': 400}, {'x': 50, 'y': 100, 'width': 100, 'height': 40})
+        self.assertEqual({'x': 0.5, 'y': 0.3, 'width': 0.5, 'height': 0.1}, pct)
+
+    def test_pct_conversions(self):
+        boxes = geometry.as_boxes([(50, 100, 100, 40), (0, 0, 10, 10)])
+        sizes = [(200, 400), (20, 10)]
+        pct = geometry.px_to_pct(boxes, sizes)
+        np.testing.assert_allclose([[0.5, 0.3, 0.5, 0.1], [0.25, 0.5, 0.5, 1.0]], pct)
+        np.testing.assert_allclose(boxes, geometry.pct_to_px(pct, sizes))
+
+    def test_as_boxes(self):
+        expected = [[1, 2, 3, 4], [5, 6, 7, 8]]
+        structured = np.array([(1, 2, 3, 4, 9), (5, 6, 7, 8, 9)], dtype=[(k, '<i4') for k in ZONE_KEYS + ('other', )])
+        np.testing.assert_array_equal(expected, geometry.as_boxes(structured))
+        np.testing.assert_array_equal(expected, geometry.as_boxes([dict(zip(ZONE_KEYS, b)) for b in expected]))
+        self.assertEqual((0, 4), geometry.as_boxes([]).shape)
+        np.testing.assert_array_equal([False, True], geometry.undefined([[1, 2, 3, 4], [1, 2, -1, 4]]))
+
+    def test_clip_and_rescale(self):
+        boxes = geometry.as_boxes([(-10, 5, 30, 10), (90, 90, 20, 20), (200, 0, 10, 10)])
+        np.testing.assert_array_equal([[0, 5, 20, 10], [90, 90, 10, 10], [100, 0, 0, 10]], geometry.clip(boxes, (100, 100)))
+        np.testing.assert_array_equal([[-2, 1, 6, 2], [18, 18, 4, 4], [40, 0, 2, 2]], geometry.rescale(boxes, 20))
+        np.testing.assert_array_equal([[-10, 5, 30, 10], [45, 45, 10, 10]], geometry.rescale(boxes[:2], [100, 50]))
+
+    def test_iou_and_containment(self):
+        a = geometry.as_boxes([(0, 0, 10, 10), (20, 20, 10, 10)])
+        b = geometry.as_boxes([(5, 0, 10, 10), (0, 0, 10, 10), (0, 0, 0, 0)])
+        np.testing.assert_allclose([[50 / 150, 1, 0], [0, 0, 0]], geometry.iou_matrix(a, b))
+        np.testing.assert_allclose([[0.5, 1, 0], [0, 0, 0]], geometry.containment(a, b))
+        np.testing.assert_array_equal([[True, False]], geometry.contained(geometry.as_boxes([(2, 2, 5, 5)]), a))
+        self.assertAlmostEqual(50 / 150, zone_iou({'x': 0, 'y': 0, 'width': 10, 'height': 10}, (5, 0, 10, 10)))
+        self.assertTrue(zone_in_zone((0, 0, 10, 10), (5, 0, 10, 10), 0.5))
+        self.assertFalse(zone_in_zone((0, 0, 10, 10), (5, 0, 10, 10)))
@@ -0,0 +1,72 @@
+import unittest
+import tempfile
+import os
+import numpy as np
+from mdlg.persistence.db import PersistMandlagore
+from mdlg.services.ornaments_eval import OrnamentsEvaluator, param_grid, matched_ious, evaluate_pages
+
+URL = 'https://gallica.bnf.fr/iiif/ark:/12148/btv1b8470209d/f%d/full/full/0/native.jpg'
+
+
+class TestOrnamentsEval(unittest.TestCase):
+    def _probs(self):
+        # 2 scenes, the second one being faint
+        probs = np.full((60, 80), 0.1, dtype=np.float32)
+        probs[10:30, 5:35] = 0.9
+        probs[40:55, 50:75] = 0.4
+        return probs
+
+    def test_param_grid(self):
+        grid = param_grid({'threshold': [0.3, 0.5], 'ksize_open': [[0, 0], [5, 5]]})
+        self.assertEqual(4, len(grid))
+        self.assertEqual({'threshold': 0.3, 'ksize_open': [0, 0], 'ksize_close': [5, 5]}, grid[0])
+        self.assertEqual(1, len(param_grid({'threshold': 0.5, 'ksize_open': [3, 3]})))
+        with self.assertRaisesRegex(ValueError, "unknown params ksize in the grid - the params are threshold, ksize_open, ksize_close"):
+            param_grid({'ksize': [3, 3]})
+
+    def test_matched_ious(self):
+        predicted = np.array([[0, 0, 10, 10], [0, 0, 10, 5], [50, 50, 10, 10]])
+        truth = np.array([[0, 0, 10, 10], [100, 100, 10, 10]])
+        # the best pair is kept, the second box predicted matches nothing else
+        self.assertEqual([1.0], matched_ious(predicted, truth).tolist())
+        self.assertEqual([0.5], matched_ious(predicted[1:], truth).tolist())
+        self.assertEqual(0, len(matched_ious(predicted[:0], truth)))
+
+    def test_evaluate_pages(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, 'IMG-8470209_P-1.npy')
+            np.save(filename, self._probs())
+            truth = np.array([[50, 100, 300, 200], [500, 400, 250, 150], [0, 500, 10, 10]])
+            grid = param_grid({'threshold': [0.3, 0.5]})
+            matched, predicted, truth_count = evaluate_pages([(filename, URL % 1, (800, 600), truth)], grid, (0.5, 0.9), 0.0)
+        self.assertEqual(3, truth_count)
+        self.assertEqual([2, 1], predicted.tolist())
+        self.assertEqual([[2, 2], [1, 1]], matched.tolist())
+
+    def test_evaluate_dir(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            with PersistMandlagore(os.path.join(tmpdir, 'mdlg-test.db')) as db:
+                db.ensure_schema(True)
+                db.ensure_images([{'imageID': '8470209-%d' % p, 'documentURL': URL % p, 'width': 800, 'height': 600} for p in (1, 2)])
+                db.add_scenes([
+                    {'mandragoreID': 1, 'imageID': '8470209-1', 'x': 50, 'y': 100, 'width': 300, 'height': 200},
+                    {'mandragoreID': 2, 'imageID': '8470209-1', 'x': 500, 'y': 400, 'width': 250, 'height': 150},
+                    {'mandragoreID': 3, 'imageID': '8470209-2', 'x': 50, 'y': 100, 'width': 300, 'height': 100},
+                ])
+                for p in (1, 2):
+                    np.save(os.path.join(tmpdir, 'IMG-8470209_P-%d.npy' % p), self._probs())
+                evaluator = OrnamentsEvaluator(db, {'threshold': [0.3, 0.5]}, cutoffs=(0.5, 0.9))
+                results = evaluator.evaluate([os.path.join(tmpdir, 'IMG-8470209_P-%d.npy' % p) for p in (1, 2)], workers=2)
+                report = evaluator.evaluate_dir(tmpdir, workers=2)
+
+            self.assertEqual([0.3, 0.5], [r['params']['threshold'] for r in results])
+            # threshold 0.3 : 4 boxes, the 2 of page 1 match, and the first box of page 2 matches at 0.5 only (IoU 0.5)
+            self.assertEqual({0.5: 0.75, 0.9: 0.5}, results[0]['precision'])
+            self.assertEqual({0.5: 1.0, 0.9: 2 / 3}, results[0]['recall'])
+            self.assertEqual({0.5: 1.0, 0.9: 0.5}, results[1]['precision'])
+            self.assertTrue(report.startswith("2 params evaluated on 2 predictions"), report)
+            self.assertIn("best F1 at IoU 0.5 : {'threshold': 0.3", report)
+            with open(os.path.join(tmpdir, 'eval.csv')) as f:
+                lines = f.read().splitlines()
+            self.assertEqual('threshold,ksize_open,ksize_close,predicted,truth,precision@0.5,precision@0.9,recall@0.5,recall@0.9', lines[0])
+            self.assertEqual('0.3,5x5,5x5,4,3,0.7500,0.5000,1.0000,0.6667', lines[1])
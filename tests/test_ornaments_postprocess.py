@@ -0,0 +1,102 @@
+import unittest
+import tempfile
+import os
+import glob
+import numpy as np
+from mdlg.persistence.db import PersistMandlagore
+from mdlg.model.model import GalacticaURL
+from mdlg.services.ornaments_postprocess import OrnamentsPostProcessor, otsu_threshold, binarize, erode, dilate, opening, closing, \
+    component_boxes, post_process, to_page, image_id_of
+
+
+class TestOrnamentsPostProcess(unittest.TestCase):
+    def _probs(self):
+        # 2 scenes, a spot of noise, and a hole in the first scene
+        probs = np.full((60, 80), 0.1, dtype=np.float32)
+        probs[10:30, 5:35] = 0.9
+        probs[20, 20] = 0.2
+        probs[40:55, 50:75] = 0.8
+        probs[5, 70] = 0.95
+        return probs
+
+    def test_threshold(self):
+        probs = self._probs()
+        self.assertTrue(0.1 < otsu_threshold(probs) <= 0.8)
+        self.assertEqual((2, ), otsu_threshold(np.stack([probs, probs])).shape)
+        self.assertEqual(20 * 30 - 1 + 15 * 25 + 1, binarize(probs, -1).sum())
+        self.assertEqual(20 * 30 - 1 + 1, binarize(probs, 0.85).sum())
+
+    def test_morphology(self):
+        mask = np.zeros((9, 9), dtype=bool)
+        mask[2:7, 2:7] = True
+        self.assertEqual(9, erode(mask, (3, 3)).sum())
+        self.assertEqual(15, erode(mask, (1, 3)).sum())
+        self.assertEqual(49, dilate(mask, (3, 3)).sum())
+        # the hole is filled by the closing
+        mask[4, 4] = False
+        self.assertEqual(0, erode(mask, (3, 3)).sum())
+        self.assertEqual(25, closing(mask, (3, 3)).sum())
+        mask[0, 0] = True
+        self.assertFalse(opening(mask, (3, 3))[0, 0])
+        # a batch of masks is processed at once
+        self.assertEqual((2, 9, 9), erode(np.stack([mask, mask]), (3, 3)).shape)
+
+    def test_component_boxes(self):
+        mask = np.zeros((6, 8), dtype=bool)
+        mask[0, 0:3] = True
+        mask[1, 3] = True  # touches the first run by a corner
+        mask[2:4, 6:8] = True
+        mask[4, 0] = True
+        mask[5, 0:2] = True
+        boxes, areas, scores = component_boxes(mask, mask.astype(np.float64))
+        self.assertEqual([[0, 0, 4, 2], [6, 2, 2, 2], [0, 4, 2, 2]], boxes.tolist())
+        self.assertEqual([4, 4, 3], areas.tolist())
+        self.assertEqual([1, 1, 1], scores.tolist())
+        # a U shape is one component, its branches being joined on the last row only
+        u = np.zeros((4, 5), dtype=bool)
+        u[:, 0] = u[:, 4] = u[3, :] = True
+        self.assertEqual([[0, 0, 5, 4]], component_boxes(u)[0].tolist())
+        self.assertEqual(0, len(component_boxes(np.zeros((3, 3), dtype=bool))[0]))
+
+    def test_post_process(self):
+        boxes, scores = post_process(self._probs())
+        self.assertEqual([[5, 10, 30, 20], [50, 40, 25, 15]], boxes.tolist())
+        self.assertTrue(0.85 < scores[0] < 0.9)
+        self.assertEqual(1, len(post_process(self._probs(), min_area=0.1)[0]))
+
+    def test_to_page(self):
+        gal = GalacticaURL.from_url('https://gallica.bnf.fr/iiif/ark:/12148/btv1b8470209d/f11/full/full/0/native.jpg')
+        self.assertEqual([[100, 50, 200, 100]], to_page([[10, 5, 20, 10]], (60, 80), gal, (800, 600)).tolist())
+        gal = gal.set_zone((400, 300, 160, 120)).set_size(50)
+        self.assertEqual([[420, 310, 40, 20]], to_page([[10, 5, 20, 10]], (60, 80), gal, (800, 600)).tolist())
+
+    def test_process_dir(self):
+        self.assertEqual('8470209-11', image_id_of('/tmp/IMG-8470209_P-11.npy'))
+        self.assertIsNone(image_id_of('boxes.csv'))
+        with tempfile.TemporaryDirectory() as tmpdir:
+            with PersistMandlagore(os.path.join(tmpdir, 'mdlg-test.db')) as db:
+                db.ensure_schema(True)
+                db.ensure_images([{
+                    'imageID': '8470209-%d' % p,
+                    'documentURL': 'https://gallica.bnf.fr/iiif/ark:/12148/btv1b8470209d/f%d/full/full/0/native.jpg' % p,
+                    'width': 800 if p == 1 else None,
+                    'height': 600 if p == 1 else None
+                } for p in (1, 2)])
+                # class 1 of the maps holds the scenes
+                for p in (1, 2):
+                    np.save(os.path.join(tmpdir, 'IMG-8470209_P-%d.npy' % p), np.stack([1 - self._probs(), self._probs()], axis=-1))
+                # the pages skipped are known before any file is processed
+                skipped = []
+                results = OrnamentsPostProcessor(db).process(sorted(glob.glob(os.path.join(tmpdir, '*.npy'))), 1, skipped)
+                self.assertEqual(['IMG-8470209_P-2.npy'], [os.path.basename(f) for f in skipped])
+                self.assertEqual(['8470209-1'], [imageID for imageID, _, _ in results])
+                report = OrnamentsPostProcessor(db).process_dir(tmpdir, workers=2, run='run-1')
+                self.assertEqual([('8470209-1', 50, 100, 300, 200), ('8470209-1', 500, 400, 250, 150)],
+                                 db.conn.execute("SELECT imageID, x, y, width, height FROM predictions WHERE runID = 'run-1' ORDER BY x").fetchall())
+            self.assertTrue(report.startswith("2 boxes found in 1 predictions"), report)
+            self.assertIn("recorded in DB as run run-1", report)
+            self.assertTrue(report.endswith("1 predictions skipped (page not in DB, or without size)"), report)
+            with open(os.path.join(tmpdir, 'boxes.csv')) as f:
+                lines = f.read().splitlines()
+            self.assertEqual('imageID,x,y,width,height,score', lines[0])
+            self.assertEqual(['8470209-1,50,100,300,200', '8470209-1,500,400,250,150'], [l.rsplit(',', 1)[0] for l in lines[1:]])
@@ -0,0 +1,50 @@
+import unittest
+import unittest.mock
+import tempfile
+import os
+from PIL import Image
+from mdlg.persistence.db import PersistMandlagore
+from mdlg.persistence.remoteHttp import GalacticaSession
+from mdlg.services.pyramid_store import PyramidStore, LevelNotAvailable
+
+IMAGE = {'imageID': '8470209-1', 'documentURL': 'https://gallica.bnf.fr/iiif/ark:/12148/btv1b8470209d/f1/full/full/0/native.jpg', 'width': 1000, 'height': 800}
+
+
+class TestPyramidStore(unittest.TestCase):
+    def _store(self, tmpdir, db, gal=None):
+        db.ensure_schema(True)
+        db.ensure_images([IMAGE])
+        Image.new('RGB', (500, 400), (200, 10, 10)).save(os.path.join(tmpdir, 'IMG-8470209_P-1_Z-50.jpg'))
+        db.add_image_files([{'path': 'IMG-8470209_P-1_Z-50.jpg', 'imageID': '8470209-1', 'zoom': 50, 'width': 500, 'height': 400}])
+        return PyramidStore(tmpdir, db, gal)
+
+    def test_get_derives_smaller_levels(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            with PersistMandlagore(os.path.join(tmpdir, 'mdlg-test.db')) as db:
+                store = self._store(tmpdir, db)
+                self.assertEqual(os.path.join(tmpdir, 'IMG-8470209_P-1_Z-50.jpg'), store.get('8470209-1', (400, None)))
+
+                level = store.get('8470209-1', (90, 75))
+                self.assertEqual(os.path.join(tmpdir, 'IMG-8470209_P-1_Z-10.jpg'), level)
+                with Image.open(level) as im:
+                    self.assertEqual((100, 80), im.size)
+                self.assertEqual([50, 10], [f['zoom'] for f in store.levels('8470209-1')])
+                self.assertEqual(level, store.get('8470209-1', (100, None)))
+
+                # no larger level held, and no galactica session
+                with self.assertRaises(LevelNotAvailable):
+                    store.get('8470209-1', (800, None))
+
+    def test_get_downloads_missing_levels(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            with PersistMandlagore(os.path.join(tmpdir, 'mdlg-test.db')) as db, GalacticaSession() as gal:
+                store = self._store(tmpdir, db, gal)
+                with unittest.mock.patch.object(gal, 'download_image', side_effect=lambda url, filename, *args: Image.new('RGB', (1000, 800)).save(filename)) \
+                        as download:
+                    level = store.get('8470209-1', (None, 500))
+                    self.assertEqual(os.path.join(tmpdir, 'IMG-8470209_P-1_Z-100.jpg'), level)
+                    self.assertEqual('https://gallica.bnf.fr/iiif/ark:/12148/btv1b8470209d/f1/full/pct:100/0/native.jpg', download.call_args[0][0])
+                    store.get('8470209-1', (None, 500))
+                    store.get('8470209-1', (200, None))
+                    self.assertEqual(1, download.call_count)
+                self.assertEqual([100, 50, 20], [f['zoom'] for f in store.levels('8470209-1')])
@@ -1,14 +1,21 @@
 import unittest
-from mdlg.persistence.remoteHttp import download_binary_file, GalacticaSession
+import unittest.mock
+from mdlg.persistence.remoteHttp import download_binary_file, GalacticaSession, is_complete_download, read_manifest, CannotRetriveInformation, PARTIAL_SUFFIX
 from unittest.mock import patch
 import json
 import tempfile
 import os
 from requests import Session
 from mdlg.model.model import GalacticaURL
+from mdlg.persistence.iiifCache import IIIFInfoCache
+from mdlg.persistence.rateLimiter import RateLimiter, RetryPolicy
+from requests import HTTPError
 
 
 class FakeRequest:
+    status_code = 200
+    headers = {}
+
     def raise_for_status(self):
         pass
 
@@ -22,7 +29,54 @@ class FakeRequest:
         })
 
 
+class FakeRangeSession:
+    # serve CONTENT, honoring the Range header - the first response is cut after 'cut' bytes
+    CONTENT = bytes(range(256)) * 40
+
+    def __init__(self, cut=None):
+        self.cut = cut
+        self.ranges = []
+
+    def get(self, url, stream=False, headers=None, timeout=None):
+        start = 0
+        if headers is not None and 'Range' in headers:
+            start = int(headers['Range'][len('bytes='):-1])
+        self.ranges.append(start)
+        body = self.CONTENT[start:]
+        response = unittest.mock.Mock()
+        response.status_code = 206 if start > 0 else 200
+        response.headers = {'content-length': str(len(body))}
+        if self.cut is not None:
+            body = body[:self.cut]
+            self.cut = None
+        response.iter_content.return_value = (body[i:i + 1024] for i in range(0, len(body), 1024))
+        return response
+
+
 class TestRemoteHTTP(unittest.TestCase):
+    def test_download_resumed(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            datafile = os.path.join(tmpdir, "image.jpg")
+            session = FakeRangeSession(cut=3000)
+            with self.assertRaises(CannotRetriveInformation):
+                download_binary_file(session, "http://localhost/image.jpg", datafile, progress=False)
+            self.assertFalse(os.path.exists(datafile))
+            self.assertFalse(is_complete_download(datafile))
+            self.assertEqual(3000, os.path.getsize(datafile + PARTIAL_SUFFIX))
+
+            download_binary_file(session, "http://localhost/image.jpg", datafile, progress=False)
+            self.assertEqual([0, 3000], session.ranges)
+            with open(datafile, 'rb') as d:
+                self.assertEqual(FakeRangeSession.CONTENT, d.read())
+            self.assertFalse(os.path.exists(datafile + PARTIAL_SUFFIX))
+            self.assertEqual(len(FakeRangeSession.CONTENT), read_manifest(datafile)['length'])
+            self.assertTrue(is_complete_download(datafile, verify=True))
+
+            # a truncated file does not match its manifest any more
+            with open(datafile, 'r+b') as d:
+                d.truncate(100)
+            self.assertFalse(is_complete_download(datafile))
+
     @patch('mdlg.persistence.remoteHttp.requests.Session.get')
     def test_collect_image_size(self, mock_requests):
         mock_requests.return_value = FakeRequest()
@@ -32,6 +86,46 @@ class TestRemoteHTTP(unittest.TestCase):
         self.assertEqual(100, width)
         self.assertEqual(200, height)
 
+    @patch('mdlg.persistence.remoteHttp.requests.Session.get')
+    def test_collect_image_size_from_cache(self, mock_requests):
+        mock_requests.return_value = FakeRequest()
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            for _ in range(3):
+                with GalacticaSession(cache=IIIFInfoCache(tmpdir)) as g:
+                    width, height = g.collect_image_size("https://gallica.bnf.fr/iiif/ark:/12148/btv1b8470209d/f11/full/pct:20/0/native.jpg")
+                self.assertEqual((100, 200), (width, height))
+        self.assertEqual(1, mock_requests.call_count)
+
+    @patch('mdlg.persistence.remoteHttp.requests.Session.get')
+    def test_collect_image_size_retried(self, mock_requests):
+        busy = unittest.mock.Mock(status_code=503, headers={'retry-after': '2'})
+        busy.raise_for_status.side_effect = HTTPError("503 Service Unavailable", response=busy)
+        mock_requests.side_effect = [busy, busy, FakeRequest()]
+        clock = FakeClock()
+        sleep = unittest.mock.Mock(side_effect=clock.sleep)
+
+        with GalacticaSession(rate_options={'clock': clock, 'sleep': clock.sleep}, sleep=sleep) as g:
+            self.assertEqual((100, 200), g.collect_image_size("https://gallica.bnf.fr/iiif/ark:/12148/btv1b8470209d/f11/info.json"))
+            self.assertEqual(3, mock_requests.call_count)
+            self.assertEqual((5, 30), mock_requests.call_args[1]['timeout'])
+            # the Retry-After of the server is the minimal backoff, and the rate of the host is reduced
+            self.assertTrue(all(c[0][0] >= 2 for c in sleep.call_args_list))
+            self.assertLess(g.rate_limiter("https://gallica.bnf.fr/").rate, 4.0)
+
+        # no retry on errors that are not transient
+        missing = unittest.mock.Mock(status_code=404, headers={})
+        missing.raise_for_status.side_effect = HTTPError("404 Not Found", response=missing)
+        mock_requests.side_effect = None
+        mock_requests.return_value = missing
+        mock_requests.reset_mock()
+        with GalacticaSession(rate_options={'clock': clock, 'sleep': clock.sleep}, sleep=sleep) as g:
+            with self.assertRaises(CannotRetriveInformation) as cm:
+                g.collect_image_size("https://gallica.bnf.fr/iiif/ark:/12148/btv1b8470209d/f11/info.json")
+            self.assertEqual(404, cm.exception.status_code)
+            self.assertFalse(cm.exception.transient)
+        self.assertEqual(1, mock_requests.call_count)
+
     def test_download_file(self):
         FILENAME = "google_home.http"
         with tempfile.TemporaryDirectory() as tmpdir:
@@ -55,3 +149,69 @@ class TestGalacticaSession(unittest.TestCase):
             with GalacticaSession() as g:
                 g.download_image(gal.as_url(), datafile)
                 w, h = g.collect_image_size(gal.as_url())
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, delay):
+        self.now += delay
+
+
+class TestRateLimiter(unittest.TestCase):
+    def test_token_bucket(self):
+        clock = FakeClock()
+        limiter = RateLimiter(rate=2.0, burst=2.0, clock=clock, sleep=clock.sleep)
+        for _ in range(6):
+            limiter.acquire()
+        # 2 requests of the burst, then 2 requests per second
+        self.assertAlmostEqual(2.0, clock.now)
+
+    def test_aimd(self):
+        clock = FakeClock()
+        limiter = RateLimiter(rate=4.0, min_rate=1.0, max_rate=5.0, latency_target=1.0, clock=clock, sleep=clock.sleep)
+        limiter.on_response(200, 0.1)
+        self.assertEqual(4.5, limiter.rate)
+        limiter.on_response(429)
+        self.assertEqual(2.25, limiter.rate)
+        # the responses to the requests in flight report the same congestion : only one decrease
+        limiter.on_response(None)
+        self.assertEqual(2.25, limiter.rate)
+        clock.now += RateLimiter.DECREASE_PERIOD
+        limiter.on_response(200, 3.0)
+        self.assertEqual(1.125, limiter.rate)
+        clock.now += RateLimiter.DECREASE_PERIOD
+        limiter.on_response(500)
+        self.assertEqual(1.0, limiter.rate)
+        for _ in range(10):
+            limiter.on_response(200)
+        self.assertEqual(5.0, limiter.rate)
+
+        # Retry-After pauses the requests
+        limiter.on_response(503, retry_after=10)
+        start = clock.now
+        limiter.acquire()
+        self.assertGreaterEqual(clock.now - start, 10)
+
+    def test_transient_errors(self):
+        # no response, server overloaded or failing
+        self.assertEqual([True, True, True, False, False], [CannotRetriveInformation("", s).transient for s in (None, 429, 503, 404, 400)])
+        self.assertFalse(CannotRetriveInformation("disk full", transient=False).transient)
+
+    def test_retry_policy(self):
+        policy = RetryPolicy(max_attempts=3, base_delay=1, max_delay=5, budget_ratio=0.5, min_retries=1, rand=lambda: 1.0)
+        self.assertEqual([2, 4, 5, 5], [policy.backoff(a) for a in range(1, 5)])
+        self.assertEqual(8, policy.backoff(1, retry_after=8))
+        self.assertFalse(policy.allow_retry(3))
+
+        # the budget allows 1 retry + 1 for 2 requests
+        self.assertTrue(policy.allow_retry(1))
+        self.assertFalse(policy.allow_retry(1))
+        policy.on_request()
+        policy.on_request()
+        self.assertTrue(policy.allow_retry(1))
+        self.assertFalse(policy.allow_retry(1))
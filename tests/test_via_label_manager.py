@@ -3,6 +3,7 @@ import unittest.mock
 import json
 import tempfile
 from mdlg.services.via_label_manager import ViaLabelManager
+from mdlg.persistence.remoteHttp import CannotRetriveInformation
 import os
 
 gallica_12148_f11 = {
@@ -129,7 +130,7 @@ class TestViaLabelManager(unittest.TestCase):
             with unittest.mock.patch('mdlg.persistence.remoteHttp.GalacticaSession',
                                      autospec=True) as MockGalactica:
                 with MockDB() as db:
-                    db.retrieve_image.return_value = None
+                    db.retrieve_images_by_ids.return_value = {}
                     gal = MockGalactica()
                     gal.collect_image_size.return_value = (1000, 2000)
                     vlm = ViaLabelManager(None, db, gal)
@@ -154,3 +155,36 @@ class TestViaLabelManager(unittest.TestCase):
                             'height': 2000
                         },
                     ])
+
+    def test_record_scenes_collects_shared_page_once(self):
+        with unittest.mock.patch('mdlg.persistence.db.PersistMandlagore', autospec=True) as MockDB:
+            with unittest.mock.patch('mdlg.persistence.remoteHttp.GalacticaSession', autospec=True) as MockGalactica:
+                with MockDB() as db:
+                    db.retrieve_images_by_ids.return_value = {}
+                    gal = MockGalactica()
+                    gal.collect_image_size.return_value = (1000, 2000)
+                    vlm = ViaLabelManager(None, db, gal)
+
+                    shared = dict(SCENES[1], mandragoreID='ID3', documentURL='https://gallica.bnf.fr/iiif/ark:/12148/doc/page2/0,0,10,10/full/0/native.jpg')
+                    vlm.record_scenes(SCENES + [shared])
+
+                    db.retrieve_images_by_ids.assert_called_once_with(['doc-page1', 'doc-page2', 'doc-page2'])
+                    self.assertEqual(2, gal.collect_image_size.call_count)
+                    self.assertEqual(2, len(db.ensure_images.call_args[0][0]))
+
+    def test_record_scenes_reports_missing_sizes(self):
+        with unittest.mock.patch('mdlg.persistence.db.PersistMandlagore', autospec=True) as MockDB:
+            with unittest.mock.patch('mdlg.persistence.remoteHttp.GalacticaSession', autospec=True) as MockGalactica:
+                with MockDB() as db:
+                    db.retrieve_images_by_ids.return_value = {}
+                    gal = MockGalactica()
+                    gal.collect_image_size.side_effect = CannotRetriveInformation("503", 503)
+                    vlm = ViaLabelManager(None, db, gal)
+
+                    warnings = []
+                    report = vlm.record_scenes(SCENES, warnings=warnings)
+
+                    self.assertEqual("2 scenes imported in DB. 2 image sizes could not be collected.", report)
+                    self.assertEqual(2, len(warnings))
+                    self.assertTrue(all(w.startswith("size of image https://gallica.bnf.fr/iiif/ark:/12148/doc/page") for w in warnings))
+                    self.assertEqual([(None, None)] * 2, [(i['width'], i['height']) for i in db.ensure_images.call_args[0][0]])